@@ -0,0 +1,385 @@
+"""
+This module runs the core protocol on an asyncio event loop instead of threads.
+
+AsyncServer and AsyncClient are asyncio DatagramProtocol versions of
+core.server.Server and core.client.Client.  They share all of the core packet
+handling (reliable, ACK, chunk, cluster, sync, ...) with those classes, so the
+protocol behaves identically.  Only the transport and the timing differ:
+    * recv() returns an awaitable for the next packet,
+    * send(), send_to_many() and send_chunked() never block, and
+    * reliable resends and Syncs are loop.call_later timers, not core.timer
+      ones.
+Nothing here spawns a thread per connection (or per anything), so a single
+loop can host zones, billers and bots with thousands of connections.
+
+This is python 2, so asyncio is the trollius backport.  From a coroutine:
+
+    server = yield From(AsyncServer.listen(("", 5000)))
+    client = yield From(AsyncClient.connect(("127.0.0.1", 5000)))
+    client.send(some_packet, reliable=True)
+    address, raw_packet = yield From(server.recv())
+"""
+import trollius as asyncio
+from trollius import From, Return
+from subspace.core import packet
+from subspace.core.client import Client, QUEUE_SIZE_IN
+from subspace.core.client import ACK_DELAY as CLIENT_ACK_DELAY
+from subspace.core.server import Server
+from subspace.core.server import ACK_DELAY, IDLE_TIMEOUT, MAX_CONNECTIONS
+from subspace.core.server import SEND_RATE
+from subspace.core.chunk import MAX_CHUNKED_SIZE
+from subspace.core.ingress import INGRESS_CAP, DROP_NEWEST
+from subspace.core.ratelimit import CONNECT_RATE, CONNECT_RATE_PER_IP
+from subspace.core.encryption import VIE, key_tables
+from threading import RLock, Event
+from collections import deque
+from time import time
+from logging import warn, info, debug
+
+CONNECT_ATTEMPTS = 3 # Connects sent before AsyncClient.connect gives up
+CONNECT_TIMEOUT = 3.0 # seconds to wait for each ConnectResponse
+
+class AsyncServer(Server, asyncio.DatagramProtocol):
+    """
+    This is core.server.Server as an asyncio DatagramProtocol.
+
+    Incoming datagrams are handled by the same CoreConnections as the
+    threaded server.  Outgoing packets are queued (and clustered) the same
+    way, but instead of a sending thread, the first packet queued schedules
+    one flush on the loop which writes everything due to the transport.
+    """
+
+    def __init__(self, loop=None, cluster_delay=0.0, ack_delay=ACK_DELAY,
+                 idle_timeout=IDLE_TIMEOUT, max_connections=MAX_CONNECTIONS,
+                 connect_rate=CONNECT_RATE,
+                 connect_rate_per_ip=CONNECT_RATE_PER_IP,
+                 send_rate=SEND_RATE, adaptive_send_rate=False,
+                 max_chunked_size=MAX_CHUNKED_SIZE, ingress_cap=INGRESS_CAP,
+                 ingress_drop=DROP_NEWEST):
+        # NOTE: this doesn't call Server.__init__, it would start threads
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._connections = {} # all active {client_address:CoreConnection}
+        self._connections_lock = RLock() # (only ever taken on the loop)
+        self._init_ingress(ingress_cap, ingress_drop)
+        self._receivers = deque() # futures of recv()'ers awaiting a packet
+        self._transport = None # set in connection_made
+        self._flush_scheduled = False # (a flush is queued with call_soon)
+        self._flush_timer = None # the delayed flush's handle (see _flush_at)
+        self._flush_at = None # when that is due
+        self._init_clustering(cluster_delay, ack_delay)
+        self._init_connection_limits(idle_timeout, max_connections,
+                                     connect_rate, connect_rate_per_ip,
+                                     max_chunked_size)
+        self._init_shaping(send_rate, adaptive_send_rate)
+        self._shutting_down = Event() # this stops the timers from firing
+        self.address = None
+
+    @classmethod
+    @asyncio.coroutine
+    def listen(cls, address, loop=None, cluster_delay=0.0,
+               ack_delay=ACK_DELAY, idle_timeout=IDLE_TIMEOUT,
+               max_connections=MAX_CONNECTIONS, connect_rate=CONNECT_RATE,
+               connect_rate_per_ip=CONNECT_RATE_PER_IP, send_rate=SEND_RATE,
+               adaptive_send_rate=False, max_chunked_size=MAX_CHUNKED_SIZE,
+               ingress_cap=INGRESS_CAP, ingress_drop=DROP_NEWEST):
+        """ This coroutine creates the server listening on address. """
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        server = cls(loop, cluster_delay, ack_delay, idle_timeout,
+                     max_connections, connect_rate, connect_rate_per_ip,
+                     send_rate, adaptive_send_rate, max_chunked_size,
+                     ingress_cap, ingress_drop)
+        yield From(loop.create_datagram_endpoint(lambda: server,
+                                                 local_addr=address))
+        raise Return(server)
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self.address = transport.get_extra_info("sockname")
+        key_tables.start() # so Connects find server keys with tables built
+        info("starting core server %s" % self)
+
+    def datagram_received(self, data, address):
+        self._handle_datagram(data, address)
+
+    def error_received(self, exc):
+        warn("core server socket error: %s" % exc)
+
+    def connection_lost(self, exc):
+        self._shutting_down.set()
+
+    def recv(self):
+        """
+        This returns an awaitable for the next (address, packet) tuple.  As
+        with Server.recv, packet is None when the address has disconnected.
+        """
+        received = asyncio.Future(loop=self._loop)
+        if self.ingress:
+            received.set_result(self.ingress.pop())
+        else:
+            self._receivers.append(received)
+        return received
+
+    def shutdown(self):
+        """ This notifies every client, flushes, and closes the transport. """
+        debug("shutting down core server")
+        self._shutting_down.set()
+        for address in self._connections.keys():
+            self.send(address, packet.Disconnect()) # let them know
+            self.send(address, packet.Disconnect()) # let them know
+        self._flush_outgoing()
+        self._schedule_flush(None)
+        for conn in self._connections.values():
+            conn._stop_timers()
+        self._connections.clear()
+        if self._transport is not None:
+            self._transport.close()
+
+    def _deliver(self, address, packet_data):
+        """
+        This queues the packet for recv() (see Server._deliver), and hands
+        queued packets to any recv()'ers waiting.
+        """
+        delivered = self.ingress.put(address, packet_data)
+        while self._receivers and self.ingress:
+            received = self._receivers.popleft()
+            if not received.cancelled(): # (e.g. by a wait_for's timeout)
+                received.set_result(self.ingress.pop())
+        return delivered
+
+    def _output_ready(self):
+        """
+        This schedules one flush of the outgoing queues on the loop, soon.  A
+        delayed flush (see _schedule_flush) doesn't hold it up.
+        """
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            # threadsafe so that other threads can still call send()
+            self._loop.call_soon_threadsafe(self._flush_outgoing)
+
+    def _flush_outgoing(self):
+        """
+        This hands everything due to the transport (which buffers).  If some
+        connections aren't due yet (see cluster_delay and ack_delay), it
+        schedules the next flush for when they will be.
+        """
+        self._flush_scheduled = False
+        if self._transport is None:
+            return
+        for encrypted, address in self._collect_outgoing(
+                                    force = self._shutting_down.is_set()):
+            self._transport.sendto(encrypted, address)
+        self._schedule_flush(self._next_flush)
+
+    def _schedule_flush(self, deadline):
+        """
+        This has the loop flush at deadline (or never, if it is None).  The
+        delayed flush already scheduled stays if it is due by then, otherwise
+        it is cancelled: whatever it was waiting for has since gone out.
+        """
+        if self._flush_timer is not None:
+            if deadline is not None and self._flush_at <= deadline:
+                return
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if deadline is not None:
+            self._flush_at = deadline
+            self._flush_timer = self._loop.call_later(
+                            max(0.0, deadline - time()), self._flush_delayed)
+
+    def _flush_delayed(self):
+        """ This is the delayed flush, see _schedule_flush. """
+        self._flush_timer = None
+        self._flush_outgoing()
+
+    def _call_later(self, delay, fn, *args):
+        """ This has the loop invoke fn(*args) after delay seconds. """
+        return self._loop.call_later(delay, self._fire, fn, *args)
+
+    def _fire(self, fn, *args):
+        """ This invokes timer fn, unless the server has since shut down. """
+        if not self._shutting_down.is_set():
+            fn(*args)
+
+class AsyncClient(Client, asyncio.DatagramProtocol):
+    """
+    This is core.client.Client as an asyncio DatagramProtocol.
+
+    Use AsyncClient.connect() to create one, it does the Connect handshake.
+    Packets are encrypted and written to the transport as they are sent, the
+    transport does any buffering.
+    """
+
+    def __init__(self, client_key=0x12345678, encryption=VIE, loop=None):
+        # NOTE: this doesn't call Client.__init__, it would start threads
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._in = asyncio.Queue(QUEUE_SIZE_IN, loop=self._loop)
+        self._init_protocol_state()
+        self._client_key = client_key
+        self._encryption = encryption
+        self._connected = False
+        self._connect_response = asyncio.Future(loop=self._loop)
+        self._transport = None # set in connection_made
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, address, client_key=0x12345678, encryption=VIE,
+                loop=None):
+        """
+        This coroutine creates the client and does the connection handshake.
+        As with Client, if the handshake fails, recv() will only give None.
+        """
+        loop = loop if loop is not None else asyncio.get_event_loop()
+        client = cls(client_key, encryption, loop)
+        yield From(loop.create_datagram_endpoint(lambda: client,
+                                                 remote_addr=address))
+        connect_p = packet.Connect(key=client_key, version=encryption.version)
+        for attempt in range(CONNECT_ATTEMPTS):
+            client._transport.sendto(connect_p.raw())
+            try:
+                yield From(asyncio.wait_for(
+                            asyncio.shield(client._connect_response, loop=loop),
+                            CONNECT_TIMEOUT, loop=loop))
+                break
+            except asyncio.TimeoutError:
+                continue
+        if not client._connected:
+            warn("connection failed")
+            client._transport.close()
+            client._transport = None
+        raise Return(client)
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, address):
+        if self._connected:
+            decrypted_data = self._decrypt_packet(data)
+            self._received_packet_count += 1
+            self._process_packet(decrypted_data)
+        elif data[:2] == '\x00'+packet.ConnectResponse._id:
+            p = packet.ConnectResponse(data)
+            self._enc = self._encryption(self._client_key, p.server_key)
+            self._connected = True
+            self._sync_timer()
+            if not self._connect_response.done():
+                self._connect_response.set_result(p)
+        else:
+            warn("no connect response: %s" %
+                    ''.join(x.encode("hex") for x in data))
+
+    def error_received(self, exc):
+        warn("core client socket error: %s" % exc)
+
+    def connection_lost(self, exc):
+        self._connected = False
+        self._transport = None
+        self._stop_timers()
+
+    def send(self, outgoing_packet, reliable = False):
+        """
+        This encrypts the packet (clustered with any held ACKs) and writes it
+        to the transport.  It never blocks.  (Packets sent before connecting,
+        or after, are dropped.)
+        """
+        if reliable:
+            outgoing_packet = self._track_reliable(outgoing_packet)
+            if outgoing_packet is None:
+                return # backlogged, an ACK will release it
+        raws = [outgoing_packet.raw()]
+        if self._acks_since is not None:
+            raws = self._take_acks() + raws
+        self._send_raws(raws)
+
+    def _send_nowait(self, outgoing_packet):
+        """ This is send(), which never blocks here anyway. """
+        self.send(outgoing_packet)
+        return True
+
+    def _send_raws(self, raws):
+        """ This clusters, encrypts and writes the raw packets. """
+        if self._transport is None:
+            return
+        for raw in self._cluster(raws):
+            self._transport.sendto(self._encrypt_packet(raw))
+            self._sent_packet_count += 1
+
+    def _ack_ready(self):
+        """ This schedules sending the held ACKs, unless a send takes them. """
+        self._loop.call_later(CLIENT_ACK_DELAY, self._flush_acks)
+
+    def _flush_acks(self):
+        """ This sends any held ACKs by themselves. """
+        self._send_raws(self._take_acks())
+
+    def recv(self):
+        """
+        This returns an awaitable for the next packet.  It gives None once the
+        connection is disconnected (or if it never connected).
+        """
+        if not self._connected and self._in.empty():
+            done = asyncio.Future(loop=self._loop)
+            done.set_result(None)
+            return done
+        return self._in.get()
+
+    def close(self):
+        """ This sends the Disconnect and closes the transport. """
+        if self._connected:
+            self.send(packet.Disconnect())
+            self._connected = False
+        if self._transport is not None:
+            self._transport.close() # this flushes before closing
+            self._transport = None
+
+    def _process_packet(self, packet_data):
+        """ This processes any core \\x00 packets, and queues all others. """
+        if packet_data[0] == '\x00':
+            self._process_core_packet(packet_data)
+        else:
+            try:
+                self._in.put_nowait(packet_data)
+            except asyncio.QueueFull:
+                warn("incoming queue full, discarding packet")
+
+    def _handle_disconnect(self, raw_packet):
+        """ This lets recv()'ers know (with a None) and closes up. """
+        if self._transport is None:
+            return # (a repeat, we already closed)
+        p = packet.Disconnect(raw_packet)
+        warn("disconnected from server")
+        self._in.put_nowait(None)
+        self._connected = False
+        self._stop_timers()
+        self._transport.close()
+        self._transport = None
+
+    def _call_later(self, delay, fn, *args):
+        """ This has the loop invoke fn(*args) after delay seconds. """
+        return self._loop.call_later(delay, fn, *args)
+
+def main():
+    import logging
+    logging.basicConfig(level=logging.DEBUG,
+            format="<%(threadName)25.25s > %(message)s")
+    loop = asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def run():
+        s = yield From(AsyncServer.listen(("127.0.0.1", 5000)))
+        c = [] # joined clients
+        for n in range(10):
+            print "Client connecting ..."
+            c.append((yield From(AsyncClient.connect(("127.0.0.1", 5000)))))
+        yield From(asyncio.sleep(3))
+        for client in c:
+            print "Client leaving ..."
+            client.close()
+        for client in c:
+            address, raw_packet = yield From(s.recv())
+            print "Server saw %s:%d leave" % address
+        s.shutdown()
+
+    loop.run_until_complete(run())
+
+if __name__ == '__main__':
+    main()
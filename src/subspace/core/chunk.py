@@ -0,0 +1,338 @@
+"""
+This reassembles packets that arrive in Chunks for one end of a connection,
+and sends and receives its streams.
+
+A packet too large for one datagram (e.g. ArenaSettings) is sent as reliable
+Chunks and a final ChunkTail (see packet.chunk_raws).  The receiver used to
+keep every chunk's tail in a list, without limit, so a peer that never sent
+a ChunkTail could grow it until memory ran out.  A ChunkBuffer copies each
+tail into one bytearray instead, and refuses to grow past max_size:
+
+>>> chunks = ChunkBuffer(max_size=4096)
+>>> chunks.add("\\x00\\x08" + "x" * 480, 2) # (past its \\x00\\x08)
+True
+>>> chunks.add("\\x00\\x09" + "y" * 20, 2) # the ChunkTail
+True
+>>> whole = chunks.take()
+>>> len(whole), whole[-1]
+(500, 'y')
+
+Each byte is copied twice in all: into the buffer, and out of it (as the str
+that is processed).  The second copy can't go: the whole packet is handed up
+to code (packet parsing, the game's handlers) that slices, concatenates and
+compares it as a str, which a bytearray or buffer doesn't behave as, and it
+may be queued for another thread while the buffer takes the next packet.
+(Without the buffer it was two copies as well: each tail sliced off its
+chunk, then joined.)  The bytearray is only allocated for the first chunk,
+and grows geometrically from there, so most connections never have one.
+
+Even larger packets (e.g. map and news files) go as a stream: reliable
+StreamRequest packets (\\x00\\x0A), each holding the total length and the
+next piece.  A StreamSender doesn't hand a whole transfer to the reliable
+window at once (its backlog would hold up every other reliable behind it).
+It keeps each transfer to STREAM_SHARE of the window, sending more pieces as
+ACKs come in, so the transfer goes as fast as the window grows and other
+reliables still get through.  A StreamReceiver reassembles them.  The
+protocol has no stream ids: one stream is sent at a time (in order), and a
+StreamCancelRequest cancels whatever is being streamed, either way.
+
+The same packet is often sent chunked to many clients (e.g. ArenaSettings to
+each entering player).  A ChunkCache keeps the raw Chunks of recent ones, so
+each is only packed and split once:
+
+>>> from subspace.game.s2c_packet import ArenaSettings
+>>> settings = ArenaSettings(tail="x" * 1400)
+>>> cache = ChunkCache(480)
+>>> raws = cache.raws(settings) # packed and split
+>>> cache.raws(settings) is raws # as before, without either
+True
+
+They are kept unencrypted and without reliable headers, so every connection
+still wraps them in its own Reliables (with its own seqs) and encrypts them.
+"""
+from subspace.core.packet import chunk_raws
+from struct import pack, unpack_from
+from collections import deque, OrderedDict
+from threading import Lock
+
+MAX_CHUNKED_SIZE = 64 * 1024 # bytes a chunked packet may add up to, at most
+INITIAL_SIZE = 2048 # bytes allocated for the first chunk (e.g. ArenaSettings)
+MAX_STREAM_SIZE = 4 * 1024 * 1024 # bytes a client accepts in one stream
+STREAM_SHARE = 0.5 # of the reliable window that streams may have in flight
+STREAM_HEADER_SIZE = 6 # \x00\x0A and the u32 total length
+STREAM_RESERVE_SIZE = 64 * 1024 # bytes reserved up front for a stream, at most
+CHUNK_CACHE_SIZE = 16 # chunked packets whose raw Chunks a ChunkCache keeps
+
+class ChunkBuffer:
+    """
+    This holds the tails of the chunks received so far.  add() refuses (and
+    empties the buffer) if they would add up to more than max_size bytes.
+    A buffer grown past INITIAL_SIZE is let go once taken, so one large
+    packet doesn't pin its memory for the rest of the connection.
+    """
+
+    def __init__(self, max_size=MAX_CHUNKED_SIZE):
+        self.max_size = max_size
+        self._data = None # the bytearray, allocated by the first add
+        self._size = 0 # bytes of _data in use
+
+    def __len__(self):
+        return self._size
+
+    def reserve(self, size):
+        """ This allocates room for size bytes up front (if it may hold them). """
+        if size <= self.max_size and \
+                (self._data is None or len(self._data) < size):
+            data = bytearray(size)
+            if self._size:
+                data[:self._size] = buffer(self._data, 0, self._size)
+            self._data = data
+
+    def add(self, raw, offset=0):
+        """
+        This appends raw[offset:] (one chunk's tail), it returns False if that
+        would overflow max_size.
+        """
+        end = self._size + len(raw) - offset
+        if end > self.max_size:
+            self.clear()
+            return False
+        if self._data is None:
+            self._data = bytearray(max(INITIAL_SIZE, end))
+        elif end > len(self._data):
+            grown = min(self.max_size, max(end, 2 * len(self._data)))
+            self._data.extend(bytearray(grown - len(self._data)))
+        self._data[self._size:end] = buffer(raw, offset)
+        self._size = end
+        return True
+
+    def take(self):
+        """ This returns the reassembled packet (a str) and empties this. """
+        whole = str(buffer(self._data, 0, self._size)) if self._size else ''
+        self.clear()
+        return whole
+
+    def clear(self):
+        """ This empties the buffer (letting go of it, if it grew large). """
+        self._size = 0
+        if self._data is not None and len(self._data) > INITIAL_SIZE:
+            self._data = None
+
+class ChunkCache:
+    """
+    This keeps the raw Chunks (see packet.chunk_raws, size bytes at a time)
+    of the max_entries packets most recently chunked, by packet.  Packets
+    are keyed by identity, so neither packing nor splitting is repeated for
+    the same packet object, which mustn't then change until discard()ed (or
+    it would still be sent as it was).  When full, the oldest is dropped.
+    It is threadsafe.
+    """
+
+    def __init__(self, size, max_entries=CHUNK_CACHE_SIZE):
+        self._size = size
+        self._max_entries = max_entries
+        self._raws = OrderedDict() # {packet:raw chunks}, oldest first
+        self._lock = Lock()
+        # these are just for inspecting how well the cache is working
+        self.hits = 0 # packets whose chunks were already split
+        self.misses = 0 # packets split (and cached)
+
+    def __len__(self):
+        return len(self._raws)
+
+    def raws(self, packet):
+        """
+        This returns the raw Chunks (a tuple) that carry the packet, or None
+        if it is small enough not to be chunked.
+        """
+        with self._lock:
+            raws = self._raws.get(packet)
+            if raws is not None:
+                self.hits += 1
+                return raws
+            data = packet.raw()
+            if len(data) < self._size:
+                return None
+            self.misses += 1
+            raws = self._raws[packet] = tuple(chunk_raws(data, self._size))
+            if len(self._raws) > self._max_entries:
+                self._raws.popitem(last=False)
+        return raws
+
+    def discard(self, packet):
+        """ This forgets the packet's raw Chunks (if they are kept). """
+        with self._lock:
+            self._raws.pop(packet, None)
+
+    def clear(self):
+        """ This forgets every packet's raw Chunks. """
+        with self._lock:
+            self._raws.clear()
+
+class StreamOut:
+    """
+    This is one outgoing stream transfer, as returned by send_stream.  Its
+    progress is in acked (of total bytes), and progress (if given) is called
+    with it whenever more is acknowledged (on whichever thread handled the
+    ACK, so it shouldn't block).  It's done once all is acked.
+    """
+
+    def __init__(self, data, piece_size, progress=None):
+        self.total = len(data)
+        self.sent = 0 # bytes handed to the reliable window
+        self.acked = 0 # bytes acknowledged
+        self.cancelled = False
+        self._data = data
+        self._header = '\x00\x0A' + pack("<I", self.total)
+        self._piece_size = piece_size
+        self._progress = progress
+        self._in_flight = deque() # (seq, size) of the pieces not yet acked
+
+    def __str__(self):
+        return "StreamOut(%d/%d bytes acked%s)" % (self.acked, self.total,
+                                    ", cancelled" if self.cancelled else "")
+
+    def done(self):
+        """ This returns whether every byte has been acknowledged. """
+        return self.acked == self.total
+
+    def report(self):
+        """ This calls progress (if any) with this. """
+        if self._progress is not None:
+            self._progress(self)
+
+    def _next_raw(self):
+        """ This returns the next piece's raw StreamRequest. """
+        end = min(self.total, self.sent + self._piece_size)
+        raw = self._header + self._data[self.sent:end]
+        self.sent = end
+        return raw
+
+class StreamSender:
+    """
+    This keeps a connection's outgoing streams, in order, and feeds their
+    pieces to its ReliableOut (see the module doc).  The caller holds the
+    lock on that ReliableOut around each method.  At most max_transfers (if
+    given) may be queued at once.
+    """
+
+    def __init__(self, piece_size, max_transfers=None):
+        self._piece_size = piece_size
+        self._max_transfers = max_transfers
+        self._transfers = [] # StreamOuts not yet done (or cancelled)
+
+    def __len__(self):
+        return len(self._transfers)
+
+    def add(self, data, progress=None):
+        """
+        This queues data (a raw packet) to stream, returning its StreamOut (or
+        None, if max_transfers are already queued).
+        """
+        if self._max_transfers is not None and \
+                len(self._transfers) >= self._max_transfers:
+            return None
+        transfer = StreamOut(data, self._piece_size, progress)
+        self._transfers.append(transfer)
+        return transfer
+
+    def pump(self, reliable_out, now, timeout):
+        """
+        This returns the new Reliables for as many pieces as may go now: the
+        window must have room to spare (and no backlog), and streams may only
+        have STREAM_SHARE of it in flight.
+        """
+        reliables = []
+        in_flight = sum(len(t._in_flight) for t in self._transfers)
+        share = max(1, int(reliable_out.window * STREAM_SHARE))
+        for transfer in self._transfers:
+            while transfer.sent < transfer.total and in_flight < share and \
+                    reliable_out.room() > 0:
+                start = transfer.sent
+                p = reliable_out.add(transfer._next_raw(), now, timeout)
+                transfer._in_flight.append((p.seq, transfer.sent - start))
+                reliables.append(p)
+                in_flight += 1
+            if transfer.sent < transfer.total:
+                break # (the next can't start before this one is all sent)
+        return reliables
+
+    def acked(self, seq):
+        """
+        This notes an ACK of every seq up to seq.  It returns the transfers
+        that progressed, for the caller to report() once it drops the lock.
+        """
+        progressed = []
+        for transfer in self._transfers:
+            acked = transfer.acked
+            while transfer._in_flight and transfer._in_flight[0][0] <= seq:
+                transfer.acked += transfer._in_flight.popleft()[1]
+            if transfer.acked != acked:
+                progressed.append(transfer)
+        if progressed:
+            self._transfers = [t for t in self._transfers if not t.done()]
+        return progressed
+
+    def cancel(self, transfer=None):
+        """
+        This cancels the transfer (or, by default, every transfer).  It
+        returns whether any of them had begun, so that the receiver has to
+        be told (with a StreamCancelRequest) to discard what it has.
+        """
+        cancelled = [t for t in self._transfers
+                        if transfer is None or t is transfer]
+        for t in cancelled:
+            t.cancelled = True
+        self._transfers = [t for t in self._transfers if not t.cancelled]
+        return any(t.sent for t in cancelled)
+
+class StreamReceiver:
+    """
+    This reassembles the pieces of an incoming stream into a ChunkBuffer of
+    at most max_size bytes.  While cancelling (having sent a
+    StreamCancelRequest, until its ACK), pieces still in flight are dropped.
+    Only STREAM_RESERVE_SIZE of the total the first piece claims is reserved
+    up front, past that the buffer grows as pieces arrive, so a peer can't
+    make us allocate much more than it has sent.
+    """
+
+    def __init__(self, max_size=MAX_STREAM_SIZE):
+        self._buffer = ChunkBuffer(max_size)
+        self.total = None # the length of the stream being received
+        self.cancelling = False
+
+    def __str__(self):
+        return "StreamReceiver(%d/%s bytes)" % (len(self._buffer), self.total)
+
+    def received(self):
+        """ This returns how many bytes of the current stream have come. """
+        return len(self._buffer)
+
+    def add(self, raw):
+        """
+        This adds the piece in the raw StreamRequest.  It returns the whole
+        packet once the last piece is in, otherwise None.  It returns False if
+        the stream is larger than max_size (or its pieces don't add up).
+        """
+        if self.cancelling or len(raw) < STREAM_HEADER_SIZE:
+            return None
+        total = unpack_from("<I", raw, 2)[0]
+        if self.total is None:
+            if total > self._buffer.max_size:
+                return False
+            self.total = total
+            self._buffer.reserve(min(total, STREAM_RESERVE_SIZE))
+        if total != self.total or \
+                len(self._buffer) + len(raw) - STREAM_HEADER_SIZE > total:
+            self.clear()
+            return False
+        self._buffer.add(raw, STREAM_HEADER_SIZE)
+        if len(self._buffer) < total:
+            return None
+        self.total = None
+        return self._buffer.take()
+
+    def clear(self):
+        """ This discards the stream received so far. """
+        self.total = None
+        self._buffer.clear()
@@ -11,19 +11,24 @@ module implements the controlling logic for these core packets.
 
 """
 from subspace.core import packet
+from subspace.core.reliable import ReliableIn, ReliableOut, RTTEstimator
 from subspace.core.encryption import VIE
+from subspace.core.timer import timers
+from subspace.core.clock import ClockSync, tick_diff
+from subspace.core.chunk import ChunkBuffer, StreamSender, StreamReceiver
 from subspace.util import now
 from socket import socket,AF_INET,SOCK_DGRAM,timeout
 from threading import Thread, Lock, Event
-from Queue import Queue, Empty
+from Queue import Queue, Empty, Full
 from time import time, sleep
 from logging import warn, info, debug
 
 MAX_PACKET_SIZE = 512 # we grab up to this many bytes from the socket at a time
+CHUNK_SIZE = 480 # this is the size of the chunks to send when chunking
 QUEUE_SIZE_IN = 500 # the number of incoming packets to queue before dropping 
 QUEUE_SIZE_OUT = 500 # same, but for outgoing packets
 SYNC_PERIOD = 5.0 # seconds between Sync's (see _sync)
-RELIABLE_TIMEOUT_RESEND = 5.0 # seconds between reliable resends
+ACK_DELAY = 0.02 # seconds a ReliableACK may wait for company (see _queue_ack)
 
 class Client(object):
     """
@@ -42,31 +47,51 @@ class Client(object):
     def __init__(self,address, client_key=0x12345678, encryption=VIE):
         self._in = Queue(QUEUE_SIZE_IN)
         self._out = Queue(QUEUE_SIZE_OUT)
-        # added to by _handle_reliable, removed from by _process_any_reliable
-        self._reliable_in = [] 
-        self._reliable_in_seq = 0
-        # for outgoing reliable packets, reliable_out is locked by 3 methods: 
-        # 1:send (if reliable)   -- to add unacknowledged reliable packets
-        # 2:_handle_reliable_ack -- to remove now-acknowledged reliable packets
-        # 3:_reliable_loop       -- to resend unacknowledged rel packets
-        self._reliable_out = []
-        self._reliable_out_lock = Lock()
-        self._reliable_out_seq = 0
-        # payload accumulates in _handle_chunk and _handle_chunk_tail
-        self._chunks = [] 
+        self._init_protocol_state()
         self._threads = { # these do nothing until they .start()
             # this sends packets from the outgoing queue
             "send" : Thread(target = self._sending_loop, name = "Core:send"),
             # this receives packets into the incoming queue
             "recv" : Thread(target = self._receiving_loop, name = "Core:recv"),
-            # this resends unacknowledged items from the reliable outgoing list
-            "rel" : Thread(target = self._reliable_loop, name = "Core:rel"),
-            # this sends a sync packet every SYNC_PERIOD seconds
-            "sync" : Thread(target = self._syncing_loop, name = "Core:sync"),
             }
+        # (resends and syncs are timers on the shared core.timer service)
+        self._socket = None
+        self._disconnecting = Event() # all threads poll this event to continue
+        self._connect(address, client_key, encryption)
+
+    def _init_protocol_state(self):
+        """
+        This sets up the state used by the core packet handlers.  It is apart
+        from __init__ so that other transports (see core.aio) can share the
+        handlers without the threads and the blocking socket.
+        """
+        # added to by _handle_reliable, removed from by _process_any_reliable
+        self._reliable_in = ReliableIn()
+        # seqs of received reliables still to acknowledge, see _queue_ack
+        self._acks = []
+        self._acks_since = None # when the oldest of those was received
+        # for outgoing reliable packets, reliable_out is locked by 3 methods: 
+        # 1:send (if reliable)   -- to add unacknowledged reliable packets
+        # 2:_handle_reliable_ack -- to remove now-acknowledged reliable packets
+        # 3:_check_reliable_resend -- to resend unacknowledged rel packets
+        # (it also guards _acks, which the receiving thread adds to and the
+        # sending thread empties, see _queue_ack and _take_acks)
+        self._reliable_out = ReliableOut()
+        self._reliable_out_lock = Lock()
+        # {name:timer} for the "rel" and "sync" timers, None once stopped
+        self._timers = {}
+        self._resend_due = None # when the "rel" timer is set to fire
+        # the measured round trip time sets how long we wait to resend
+        self.rtt = RTTEstimator()
+        # the server's clock, e.g. clock.to_remote(now()) is its time now
+        self.clock = ClockSync()
+        # payload accumulates in _handle_chunk and _handle_chunk_tail
+        self._chunks = ChunkBuffer()
+        # streams go out (and come in) with these, see core.chunk
+        self._streams_out = StreamSender(CHUNK_SIZE)
+        self._stream_in = StreamReceiver()
         self._sent_packet_count = 0
         self._received_packet_count = 0
-        self._socket = None
         # this is properly initialized during self._connect (after we receive
         # the server's encryption key).
         self._enc = None         
@@ -81,10 +106,12 @@ class Client(object):
             packet.Chunk._id        : self._handle_chunk,
             packet.ChunkTail._id    : self._handle_chunk_tail,
             packet.Cluster._id      : self._handle_cluster,
+            packet.StreamRequest._id : self._handle_stream_request,
+            packet.StreamCancelRequest._id : self._handle_stream_cancel_request,
+            packet.StreamCancelRequestACK._id :
+                                    self._handle_stream_cancel_request_ack,
             # packet.ConnectResponse is handled inside _connect
             }
-        self._disconnecting = Event() # all threads poll this event to continue
-        self._connect(address, client_key, encryption)
 
     def send(self, outgoing_packet, reliable = False):
         """ 
@@ -92,14 +119,127 @@ class Client(object):
         NOTE: packet is not raw data, it is a packet class having member .raw()
         """
         if reliable:
-            p = packet.Reliable(seq=self._reliable_out_seq)
-            p.tail = outgoing_packet.raw()
-            self._reliable_out_seq += 1
-            p._last_send_time = time()
-            with self._reliable_out_lock:
-                self._reliable_out.append(p)
-            outgoing_packet = p
+            outgoing_packet = self._track_reliable(outgoing_packet)
+            if outgoing_packet is None:
+                return # backlogged, an ACK will release it
         self._out.put(outgoing_packet)
+
+    def _send_nowait(self, outgoing_packet):
+        """
+        This queues the packet (unreliable, or a tracked Reliable) like send()
+        but never blocks, returning False if the outgoing queue is full.  The
+        timers send with it, since they all share one thread (see core.timer).
+        """
+        try:
+            self._out.put_nowait(outgoing_packet)
+        except Full:
+            return False
+        return True
+
+    def send_chunked(self, outgoing_packet):
+        """
+        This sends a large packet to the server in reliable chunks.
+        """
+        data = outgoing_packet.raw()
+        if len(data) < CHUNK_SIZE: # don't chunk it if we don't have to
+            self.send(outgoing_packet, reliable=True)
+            return
+        # the raw chunks go straight into the window (see packet.chunk_raws)
+        send_time = time()
+        with self._reliable_out_lock:
+            reliables = [self._reliable_out.add(raw, send_time,
+                                                self.rtt.timeout())
+                         for raw in packet.chunk_raws(data, CHUNK_SIZE)]
+            self._arm_resend()
+        for p in reliables:
+            if p is not None: # (backlogged, an ACK will release it)
+                self.send(p)
+
+    def send_stream(self, outgoing_packet, progress=None):
+        """
+        This streams a large packet to the server, as StreamRequest pieces
+        that keep to a share of the reliable window (see core.chunk).  It
+        returns the chunk.StreamOut for the transfer.
+        """
+        with self._reliable_out_lock:
+            transfer = self._streams_out.add(outgoing_packet.raw(), progress)
+            reliables = self._streams_out.pump(self._reliable_out, time(),
+                                               self.rtt.timeout())
+            self._arm_resend()
+        for p in reliables:
+            self.send(p)
+        return transfer
+
+    def cancel_stream(self, transfer=None):
+        """
+        This cancels the transfer (or every one) to the server.  If it had
+        begun, the server is told to discard it with a StreamCancelRequest.
+        """
+        with self._reliable_out_lock:
+            begun = self._streams_out.cancel(transfer)
+        if begun:
+            self.send(packet.StreamCancelRequest(), reliable=True)
+
+    def cancel_incoming_stream(self):
+        """
+        This cancels the stream the server is sending (e.g. a map download).
+        Its pieces still in flight are dropped, until the server's ACK.
+        """
+        self._stream_in.clear()
+        self._stream_in.cancelling = True
+        self.send(packet.StreamCancelRequest(), reliable=True)
+
+    def stream_progress(self):
+        """
+        This returns (received, total) bytes of the stream coming from the
+        server, or None if none is.
+        """
+        if self._stream_in.total is None:
+            return None
+        return (self._stream_in.received(), self._stream_in.total)
+
+    def _queue_ack(self, seq):
+        """
+        This holds the ReliableACK for seq for up to ACK_DELAY seconds, so
+        that ACKs for a burst of reliables go out together in a Cluster (with
+        whatever else is sent in the meantime).
+        """
+        with self._reliable_out_lock: # (the sending thread takes them)
+            if seq not in self._acks:
+                self._acks.append(seq)
+            first = self._acks_since is None
+            if first:
+                self._acks_since = time()
+        if first:
+            self._ack_ready()
+
+    def _ack_ready(self):
+        """ This wakes the sending loop to send the ACKs once they're due. """
+        self._out.put(None)
+
+    def _take_acks(self):
+        """ This empties the held ACKs, returning their raw ReliableACKs. """
+        with self._reliable_out_lock:
+            self._acks_since = None
+            acks, self._acks = self._acks, []
+        return [packet.ReliableACK(seq=seq).raw() for seq in acks]
+
+    def _cluster(self, raws):
+        """ This packs the raw packets into as few datagrams as it can. """
+        return [packet.cluster_raw(group)
+                for group in packet.cluster_groups(raws, MAX_PACKET_SIZE)]
+
+    def _track_reliable(self, outgoing_packet):
+        """
+        This wraps the packet as Reliable, and keeps it (in _reliable_out) for
+        resending until it is acknowledged.  It returns the Reliable packet,
+        or None if it must wait in the backlog for room in the window.
+        """
+        with self._reliable_out_lock:
+            p = self._reliable_out.add(outgoing_packet.raw(),
+                                       time(), self.rtt.timeout())
+            self._arm_resend()
+            return p
     
     def recv(self,timeout=None):
         """ 
@@ -120,6 +260,7 @@ class Client(object):
             self.send(packet.Disconnect())
             self._connected = False
         self._disconnecting.set() # this tells the threads to end
+        self._stop_timers()
         for name,thread in self._threads.iteritems():
             if thread.is_alive():
                 thread.join(1) # giving them all 2s may leave sync dawdling +3s
@@ -165,10 +306,30 @@ class Client(object):
     
     def _spawn_threads(self):
         """
-        This starts all threads.
+        This starts all threads, and the sync timer.
         """
         for name,thread in self._threads.iteritems():
             thread.start()
+        self._sync_timer()
+
+    def _call_later(self, delay, fn, *args):
+        """
+        This has the shared timer service invoke fn(*args) after delay
+        seconds.  It returns the timer, which can be cancel()'ed.
+        """
+        return timers.schedule(delay, fn, *args)
+
+    def _set_timer(self, name, delay, fn):
+        """ This sets the named timer, unless the timers were stopped. """
+        named_timers = self._timers # (_stop_timers may run meanwhile)
+        if named_timers is not None:
+            named_timers[name] = self._call_later(delay, fn)
+
+    def _stop_timers(self):
+        """ This cancels every timer, for good. """
+        stopped, self._timers = self._timers, None
+        for timer in (stopped or {}).values():
+            timer.cancel()
     
     def _encrypt_packet(self,packet_data):
         """
@@ -200,32 +361,43 @@ class Client(object):
     def _sending_loop(self):
         """ 
         This thread grabs packets from the outgoing queue, then encrypts and 
-        sends them.
+        sends them.  Held ACKs (see _queue_ack) are clustered in with the next
+        packet, or sent by themselves once they are due.
         
         The second condition on this loo ("or not self._out.empty()") makes
         this finished the outgoing queue before terminating.
         """
         while not self._disconnecting.is_set() or not self._out.empty():
+            if self._acks_since is None:
+                wait = 1
+            else:
+                wait = max(0.0, self._acks_since + ACK_DELAY - time())
             try:
-                p = self._out.get(True,1)
+                p = self._out.get(True,wait)
             except Empty:
-                continue
-            raw = p.raw()
-            if raw is None:
-                warn("unable to get raw, discarding")
+                p = None # the ACKs are due
+            else:
                 self._out.task_done()
-                continue
-            raw_encrypted_data = self._encrypt_packet(raw)
-            if raw_encrypted_data is None:
-                warn("unable to encrypt, discarding %s" % p)
-                self._out.task_done()
-                continue
-            try:
-                self._socket.sendall(raw_encrypted_data)
-                self._sent_packet_count += 1
-            except timeout:
-                warn("socket send failure")
-            self._out.task_done()
+            raws = []
+            if p is not None: # (else _ack_ready just woke us)
+                raw = p.raw()
+                if raw is None:
+                    warn("unable to get raw, discarding")
+                else:
+                    raws.append(raw)
+            if self._acks_since is not None and \
+                    (raws or time() >= self._acks_since + ACK_DELAY):
+                raws = self._take_acks() + raws
+            for raw in self._cluster(raws):
+                raw_encrypted_data = self._encrypt_packet(raw)
+                if raw_encrypted_data is None:
+                    warn("unable to encrypt, discarding %s" % p)
+                    continue
+                try:
+                    self._socket.sendall(raw_encrypted_data)
+                    self._sent_packet_count += 1
+                except timeout:
+                    warn("socket send failure")
     
     def _receiving_loop(self):
         """ This thread receives, decrypts, and then processes packets. """
@@ -238,34 +410,64 @@ class Client(object):
             self._received_packet_count += 1
             self._process_packet(decrypted_data)
 
-    def _syncing_loop(self):
+    def _sync_timer(self):
         """ 
-        This is the sync loop.
-        While connected, this sends one Sync every SYNC_PERIOD seconds.
+        This is the sync timer.
+        While connected, this sends one Sync every SYNC_PERIOD seconds.  (If
+        the outgoing queue is full, this one is skipped.)
         """
-        #sleep(0.01) # a little magic
-        while not self._disconnecting.is_set():
-            self.send(packet.Sync(sender_time=now(),
-                      packets_sent=self._sent_packet_count,
-                      packets_received=self._received_packet_count))
-            sleep(SYNC_PERIOD)
+        if not self._send_sync():
+            warn("outgoing queue full, skipping sync")
+        self._set_timer("sync", SYNC_PERIOD, self._sync_timer)
+
+    def _send_sync(self):
+        """
+        This sends the server a Sync with our time and packet counts.  Like
+        _send_nowait, it returns False if the outgoing queue was full.
+        """
+        return self._send_nowait(packet.Sync(sender_time=now(),
+                                 packets_sent=self._sent_packet_count,
+                                 packets_received=self._received_packet_count))
             
-    def _reliable_loop(self):
+    def _check_reliable_resend(self):
         """
-        This begins the reliable loop.
-        While connected, this resends any packet in reliable_out list that has 
-        gone unacknowledged for RELIABLE_TIMEOUT_RESEND seconds.
-        This must move quickly else it starves the 
+        This resends any packet in the reliable_out list that has gone
+        unacknowledged for its timeout (see reliable.RTTEstimator).  The
+        "rel" timer invokes it when the earliest one is due.
+        This must move quickly else it starves the other timers, so it never
+        blocks: the due packets are collected under the lock and queued after
+        it, and any that don't fit in the outgoing queue just wait for their
+        next timeout.
         """
-        while not self._disconnecting.is_set():
-            now = time()
-            with self._reliable_out_lock:
-                for p in self._reliable_out:
-                    if now - p._last_send_time > RELIABLE_TIMEOUT_RESEND:
-                        self.send(p)
-                        p._last_send_time = now
-            sleep(0.5)
+        now = time()
+        with self._reliable_out_lock:
+            self._resend_due = None # (the timer that called this is done)
+            due = self._reliable_out.expired(now)
+            for p in due:
+                self._reliable_out.resent(p, now,
+                                          self.rtt.timeout(p._resends + 1))
+            self._arm_resend()
+        for n, p in enumerate(due):
+            if not self._send_nowait(p):
+                warn("outgoing queue full, %d reliables wait to resend" %
+                     (len(due) - n))
+                break
 
+    def _arm_resend(self):
+        """
+        This makes sure that the "rel" timer will invoke _check_reliable_resend
+        when the earliest unacknowledged reliable is due.  It's only replaced
+        by an earlier one.  (The caller must hold _reliable_out_lock.)
+        """
+        due = self._reliable_out.next_due()
+        if due is None or self._timers is None or \
+                (self._resend_due is not None and self._resend_due <= due):
+            return
+        if self._resend_due is not None:
+            self._timers["rel"].cancel()
+        self._resend_due = due
+        self._set_timer("rel", max(0.0, due - time()),
+                        self._check_reliable_resend)
 
     def _process_packet(self,packet_data):
         """ This processes any core \x00 packets, and queues all others. """
@@ -284,27 +486,13 @@ class Client(object):
 
     def _process_any_reliables(self):
         """ 
-        This goes through the list of received reliable packets and processes
-        any that are now ready to be processed.  
-        
-        self._reliable_in is the list, it contains packet.Reliable items.
-        self._reliable_in_seq is the next id to be processed.
-        It is incremented as the packets are processed.
-        
-        The actual contents of each reliable packet is retrieved by calling the
-        instance member .tail() on the packet.
-
+        This processes, in order, the received reliable packets that are now
+        ready to be processed (see reliable.ReliableIn), acknowledging each.
         If nothing is ready for processing, this function does nothing.
-        Also, we might squeeze some performance with bisect instead of sort
         """
-        self._reliable_in.sort(key=lambda x: x.seq)
-        while len(self._reliable_in) > 0 and \
-                self._reliable_in[0].seq == self._reliable_in_seq:
-            p = self._reliable_in.pop(0)
+        for p in self._reliable_in.deliverable():
             self._process_packet(p.tail)
-            self.send(packet.ReliableACK(seq=self._reliable_in_seq))
-            self._reliable_in_seq += 1
-            
+            self._queue_ack(p.seq)
 
     def _handle_reliable(self,raw_data):
         """
@@ -313,28 +501,43 @@ class Client(object):
         packets that are newly ripe for processing.
         """
         p = packet.Reliable(raw_data)
-        if p.seq < self._reliable_in_seq: # we already got this, re-ACK
-            self.send(packet.ReliableACK(seq=self._reliable_in_seq))
-        else:
-            self._reliable_in.append(p)
+        if p.seq < self._reliable_in.next_seq: # we already got this, re-ACK
+            self._queue_ack(p.seq)
+        elif self._reliable_in.add(p):
             self._process_any_reliables()
+        else:
+            warn("incoming reliable too far ahead, dropping seq=%d (next=%d)" %
+                    (p.seq, self._reliable_in.next_seq))
         if len(self._reliable_in) > 30:
-            warn("outgoing reliable queue getting large seq=%d,size=%d" % \
-                  (self._reliable_in_next_id,len(self._reliable_in)))
+            warn("incoming reliable queue getting large seq=%d,size=%d" % \
+                  (self._reliable_in.next_seq,len(self._reliable_in)))
 
     def _handle_reliable_ack(self,raw_data):
         """
         This Handles incoming ACKs for reliable packets we earlier sent. This
         ensures we stop waiting for acknowledgements about packets that we now
         know have been received.  An ACK operates to acknowledge every seq <= 
-        that seq.
+        that seq.  The ACK's own Reliable, if it was sent just once, gives an
+        RTT sample.  The room it makes in the window releases any backlogged
+        reliables.
         """
         p = packet.ReliableACK(raw_data)
+        ack_time = time()
         with self._reliable_out_lock:
-            if p.seq < self._reliable_out_seq:
-                for out_p in self._reliable_out:
-                    if out_p.seq <= p.seq:
-                        self._reliable_out.remove(out_p)
+            acked = self._reliable_out.ack(p.seq)
+            if acked and acked[-1].seq == p.seq and acked[-1]._resends == 0:
+                self.rtt.sample(ack_time - acked[-1]._sent_time)
+            released = self._reliable_out.released(ack_time, self.rtt.timeout())
+            progressed = []
+            if len(self._streams_out):
+                progressed = self._streams_out.acked(p.seq)
+                released.extend(self._streams_out.pump(self._reliable_out,
+                                            ack_time, self.rtt.timeout()))
+            self._arm_resend()
+        for released_p in released:
+            self.send(released_p)
+        for transfer in progressed:
+            transfer.report()
                                            
     def _handle_sync(self,raw_packet):
         """ This receives the Sync packet and responds with a SyncResponse. """
@@ -344,9 +547,18 @@ class Client(object):
         self.send(sync_resp)
 
     def _handle_sync_response(self,raw_packet):
-        """ This receives SyncResponses to our earlier Sync requests. """
+        """
+        This receives SyncResponses to our earlier Sync requests.  The time
+        since the Sync that it repeats back is an RTT sample (if it isn't
+        from an old Sync), and a sample of the server's clock.
+        """
         p = packet.SyncResponse(raw_packet)
-        # TODO: store or do something to synchronize
+        received = now()
+        rtt = tick_diff(received, p.remote_time) / 100.0 # centiseconds
+        if 0 <= rtt < SYNC_PERIOD:
+            self.rtt.sample(rtt)
+            self.clock.sample_round_trip(p.remote_time, p.sender_time,
+                                         received)
 
     def _handle_disconnect(self,raw_packet):
         """ 
@@ -360,11 +572,12 @@ class Client(object):
         self._in.put(None)
         warn("disconnected from server") 
         self._disconnecting.set()
+        self._stop_timers()
 
     def _handle_chunk(self,raw_packet):
         """ This handles accumulating chunks. """
-        p = packet.Chunk(raw_packet)
-        self._chunks.append(p.tail)
+        if not self._chunks.add(raw_packet, 2): # (past \x00\x08)
+            warn("chunked packet from server overflowed, discarding it")
 
     def _handle_chunk_tail(self,raw_packet):
         """ 
@@ -372,22 +585,36 @@ class Client(object):
         the content as a single packet.
         """ 
         
-        p = packet.ChunkTail(raw_packet)
-        self._chunks.append(p.tail)
-        all_chunks = ''.join(self._chunks)
-        #debug("got tail total length: %d" % len(all_chunks))
-        self._process_packet(all_chunks)
-        self._chunks = []
+        self._handle_chunk(raw_packet) # (\x00\x09 is as long as \x00\x08)
+        if len(self._chunks):
+            self._process_packet(self._chunks.take())
     
-    def _handle_cluster(self,raw_packet):
+    def _handle_stream_request(self, raw_packet):
+        """
+        This adds a piece of the server's stream, and processes the whole
+        once it's in.  A stream over chunk.MAX_STREAM_SIZE is discarded.
+        """
+        whole = self._stream_in.add(raw_packet)
+        if whole is False:
+            warn("stream from server overflowed, discarding it")
+        elif whole:
+            self._process_packet(whole)
+
+    def _handle_stream_cancel_request(self, raw_packet):
+        """ This cancels the streams either way, and acknowledges it. """
+        with self._reliable_out_lock:
+            self._streams_out.cancel()
+        self._stream_in.clear()
+        self.send(packet.StreamCancelRequestACK(), reliable=True)
+
+    def _handle_stream_cancel_request_ack(self, raw_packet):
+        """ This ends the dropping of stale pieces after a cancel. """
+        self._stream_in.cancelling = False
+
+    def _handle_cluster(self, raw_packet):
         """ This takes a cluster and processes the packets inside. """
-        p = packet.Cluster(raw_packet)
-        d = p.tail
-        while len(d) > 0:
-            size = ord(d[0])
-            if len(d) > size:
-                self._process_packet(d[1:size+1]) 
-            d = d[size+1:]
+        for raw in packet.cluster_parts(raw_packet, 2): # (past \x00\x0E)
+            self._process_packet(raw)
 
 def main():
     import logging
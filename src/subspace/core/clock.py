@@ -0,0 +1,160 @@
+"""
+This estimates how the clock at the other end of a connection relates to
+ours, from the Sync exchanges (see packet.Sync).
+
+Times are ticks (hundredths of a second, see util.now) in 32 bits, so they
+wrap.  Each end's clock starts wherever it likes and runs at its own rate, so
+a time in a client's packet (e.g. a position's) says little to the server
+until the two are reconciled.  A ClockSync keeps the offset (remote - local)
+measured by each of the latest Syncs:
+    * a SyncResponse to our Sync is a round trip, the remote time in it was
+      read (we assume) halfway between our sending and our receiving, and
+    * a Sync from the other end is one way, its time was read about half an
+      RTT (as measured so far) before we received it.
+The offset is the median of those samples, so one delayed Sync doesn't move
+it.  No two clocks run at quite the same rate, so the offset drifts too, but
+only by a tick or so a minute.  That is too little to see in one window of
+samples, so every window's median offset is kept (for DRIFT_HISTORY windows)
+and the drift is the median of the slopes between those:
+
+>>> clock = ClockSync()
+>>> clock.sample(1000, 51000, delay=3) # a Sync's sender_time, at our 1000
+>>> clock.offset
+50003.0
+>>> clock.to_local(51100) # e.g. a position's time, as our time
+1097
+"""
+CLOCK_WINDOW = 15 # the latest samples that the offset is the median of
+DRIFT_HISTORY = 8 # windows' median offsets that the drift is estimated from
+DRIFT_MIN_SPAN = 12000 # ticks those must span before drift is estimated
+
+def tick_diff(a, b):
+    """ This returns a - b, for tick times that may have wrapped past 2**32. """
+    return (a - b + 0x80000000) % 0x100000000 - 0x80000000
+
+def _median(values):
+    """ This returns the median of the values (a non-empty list). """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class ClockSync(object):
+    """
+    This estimates a remote clock from samples of it (see the module doc).
+    Until the first sample, offset is None and times can't be translated.
+        offset -- remote - local, in ticks, as of local time stamp
+        drift  -- ticks the offset gains per local tick (e.g. 1e-5 is 10ppm)
+    The samples are kept in short lists (a deque would be ~600 bytes each,
+    for every connection).
+    """
+    __slots__ = ("_window", "_samples", "_history", "offset", "drift",
+                 "stamp", "samples")
+
+    def __init__(self, window=CLOCK_WINDOW):
+        self._window = window
+        self._samples = [] # the latest (local time, offset) samples
+        self._history = [] # the latest (stamp, offset) medians
+        self.offset = None # (until the first sample)
+        self.drift = 0.0
+        self.stamp = None
+        self.samples = 0
+
+    def __str__(self):
+        if self.offset is None:
+            return "ClockSync(unmeasured)"
+        return "ClockSync(offset=%.1f, drift=%.2gppm, samples=%d)" % \
+                (self.offset, self.drift * 1e6, self.samples)
+
+    def sample(self, local_time, remote_time, delay=0):
+        """
+        This adds a sample: the remote clock read remote_time delay ticks
+        before our clock read local_time (e.g. a Sync's sender_time, with
+        half the RTT for its delay).
+        """
+        self._samples.append((local_time, tick_diff(remote_time,
+                                                    local_time - delay)))
+        if len(self._samples) > self._window:
+            del self._samples[0]
+        self.samples += 1
+        self._estimate()
+        if self.samples % self._window == 0:
+            self._history.append((self.stamp, self.offset))
+            if len(self._history) > DRIFT_HISTORY:
+                del self._history[0]
+            self.drift = self._estimate_drift()
+
+    def estimate(self):
+        """
+        This returns (offset, drift, stamp, samples), e.g. to hand the estimate
+        to another process (see set_estimate).
+        """
+        return self.offset, self.drift, self.stamp, self.samples
+
+    def set_estimate(self, estimate):
+        """
+        This takes on an estimate() from elsewhere (e.g. a shard worker's
+        ClockSync) in place of its own.
+        """
+        self.offset, self.drift, self.stamp, self.samples = estimate
+
+    def sample_round_trip(self, sent, remote_time, received):
+        """
+        This adds the sample from a SyncResponse: our Sync went at sent, the
+        remote clock read remote_time, and the response came at received.
+        """
+        rtt = tick_diff(received, sent)
+        if rtt >= 0:
+            self.sample(received, remote_time, rtt / 2.0)
+
+    def offset_at(self, local_time):
+        """ This returns the estimated offset at local_time. """
+        return self.offset + self.drift * tick_diff(local_time, self.stamp)
+
+    def to_local(self, remote_time):
+        """
+        This returns remote_time as a time on our clock (or None until the
+        first sample).
+        """
+        if self.offset is None:
+            return None
+        # (to within a fraction of a tick, drift is the same either side)
+        guess = remote_time - self.offset
+        return int(round(remote_time - self.offset_at(guess))) % 0x100000000
+
+    def to_remote(self, local_time):
+        """
+        This returns local_time as a time on the remote clock (or None until
+        the first sample).
+        """
+        if self.offset is None:
+            return None
+        return int(round(local_time + self.offset_at(local_time))) % 0x100000000
+
+    def _estimate(self):
+        """
+        This updates the offset from the samples, each carried forward (by
+        the drift) to the latest.  They're taken relative to the latest, so
+        that ticks wrapping doesn't matter.
+        """
+        latest_time, latest_offset = self._samples[-1]
+        offset = _median([tick_diff(o, latest_offset)
+                            - self.drift * tick_diff(t, latest_time)
+                            for t, o in self._samples])
+        self.offset = tick_diff(latest_offset + offset, 0)
+        self.stamp = latest_time
+
+    def _estimate_drift(self):
+        """
+        This returns the median slope between the windows' median offsets
+        (or no drift, if they don't yet span DRIFT_MIN_SPAN ticks).
+        """
+        latest_time, latest_offset = self._history[-1]
+        points = [(tick_diff(t, latest_time), tick_diff(o, latest_offset))
+                    for t, o in self._history]
+        if -points[0][0] < DRIFT_MIN_SPAN:
+            return 0.0
+        return _median([(o2 - o1) / float(t2 - t1)
+                        for n, (t1, o1) in enumerate(points)
+                        for t2, o2 in points[n + 1:] if t2 != t1])
@@ -1,63 +1,281 @@
 from array import array
+from struct import Struct
+from collections import OrderedDict
+from threading import Thread, Lock
+from Queue import Queue, Empty
+from random import randint
+try:
+    import numpy
+except ImportError:
+    numpy = None # without numpy, VIE falls back to the pure python loops
+
+# packets with fewer 32-bit words than this (i.e. under 96 bytes, positions
+# and weapons) go through the python loops, numpy's per-call setup makes it
+# no faster (or slower) until about there, see benchmark()
+NUMPY_MIN_WORDS = 24
+KEY_TABLE_CACHE_SIZE = 1024 # the number of server_key tables kept (LRU)
+KEY_TABLE_POOL_SIZE = 64 # fresh server keys to keep with their tables built
+
+# we're simulating c32 integer truncation, so we inspect type sizes
+_size4 = [t for t in "lih" if array(t).itemsize == 4][0]
+
+# VIE tables are 130 words long, so no packet ever needs more than this many.
+# _words[n] (un)packs n native 32-bit ints in one call, for the python loops.
+_words = [Struct("=%di" % n) for n in range(131)]
+
+def generate_table(server_key):
+    """
+    This runs the 260 rounds that turn server_key into a VIE key table.  It is
+    slow (by packet handling standards) so use key_tables instead of calling
+    this directly.
+    """
+    r = array("B")
+    k = server_key
+    for i in range(260):
+        t = (k * 0x834E0B5F) >> 48
+        t += t >> 31
+        q = 127773
+        if k < 0: q *= -1
+        k = ((k % q) * 16807) - (t * 2836) + 123
+        if (k == 0) or (k & 0x80000000 != 0):
+            k += 0x7FFFFFFF
+        r.fromstring(chr(k & 0xff)+chr((k >> 8) & 0xff))
+    r.byteswap()
+    return array(_size4,r.tostring())
+
+def random_key():
+    """ This returns a random (nonzero) signed 32-bit server key. """
+    key = 0
+    while key == 0:
+        key = randint(-(2**31),(2**31)-1)
+    return key
 
 class VIE:
     """
     Basic VIE encryption.
-    
-    I started to clean this up a bit, but then quickly gave up. It is twice- 
+
+    I started to clean this up a bit, but then quickly gave up. It is twice-
     translated encryption, it's supposed to be ugly and so it remains.  That
     said, it should work on all python installs now.
-    
-    There is lots of room here for performance tweaks.
-    
-    I wrote these with frequent reference to 
+
+    The cipher is chained word to word, but the chain is only an XOR:
+        encrypt:  w[i] = d[i] ^ t[i] ^ w[i-1]      (w[-1] = key)
+        decrypt:  r[i] = d[i] ^ t[i] ^ d[i-1]      (d[-1] = key)
+    So encrypt is a running (prefix) XOR of d ^ t, and decrypt needs nothing
+    but the input shifted by one word.  Small packets (most of them) go
+    through python loops that unpack all their words with one struct call
+    and pack the result with another, rather than building an array a word
+    at a time as the original loops did.  That is 1.2-1.4x faster from 20
+    bytes up, the smallest packets (6 bytes) gain nothing since the call is
+    most of their cost (see benchmark()).  Larger packets are done as
+    whole-array numpy operations when numpy is around, otherwise in those
+    same loops.
+
+    I wrote these with frequent reference to
       grel  - asss -- src/core/enc_vie.c
       cycad - http://forums.minegoboom.com/viewtopic.php?p=81456
     """
     version = 0x0001 # this is the identifier for this encryption scheme
-    def __init__(self, client_key, server_key):
-        """ Prepares the encryption table. """
+    def __init__(self, client_key, server_key, table=None):
+        """
+        Prepares the encryption table.  If the table was already built (e.g.
+        by key_tables.fresh()) it can be passed in, otherwise it is fetched
+        from (or generated into) the shared key_tables cache.
+        """
         if client_key == server_key:
             self.encrypt = self.decrypt = lambda x: x
             return
-        # we're simulating c32 integer truncation, so we inspect type sizes
-        self._size2 = [t for t in "lih" if array(t).itemsize == 2][0]
-        self._size4 = [t for t in "lih" if array(t).itemsize == 4][0]
-        r = array("B")
-        self._key = k = server_key
-        for i in range(260):
-            t = (k * 0x834E0B5F) >> 48
-            t += t >> 31
-            q = 127773
-            if k < 0: q *= -1
-            k = ((k % q) * 16807) - (t * 2836) + 123
-            if (k == 0) or (k & 0x80000000 != 0):
-                k += 0x7FFFFFFF
-            r.fromstring(chr(k & 0xff)+chr((k >> 8) & 0xff))
-        r.byteswap()
-        self._table = array(self._size4,r.tostring())
+        self._size4 = _size4
+        self._key = server_key
+        if table is None:
+            table = key_tables.get(server_key)
+        self._table = table # (its words are iterated by the python loops)
+        if numpy is not None:
+            # a view of the table (a copy would be another 0.5K per VIE)
+            self._np_table = numpy.frombuffer(self._table, dtype=numpy.uint32)
+            self._np_key = numpy.uint32(self._key & 0xFFFFFFFF)
+            # the table with the key xor'd into its first word (encrypt_many)
+            keyed = self._np_table.copy()
+            keyed[0] ^= self._np_key
+            self._keyed_table = keyed.tostring()
 
     def encrypt(self, data):
         """ Returns data encrypted. """
         l = len(data)
-        data += '\x00' * (4 - (l % 4)) # 4-byte align
-        result = array(self._size4)
+        pad = -l % 4
+        if pad:
+            data += '\x00' * pad # 4-byte align
+        words = (l + pad) >> 2
+        if words >= NUMPY_MIN_WORDS:
+            words = min(words, len(self._table))
+            if numpy is not None:
+                d = numpy.frombuffer(data, dtype=numpy.uint32, count=words)
+                result = numpy.bitwise_xor.accumulate(
+                                        d ^ self._np_table[:words])
+                result ^= self._np_key
+                return result.tostring()[:l]
+        packer = _words[words]
         w = self._key
-        for d,t in zip(array(self._size4,data),self._table):
-            w = d ^ (t ^ w)
-            result.append(w)
-        return result.tostring()[:l]
-    
+        result = []
+        append = result.append
+        for d,t in zip(packer.unpack_from(data), self._table):
+            w ^= d ^ t
+            append(w)
+        if pad:
+            return packer.pack(*result)[:l]
+        return packer.pack(*result)
+
     def decrypt(self, data):
         """ Returns data decrypted. """
         l = len(data)
-        data += '\x00' * (4 - (l % 4)) # 4-byte align
-        result = array(self._size4)
+        pad = -l % 4
+        if pad:
+            data += '\x00' * pad # 4-byte align
+        words = (l + pad) >> 2
+        if words >= NUMPY_MIN_WORDS:
+            words = min(words, len(self._table))
+            if numpy is not None:
+                d = numpy.frombuffer(data, dtype=numpy.uint32, count=words)
+                result = d ^ self._np_table[:words]
+                result[0] ^= self._np_key
+                result[1:] ^= d[:-1]
+                return result.tostring()[:l]
+        packer = _words[words]
         w = self._key
-        for d,t in zip(array(self._size4,data),self._table):
-            result.append(t ^ w ^ d)
+        result = []
+        append = result.append
+        for d,t in zip(packer.unpack_from(data), self._table):
+            append(d ^ t ^ w)
             w = d
-        return result.tostring()[:l]
+        if pad:
+            return packer.pack(*result)[:l]
+        return packer.pack(*result)
+
+class VIEKeyTables:
+    """
+    This is the key table subsystem shared by every VIE in the process.
+
+    It has two parts:
+        1. an LRU cache of tables keyed by server_key (see get()), and
+        2. a pool of fresh random server keys whose tables were already built
+           by a background thread (see fresh()).
+    A server handling a Connect takes from the pool, so the 260-round table
+    generation never runs on its receiving thread.  Only when the pool runs
+    dry (e.g. hundreds of clients reconnecting at once) is a table generated
+    inline, and the background thread immediately starts refilling.
+    """
+
+    def __init__(self, cache_size=KEY_TABLE_CACHE_SIZE,
+                       pool_size=KEY_TABLE_POOL_SIZE):
+        self._cache = OrderedDict() # {server_key:table}, oldest first
+        self._cache_size = cache_size
+        self._lock = Lock()
+        self._pool = Queue(pool_size) # contains (server_key, table) tuples
+        self._filler = None # started by start()
+        # these are just for inspecting how well the cache/pool are working
+        self.hits = 0
+        self.misses = 0
+        self.pool_misses = 0
+
+    def __str__(self):
+        return "VIEKeyTables(cached=%d, pooled=%d, hits=%d, misses=%d, " \
+               "pool_misses=%d)" % (len(self._cache), self._pool.qsize(),
+                                    self.hits, self.misses, self.pool_misses)
+
+    def start(self):
+        """ This starts the (daemon) thread that keeps the pool filled. """
+        with self._lock:
+            if self._filler is None:
+                self._filler = Thread(target=self._filling_loop,
+                                      name="Core:VIE:pool")
+                self._filler.daemon = True
+                self._filler.start()
+
+    def get(self, server_key):
+        """ This returns the table for server_key, generating it if needed. """
+        with self._lock:
+            table = self._cache.pop(server_key, None)
+            if table is not None:
+                self._cache[server_key] = table # now the most recently used
+                self.hits += 1
+                return table
+            self.misses += 1
+        table = generate_table(server_key) # not under the lock, it's slow
+        self._store(server_key, table)
+        return table
+
+    def fresh(self, exclude=None):
+        """
+        This returns a (server_key, table) tuple for a new random server key.
+        The server key never equals exclude (a client key equal to the server
+        key would disable encryption, see VIE.__init__).
+        """
+        self.start()
+        while True:
+            try:
+                server_key, table = self._pool.get(False)
+            except Empty:
+                self.pool_misses += 1
+                server_key = random_key()
+                table = generate_table(server_key)
+            if server_key != exclude:
+                break
+        self._store(server_key, table)
+        return server_key, table
+
+    def _store(self, server_key, table):
+        """ This adds the table to the cache, evicting the oldest if full. """
+        with self._lock:
+            self._cache.pop(server_key, None)
+            self._cache[server_key] = table
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _filling_loop(self):
+        """ This keeps the pool full, it blocks (idle) while the pool is. """
+        while True:
+            server_key = random_key()
+            self._pool.put((server_key, generate_table(server_key)))
+
+# this is the shared instance used by VIE (and handed out to servers)
+key_tables = VIEKeyTables()
+
+def encrypt_many(ciphers, datas):
+    """
+    This returns a list with datas[i] encrypted by ciphers[i], for each i.
+
+    VIE is chained along the words of one packet but independent between
+    packets, so with numpy this stacks all of them into one 2-D array (packets
+    by words) against their stacked key tables and encrypts them in a single
+    pass.  Shorter packets are zero padded and cut back to length afterwards.
+    This is how the core server encrypts each flush of its outgoing queues.
+    """
+    result = list(datas)
+    # identity ciphers (client_key == server_key) have no table to apply
+    rows = [i for i, c in enumerate(ciphers) if hasattr(c, "_table")]
+    if numpy is None or len(rows) < 4 or sum(len(datas[i]) for i in rows) \
+                                            < NUMPY_MIN_WORDS * 4:
+        for i in rows:
+            result[i] = ciphers[i].encrypt(datas[i])
+        return result
+    width = (max(len(datas[i]) for i in rows) + 3) // 4 # in words
+    width = min(width, len(_words) - 1) # tables are only so long
+    size = width * 4
+    if datas.count(datas[rows[0]]) == len(datas): # (the usual send_to_many)
+        d = numpy.frombuffer((datas[rows[0]] + '\x00' * size)[:size],
+                             dtype=numpy.uint32)
+    else:
+        d = numpy.frombuffer(''.join((datas[i] + '\x00' * size)[:size]
+                                     for i in rows), dtype=numpy.uint32)
+        d = d.reshape(len(rows), width)
+    # each cipher's key is already folded into the first word of its table
+    t = numpy.frombuffer(''.join(ciphers[i]._keyed_table[:size]
+                                 for i in rows), dtype=numpy.uint32)
+    encrypted = numpy.bitwise_xor.accumulate(d ^ t.reshape(len(rows), width),
+                                             axis=1).tostring()
+    for n, i in enumerate(rows):
+        result[i] = encrypted[n * size:n * size + min(size, len(datas[i]))]
+    return result
 
 def main():
     """
@@ -69,8 +287,8 @@ def main():
         decrypt took 0.000954 ms
 
     If looking for speed, this may be a good place to squeeze.
+    (see benchmark() below for the current numbers)
     """
-    from random import randint
     from time import time
     count = 10000
     key = randint(-(2**31),(2**31)-1)
@@ -85,12 +303,102 @@ def main():
     print "encrypt (%d count) took %0.6f ms" % (count,(t2-t1)*1000.0)
     print "encrypted:\t" + ' '.join([x.encode("hex") for x in encrypted])
     t1 = time()
-    for round in xrange(count): 
+    for round in xrange(count):
         decrypted = e.decrypt(encrypted)
     t2 = time()
     print "decrypt (%d count) took %0.6f ms" % (count,(t2-t1)*1000.0)
     print "decrypted:\t" + ' '.join([x.encode("hex") for x in decrypted])
     assert decrypted == input
 
+def _reference_encrypt(e, data):
+    """ The original word-at-a-time encrypt, kept to check the faster one. """
+    l = len(data)
+    data += '\x00' * (4 - (l % 4)) # 4-byte align
+    result = array(e._size4)
+    w = e._key
+    for d,t in zip(array(e._size4,data),e._table):
+        w = d ^ (t ^ w)
+        result.append(w)
+    return result.tostring()[:l]
+
+def _reference_decrypt(e, data):
+    """ The original word-at-a-time decrypt, kept to check the faster one. """
+    l = len(data)
+    data += '\x00' * (4 - (l % 4)) # 4-byte align
+    result = array(e._size4)
+    w = e._key
+    for d,t in zip(array(e._size4,data),e._table):
+        result.append(t ^ w ^ d)
+        w = d
+    return result.tostring()[:l]
+
+def benchmark(count=10000, repeats=5):
+    """
+    This times the original loops against the current encrypt/decrypt over a
+    range of packet sizes: position packets (~20 bytes) up through full
+    chunks (~490 bytes).  It also checks that both produce identical output.
+    Each timing is the best of repeats runs, the smallest sizes differ by
+    less than the noise of any one run.
+    """
+    from os import urandom
+    from time import time
+    key = random_key()
+    e = VIE(0x12345678, key)
+    print "key = %d, numpy = %s" % (key,
+                    numpy.__version__ if numpy is not None else "unavailable")
+    print "%6s %14s %14s %8s %14s %14s %8s" % ("bytes",
+            "old enc (ms)", "new enc (ms)", "speedup",
+            "old dec (ms)", "new dec (ms)", "speedup")
+    for size in (6, 20, 37, 64, 92, 96, 128, 255, 490, 520):
+        input = urandom(size)
+        encrypted = e.encrypt(input)
+        assert encrypted == _reference_encrypt(e, input)
+        assert e.decrypt(encrypted) == _reference_decrypt(e, encrypted)
+        assert e.decrypt(encrypted) == input
+        timings = []
+        for fn, data in ((_reference_encrypt, input),
+                         (VIE.encrypt, input),
+                         (_reference_decrypt, encrypted),
+                         (VIE.decrypt, encrypted)):
+            best = None
+            for repeat in xrange(repeats):
+                t1 = time()
+                for round in xrange(count):
+                    fn(e, data)
+                t2 = time()
+                best = t2 - t1 if best is None else min(best, t2 - t1)
+            timings.append(best*1000.0/count)
+        print "%6d %14.6f %14.6f %7.1fx %14.6f %14.6f %7.1fx" % (size,
+                timings[0], timings[1], timings[0]/timings[1],
+                timings[2], timings[3], timings[2]/timings[3])
+
+def benchmark_many(count=1000):
+    """
+    This times encrypting one position-sized packet for many recipients, one
+    VIE.encrypt at a time versus a single encrypt_many.
+    """
+    from os import urandom
+    from time import time
+    print "%10s %6s %14s %14s %8s" % ("recipients", "bytes",
+            "loop (ms)", "many (ms)", "speedup")
+    for recipients in (2, 10, 50, 255):
+        ciphers = [VIE(0x12345678, random_key()) for r in range(recipients)]
+        for size in (20, 37, 255):
+            datas = [urandom(size)] * recipients
+            assert encrypt_many(ciphers, datas) == \
+                        [c.encrypt(d) for c, d in zip(ciphers, datas)]
+            t1 = time()
+            for round in xrange(count):
+                [c.encrypt(d) for c, d in zip(ciphers, datas)]
+            t2 = time()
+            for round in xrange(count):
+                encrypt_many(ciphers, datas)
+            t3 = time()
+            print "%10d %6d %14.6f %14.6f %7.1fx" % (recipients, size,
+                    (t2-t1)*1000.0/count, (t3-t2)*1000.0/count,
+                    (t2-t1)/(t3-t2))
+
 if __name__ == '__main__':
     main()
+    benchmark()
+    benchmark_many()
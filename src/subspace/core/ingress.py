@@ -0,0 +1,133 @@
+"""
+This queues the packets a core server receives, per connection, for recv().
+
+All connections used to share one Queue of QUEUE_SIZE_IN packets, and the
+receiving thread blocked putting into it.  So whenever the consumer (e.g. a
+Zone's handler thread) fell behind, the socket went unread, the kernel's
+buffer overflowed, and every client lost packets together.  And one client
+flooding it could fill the whole queue by itself.
+
+A FairQueue instead keeps each connection's packets in a deque of its own
+(of at most cap), and never blocks: a connection with a full deque has its
+packets dropped, by its drop policy, and nobody else's.  The consumer takes
+one packet from each connection in turn, so a flood from one client doesn't
+delay the others' packets either:
+
+>>> ingress = FairQueue(cap=2)
+>>> for n in range(3):
+...     ingress.put(("10.0.0.1", 1234), "flood")
+True
+True
+False
+>>> ingress.put(("10.0.0.2", 1234), "hi")
+True
+>>> ingress.pop(), ingress.pop()
+((('10.0.0.1', 1234), 'flood'), (('10.0.0.2', 1234), 'hi'))
+"""
+from threading import Condition, Lock
+from Queue import Empty
+from collections import deque
+from time import time
+
+INGRESS_CAP = 128 # packets queued per connection before they're dropped
+DROP_NEWEST = "newest" # a full connection's arriving packet is dropped
+DROP_OLDEST = "oldest" # a full connection's oldest queued packet is dropped
+
+class FairQueue:
+    """
+    This holds packets in a deque per address, and pop() takes one from
+    each address in turn.  put() never blocks: if the address already has
+    cap packets queued, one is dropped by drop (DROP_NEWEST or DROP_OLDEST).
+    A None (i.e. the address disconnected) is never dropped.  It is
+    threadsafe, and get() waits for a packet as Queue.get does.
+    """
+
+    def __init__(self, cap=INGRESS_CAP, drop=DROP_NEWEST):
+        if drop not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError("unknown drop policy %r" % (drop,))
+        self._cap = cap
+        self._drop = drop
+        self._queues = {} # {address:deque of its packets}, none empty
+        self._turns = deque() # the addresses in _queues, in turn order
+        self._size = 0 # packets in all the deques
+        self._ready = Condition(Lock()) # notified as packets are put
+        # these are just for inspecting ingress
+        self.queued = 0 # packets put (and not dropped on arrival)
+        self.dropped = 0 # packets dropped from full deques
+        self.peak = 0 # the most packets one address has had queued
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return "FairQueue(%s)" % ', '.join(["%s=%s" % item
+                                            for item in self.stats()])
+
+    def stats(self):
+        """ This returns a list of (name, value) tuples about ingress. """
+        return [("queued", self.queued), ("dropped", self.dropped),
+                ("peak", self.peak), ("waiting", self._size),
+                ("addresses", len(self._queues))]
+
+    def put(self, address, packet_data):
+        """
+        This queues packet_data from address.  It returns False if a packet
+        (this one, or the oldest queued) was dropped to keep within cap.
+        """
+        with self._ready:
+            queue = self._queues.get(address)
+            if queue is None:
+                queue = self._queues[address] = deque()
+                self._turns.append(address)
+            kept = True
+            if len(queue) >= self._cap and packet_data is not None:
+                self.dropped += 1
+                kept = False
+                if self._drop == DROP_NEWEST or queue[0] is None:
+                    return False
+                queue.popleft()
+                self._size -= 1
+            queue.append(packet_data)
+            self._size += 1
+            self.queued += 1
+            self.peak = max(self.peak, len(queue))
+            self._ready.notify()
+        return kept
+
+    def get(self, timeout=None):
+        """
+        This is pop(), but it waits for a packet: for up to timeout seconds
+        (then it raises Queue.Empty) or, by default, for as long as it takes.
+        """
+        with self._ready:
+            if not self._size:
+                deadline = None if timeout is None else time() + timeout
+            while not self._size:
+                if deadline is None:
+                    self._ready.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._ready.wait(remaining)
+            return self._pop()
+
+    def pop(self):
+        """
+        This returns the next (address, packet_data), taking turns between
+        the addresses.  It raises IndexError if nothing is queued.
+        """
+        with self._ready:
+            return self._pop()
+
+    def _pop(self):
+        """ This is pop(), for a caller holding the lock. """
+        address = self._turns.popleft()
+        queue = self._queues[address]
+        packet_data = queue.popleft()
+        self._size -= 1
+        if queue:
+            self._turns.append(address) # (to the back of the line)
+        else:
+            del self._queues[address]
+        return address, packet_data
@@ -0,0 +1,314 @@
+"""
+This provides batched datagram I/O for the core server's UDP socket.
+
+On Linux, recvmmsg() and sendmmsg() move many datagrams per system call.  The
+python 2 socket module doesn't expose them, so MMsgIO calls them from libc via
+ctypes, moving up to BATCH_SIZE datagrams per call.  Everywhere else (or if
+libc doesn't have them) PlainIO does the same job one recvfrom()/sendto() at a
+time.  Both have the same two methods:
+
+>>> from socket import socket, SOCK_DGRAM
+>>> sock = socket(AF_INET, SOCK_DGRAM)
+>>> sock.bind(("127.0.0.1", 0))
+>>> sock.setblocking(False) # (it must be non-blocking AF_INET)
+>>> io = datagram_io(sock, batched=True)
+>>> io.send_many([("hi", sock.getsockname()), ("there", sock.getsockname())])
+2
+>>> [raw_packet for raw_packet, address in io.recv_many()]
+['hi', 'there']
+
+Run this module to compare packets per second of the two.
+"""
+from socket import inet_aton, inet_ntoa, htons, ntohs, AF_INET
+from socket import error as socket_error
+from errno import EAGAIN, EWOULDBLOCK, EINTR
+from logging import warn
+from struct import Struct, calcsize
+from itertools import chain
+import ctypes
+import ctypes.util
+import sys
+
+BATCH_SIZE = 64 # the most datagrams moved by one recvmmsg/sendmmsg
+MAX_DATAGRAM_SIZE = 512 # we grab up to this many bytes per datagram
+ADDRESS_CACHE_SIZE = 4096 # sockaddr's kept for sending (see MMsgIO)
+MSG_DONTWAIT = 0x40
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_ushort),    # network byte order
+                ("sin_addr", ctypes.c_ubyte * 4), # network byte order
+                ("sin_zero", ctypes.c_char * 8)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint),
+                ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+def _load_libc():
+    """ This returns libc if it has recvmmsg/sendmmsg, otherwise None. """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                                  ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                                  ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+# native layouts of struct iovec and struct mmsghdr, for packing them quickly
+_SIZE_T = "Q" if ctypes.sizeof(ctypes.c_size_t) == 8 else "I"
+_IOVEC = "P" + _SIZE_T
+_MMSGHDR = "PIP%sP%si0PI0P" % (_SIZE_T, _SIZE_T)
+_IOVEC_SIZE = ctypes.sizeof(_iovec)
+_MMSGHDR_SIZE = ctypes.sizeof(_mmsghdr)
+_SOCKADDR_IN_SIZE = ctypes.sizeof(_sockaddr_in)
+_packers = {} # {(layout, count):Struct}
+_port = Struct("=H") # sin_family and sin_port are both unsigned shorts
+_flatten = chain.from_iterable
+
+def _packer(layout, count):
+    """ This returns the (cached) Struct for count of layout back to back. """
+    packer = _packers.get((layout, count))
+    if packer is None:
+        packer = _packers[(layout, count)] = Struct("@" + layout * count)
+    return packer
+
+_libc = _load_libc()
+if calcsize("@" + _IOVEC) != _IOVEC_SIZE or \
+        calcsize("@" + _MMSGHDR) != _MMSGHDR_SIZE:
+    _libc = None # an ABI we don't know how to pack for, so don't try
+
+def mmsg_available():
+    """ This says whether MMsgIO can be used on this platform. """
+    return _libc is not None
+
+def datagram_io(sock, batched=True):
+    """
+    This returns the I/O object for sock: MMsgIO if batched I/O was asked for
+    and the platform has it, otherwise PlainIO.
+    """
+    if batched and mmsg_available() and sock.family == AF_INET:
+        return MMsgIO(sock)
+    return PlainIO(sock)
+
+class PlainIO:
+    """ This is one recvfrom() or sendto() per datagram. """
+
+    def __init__(self, sock, max_datagram_size=MAX_DATAGRAM_SIZE):
+        self._socket = sock
+        self._max_datagram_size = max_datagram_size
+
+    def recv_many(self):
+        """ This returns a list of up to BATCH_SIZE (data, address) tuples. """
+        datagrams = []
+        for n in xrange(BATCH_SIZE):
+            try:
+                datagrams.append(
+                        self._socket.recvfrom(self._max_datagram_size))
+            except socket_error as err:
+                if err.args[0] not in (EAGAIN, EWOULDBLOCK, EINTR):
+                    warn("socket receive failure: %s" % err)
+                break
+        return datagrams
+
+    def send_many(self, datagrams):
+        """
+        This sends the (data, address) tuples in order.  It returns how many
+        were sent (or discarded on error), stopping early only if the socket
+        would block.
+        """
+        for n, (data, address) in enumerate(datagrams):
+            try:
+                self._socket.sendto(data, address)
+            except socket_error as err:
+                if err.args[0] in (EAGAIN, EWOULDBLOCK):
+                    return n
+                warn("socket send failure: %s" % err)
+        return len(datagrams)
+
+class MMsgIO:
+    """
+    This is recvmmsg()/sendmmsg(), BATCH_SIZE datagrams per system call.
+
+    Calling into ctypes costs about as much as a system call, so this avoids
+    touching the ctypes structures one field at a time.  The buffers and the
+    mmsghdr array are allocated (and pointed at each other) once, up front.
+    Each call then only memmove()s packed headers, data and addresses in or
+    string_at()s them out, and struct does the (un)packing.
+    """
+
+    def __init__(self, sock, max_datagram_size=MAX_DATAGRAM_SIZE):
+        self._socket = sock
+        self._fd = sock.fileno()
+        self._max_datagram_size = max_datagram_size
+        self._addresses = {} # {packed port and ip:(ip, port)}
+        self._names = {} # {(ip, port):packed sockaddr_in}
+        # receiving, one buffer of BATCH_SIZE slots of max_datagram_size
+        self._recv_buffer = ctypes.create_string_buffer(
+                                    BATCH_SIZE * max_datagram_size)
+        self._recv_names = (_sockaddr_in * BATCH_SIZE)()
+        self._recv_iovecs = (_iovec * BATCH_SIZE)()
+        self._recv_msgs = (_mmsghdr * BATCH_SIZE)()
+        ctypes.memmove(self._recv_iovecs, _packer(_IOVEC, BATCH_SIZE).pack(
+                *_flatten((ctypes.addressof(self._recv_buffer) +
+                           n * max_datagram_size, max_datagram_size)
+                          for n in xrange(BATCH_SIZE))),
+                ctypes.sizeof(self._recv_iovecs))
+        # the kernel overwrites msg_namelen, this template puts it back
+        self._recv_template = self._msgs_template(self._recv_names,
+                                                  self._recv_iovecs)
+        # sending
+        self._send_names = (_sockaddr_in * BATCH_SIZE)()
+        self._send_iovecs = (_iovec * BATCH_SIZE)()
+        self._send_msgs = (_mmsghdr * BATCH_SIZE)()
+        template = self._msgs_template(self._send_names, self._send_iovecs)
+        ctypes.memmove(self._send_msgs, template, len(template))
+
+    def recv_many(self):
+        """ This returns a list of up to BATCH_SIZE (data, address) tuples. """
+        ctypes.memmove(self._recv_msgs, self._recv_template,
+                       len(self._recv_template))
+        count = _libc.recvmmsg(self._fd, self._recv_msgs, BATCH_SIZE,
+                               MSG_DONTWAIT, None)
+        if count <= 0:
+            if count < 0:
+                errno = ctypes.get_errno()
+                if errno not in (EAGAIN, EWOULDBLOCK, EINTR):
+                    warn("recvmmsg failure: errno=%d" % errno)
+            return []
+        size = self._max_datagram_size
+        lengths = _packer(_MMSGHDR, count).unpack(ctypes.string_at(
+                        self._recv_msgs, count * _MMSGHDR_SIZE))[7::8]
+        data = ctypes.string_at(self._recv_buffer, count * size)
+        names = ctypes.string_at(self._recv_names, count * _SOCKADDR_IN_SIZE)
+        addresses = self._addresses
+        datagrams = []
+        for n in xrange(count):
+            name = names[n * _SOCKADDR_IN_SIZE + 2:n * _SOCKADDR_IN_SIZE + 8]
+            address = addresses.get(name)
+            if address is None:
+                address = self._address(name)
+            datagrams.append((data[n * size:n * size + lengths[n]], address))
+        return datagrams
+
+    def send_many(self, datagrams):
+        """
+        This sends the (data, address) tuples in order.  It returns how many
+        were sent (or discarded on error), stopping early only if the socket
+        would block.
+        """
+        sent = 0
+        names = self._names
+        while sent < len(datagrams):
+            batch = datagrams[sent:sent + BATCH_SIZE]
+            count = len(batch)
+            datas = [data for data, address in batch]
+            joined = "".join(datas) # this must stay referenced until sent
+            iovecs = []
+            offset = ctypes.cast(ctypes.c_char_p(joined), ctypes.c_void_p).value
+            for data in datas:
+                iovecs.append(offset)
+                iovecs.append(len(data))
+                offset += len(data)
+            ctypes.memmove(self._send_iovecs,
+                           _packer(_IOVEC, count).pack(*iovecs),
+                           count * _IOVEC_SIZE)
+            packed_names = "".join([names.get(address) or self._name(address)
+                                    for data, address in batch])
+            ctypes.memmove(self._send_names, packed_names, len(packed_names))
+            count = _libc.sendmmsg(self._fd, self._send_msgs, count, 0)
+            if count < 0:
+                errno = ctypes.get_errno()
+                if errno in (EAGAIN, EWOULDBLOCK):
+                    return sent
+                if errno != EINTR:
+                    warn("sendmmsg failure: errno=%d, discarding to %s:%d" %
+                            ((errno,) + batch[0][1]))
+                    sent += 1 # skip the one that failed
+                continue
+            sent += count
+        return sent
+
+    def _msgs_template(self, names, iovecs):
+        """ This packs an mmsghdr array of one name and one iovec each. """
+        return _packer(_MMSGHDR, BATCH_SIZE).pack(*_flatten(
+                (ctypes.addressof(names) + n * _SOCKADDR_IN_SIZE,
+                 _SOCKADDR_IN_SIZE,
+                 ctypes.addressof(iovecs) + n * _IOVEC_SIZE, 1,
+                 0, 0, 0, 0) for n in xrange(BATCH_SIZE)))
+
+    def _address(self, name):
+        """ This unpacks (and caches) a received sockaddr_in's port and ip. """
+        if len(self._addresses) >= ADDRESS_CACHE_SIZE:
+            self._addresses.clear()
+        address = self._addresses[name] = (inet_ntoa(name[2:]),
+                                           ntohs(_port.unpack(name[:2])[0]))
+        return address
+
+    def _name(self, address):
+        """ This packs (and caches) the sockaddr_in for an address to send to. """
+        if len(self._names) >= ADDRESS_CACHE_SIZE:
+            self._names.clear()
+        name = self._names[address] = _port.pack(AF_INET) + \
+                _port.pack(htons(address[1])) + inet_aton(address[0]) + \
+                "\x00" * 8
+        return name
+
+def main(count=200000, size=24):
+    """
+    This compares packets per second through loopback, PlainIO against
+    MMsgIO, sending count datagrams of size bytes each way.
+    """
+    from socket import socket, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF, SO_SNDBUF
+    from time import time
+    print "recvmmsg/sendmmsg available: %s" % mmsg_available()
+    ios = [("plain", lambda s: PlainIO(s))]
+    if mmsg_available():
+        ios.append(("mmsg", lambda s: MMsgIO(s)))
+    for name, make_io in ios:
+        rx, tx = socket(AF_INET, SOCK_DGRAM), socket(AF_INET, SOCK_DGRAM)
+        for s in rx, tx:
+            s.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 * 1024 * 1024)
+            s.setsockopt(SOL_SOCKET, SO_SNDBUF, 4 * 1024 * 1024)
+            s.bind(("127.0.0.1", 0))
+            s.setblocking(False)
+        rx_io, tx_io = make_io(rx), make_io(tx)
+        datagrams = [("x" * size, rx.getsockname())] * BATCH_SIZE
+        sent = received = 0
+        send_time = recv_time = 0.0
+        while received < count:
+            t1 = time()
+            if sent < count:
+                sent += tx_io.send_many(datagrams[:count - sent])
+            t2 = time()
+            got = len(rx_io.recv_many())
+            t3 = time()
+            received += got
+            send_time += t2 - t1
+            recv_time += t3 - t2
+            if got == 0 and sent >= count:
+                break # the rest were dropped by the kernel
+        print "%6s: sent %d at %d/s, received %d at %d/s" % (name,
+                sent, sent / send_time, received, received / recv_time)
+        rx.close()
+        tx.close()
+
+if __name__ == '__main__':
+    main()
@@ -66,7 +66,12 @@ class Packet(object):
      subspace.game.c2s_packet.C2SPacket : packets from client to game server 
      subspace.billing.packet.S2BPacket  : packets from game server to billing
      subspace.billing.packet.B2SPacket  : packets from billing server to game
+
+    A subclass without __slots__ has a __dict__ (for its components), as
+    usual.  One kept in bulk can have __slots__ instead (see Reliable), its
+    __init__ then sets the defaults that would otherwise be class attributes.
     """
+    __slots__ = ()
     # subclasses might overwrite these
     _prefix = ''        # prepended (e.g. core _prefix = '\x00', others are '')
     _id = '\x00'        # the packet ID, first byte (after _prefix)
@@ -97,7 +102,8 @@ class Packet(object):
                 values = values[len(self._prefix):] # self._prefix
             values = values[len(self._id):] # self._id
             components.update(dict(zip(self._components,values)))
-        self.__dict__.update(components)
+        for name, value in components.iteritems():
+            setattr(self, name, value)
         # these two enable caching of "final" raw outcome.
         # when raw(final_form = True) is invoked, it will cache the raw output
         # and return self.final_raw each subsequent time.
@@ -142,6 +148,15 @@ class Packet(object):
             self.final_raw = result
         return result
 
+    def latest_key(self):
+        """
+        This returns a key under which only the latest packet needs sending
+        (e.g. a player's position), or None if every packet must be sent.
+        A core server connection replaces an unsent packet with a newer one
+        under the same key (see core.server.CoreConnection, lanes).
+        """
+        return None
+
     def __str__(self):
         """ This gives a more helpful view of the packet and its innards. """
         s = self.__class__.__name__+"\n"
@@ -161,6 +176,7 @@ class Packet(object):
 
 class CorePacket(Packet):
     """ This is a core packet, with a prefix of 0x00. """
+    __slots__ = ()
     _prefix = '\x00'
 
 class Connect(CorePacket):
@@ -177,10 +193,20 @@ class ConnectResponse(CorePacket):
     server_key = 0xFFFFFFFF
 
 class Reliable(CorePacket):
+    """
+    Each connection keeps up to a window of these, so they have slots rather
+    than a __dict__ (including the ones reliable.ReliableOut uses).
+    """
+    __slots__ = ("seq", "tail", "has_final", "final_raw",
+                 "_sent_time", "_resends", "_due")
     _id = '\x03'
     _format = "I"
     _components = ["seq"]
-    seq = 0
+
+    def __init__(self, raw_data=None, **components):
+        self.seq = 0 # (slots have no class defaults)
+        self.tail = b''
+        CorePacket.__init__(self, raw_data, **components)
 
 class ReliableACK(CorePacket):
     _id = '\x04'
@@ -233,6 +259,63 @@ class StreamCancelRequestACK(CorePacket):
 class Cluster(CorePacket):
     _id = '\x0E'
 
+MAX_CLUSTERED_SIZE = 255 # each packet in a Cluster is prefixed by a size byte
+
+def cluster_groups(raws, max_size):
+    """
+    This splits the raw packets, in order, into groups that each fit in one
+    datagram of up to max_size bytes.  Consecutive packets of up to
+    MAX_CLUSTERED_SIZE bytes are grouped to go together in a Cluster; any
+    larger packet is a group of its own.
+    """
+    groups = []
+    size = max_size # the size of the last group as a Cluster
+    for raw in raws:
+        if len(raw) > MAX_CLUSTERED_SIZE:
+            groups.append([raw])
+            size = max_size # so nothing joins it
+        elif size + 1 + len(raw) > max_size:
+            groups.append([raw])
+            size = 2 + 1 + len(raw) # \x00\x0E, the size byte, the packet
+        else:
+            groups[-1].append(raw)
+            size += 1 + len(raw)
+    return groups
+
+def cluster_raw(raws):
+    """ This returns the raw Cluster holding the raw packets (a group). """
+    if len(raws) == 1:
+        return raws[0] # there's no need to wrap just one
+    return '\x00' + Cluster._id + ''.join([chr(len(raw)) + raw for raw in raws])
+
+def cluster_parts(data, offset=0):
+    """
+    This yields the raw packets packed in a Cluster's data, starting at offset
+    (i.e. 2, past the \x00\x0E of a raw Cluster).  It walks an offset rather
+    than slicing the rest off after each packet, so each byte is copied once
+    however many packets there are.  A truncated last packet is dropped.
+    """
+    end = len(data)
+    while offset < end:
+        size = ord(data[offset])
+        if offset + size < end:
+            yield data[offset + 1:offset + 1 + size]
+        offset += 1 + size
+
+def chunk_raws(data, size):
+    """
+    This splits the raw packet data into the raw Chunks (and the final raw
+    ChunkTail) that carry it, size bytes at a time.  Their headers are
+    constant, so each piece is sliced straight into its raw packet rather
+    than packed by a Chunk.
+    """
+    last = max(0, (len(data) - 1) // size * size) # where the ChunkTail starts
+    head = Chunk._prefix + Chunk._id
+    raws = [head + data[index:index + size]
+                for index in xrange(0, last, size)]
+    raws.append(ChunkTail._prefix + ChunkTail._id + data[last:])
+    return raws
+
 # continuum sends
 class _ContEncResponse(CorePacket):
     _id = '\x10'
@@ -248,11 +331,58 @@ class _ContEncResponseACK(CorePacket):
     _components = ["key1"]
     key1 = 0
 
+def benchmark(rounds=2000):
+    """
+    This compares cluster_parts against the old loop, which sliced the rest
+    of the Cluster off after each packet, and chunk_raws (and reassembly by
+    offset) against the old Chunk packets, for one ArenaSettings' worth
+    (1428 bytes) in 480 byte chunks.
+    """
+    from time import time
+    for count in (16, 128, 1024):
+        data = cluster_raw(['\x28' + 'p' * 15] * count)
+        t = time()
+        for n in xrange(rounds):
+            d = Cluster(data).tail
+            while len(d) > 0:
+                size = ord(d[0])
+                if len(d) > size:
+                    d[1:size+1]
+                d = d[size+1:]
+        old = time() - t
+        t = time()
+        for n in xrange(rounds):
+            for part in cluster_parts(data, 2):
+                pass
+        print "cluster of %4d packets: %8.2f us, was %8.2f us" % \
+                (count, (time() - t) * 1e6 / rounds, old * 1e6 / rounds)
+    data = '\x0f' + 's' * 1427
+    t = time()
+    for n in xrange(rounds):
+        raws, index = [], 0
+        while len(data) - index > 480:
+            p = Chunk()
+            p.tail = data[index:index+480]
+            index += 480
+            raws.append(p.raw())
+        p = ChunkTail()
+        p.tail = data[index:]
+        raws.append(p.raw())
+        assert ''.join([Chunk(raw).tail for raw in raws]) == data
+    old = time() - t
+    t = time()
+    for n in xrange(rounds):
+        raws = chunk_raws(data, 480)
+        assert ''.join([raw[2:] for raw in raws]) == data
+    print "1428 byte chunk round trip: %8.2f us, was %8.2f us" % \
+            ((time() - t) * 1e6 / rounds, old * 1e6 / rounds)
+
 def main():
     d = "00 06 6b 33 01 00 4f df 17 78"
     d = ''.join([b.decode('hex') for b in d.split()])
     p = SyncResponse(d)
     print p
+    benchmark()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
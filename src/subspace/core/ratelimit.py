@@ -0,0 +1,126 @@
+"""
+This limits rates, e.g. how fast new clients may connect to a core server
+(or how fast it sends to each, see core.server.CoreConnection).
+
+A datagram from an address the server doesn't know used to get a whole
+CoreConnection (queues, locks, a handler table and, after its Connect, a key
+table), so a flood of them from spoofed addresses could eat memory and CPU.
+core.server.Server now asks its ConnectAdmission first.  That only lets a
+valid Connect through, and only while the sender's IP (and the server as a
+whole) is within its rate of new connections.  Until then, the only state
+kept for an address is its IP's TokenBucket:
+
+>>> admission = ConnectAdmission(rate=100.0, rate_per_ip=2.0)
+>>> admission.admit(("10.0.0.1", 1234), packet.Connect(key=1234).raw())
+True
+>>> admission.admit(("10.0.0.1", 1235), "\\x00\\x05...")
+False
+>>> admission.stats()[:2]
+[('admitted', 1), ('not_connect', 1)]
+"""
+from subspace.core import packet
+from struct import calcsize
+from time import time
+
+CONNECT_RATE = 100.0 # new connections per second, in all
+CONNECT_RATE_PER_IP = 2.0 # new connections per second, from one IP
+BURST_SECONDS = 5.0 # a rate's burst is this many seconds' worth of it
+MAX_TRACKED_IPS = 4096 # IPs tracked before the idle ones are forgotten
+CONNECT_SIZE = calcsize(packet.Connect()._all_format())
+
+class TokenBucket(object):
+    """
+    This allows rate events per second on average, and bursts of up to burst
+    events.  Each take() spends a token, tokens come back at rate per second.
+    There is one per tracked IP and per shaped connection, so it has slots.
+    """
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst) # it starts full
+        self.stamp = time() if now is None else now # when tokens was current
+
+    def refill(self, now):
+        """ This returns the tokens available at now. """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+    def take(self, now, tokens=1):
+        """ This spends tokens if they are available, returning whether. """
+        if self.refill(now) < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def spend(self, tokens):
+        """ This spends tokens regardless, it may leave the bucket in debt. """
+        self.tokens -= tokens
+
+    def ready_at(self, tokens=1):
+        """ This returns when (as of the last refill) tokens will be there. """
+        return self.stamp + max(0.0, tokens - self.tokens) / self.rate
+
+class ConnectAdmission:
+    """
+    This decides whether a datagram from an unknown address may become a
+    new connection.  It must be a Connect, and there must be a token both in
+    its IP's bucket (rate_per_ip) and in the global one (rate).  The IP's
+    token is only spent once the global one is, so one busy IP can't starve
+    everyone else of global tokens by being refused.
+    """
+
+    def __init__(self, rate=CONNECT_RATE, rate_per_ip=CONNECT_RATE_PER_IP):
+        self._rate_per_ip = rate_per_ip
+        self._global = TokenBucket(rate, max(1.0, rate * BURST_SECONDS))
+        self._by_ip = {} # {ip:TokenBucket} of recently connecting IPs
+        # these are just for inspecting how admission is working
+        self.admitted = 0 # new connections let through
+        self.not_connect = 0 # datagrams refused for not being a Connect
+        self.ip_rate = 0 # Connects refused for their IP's rate
+        self.global_rate = 0 # Connects refused for the global rate
+
+    def __str__(self):
+        return "ConnectAdmission(%s)" % ', '.join(["%s=%s" % item
+                                                   for item in self.stats()])
+
+    def stats(self):
+        """ This returns a list of (name, value) tuples about admissions. """
+        return [("admitted", self.admitted), ("not_connect", self.not_connect),
+                ("ip_rate", self.ip_rate), ("global_rate", self.global_rate),
+                ("tracked_ips", len(self._by_ip))]
+
+    def admit(self, address, raw_packet, now=None):
+        """ This returns whether raw_packet from address may connect. """
+        if len(raw_packet) < CONNECT_SIZE or \
+                raw_packet[:2] != '\x00' + packet.Connect._id:
+            self.not_connect += 1
+            return False
+        now = time() if now is None else now
+        ip = address[0]
+        bucket = self._by_ip.get(ip)
+        if bucket is not None and bucket.refill(now) < 1:
+            self.ip_rate += 1
+            return False
+        if not self._global.take(now):
+            self.global_rate += 1
+            return False
+        if bucket is None:
+            if len(self._by_ip) >= MAX_TRACKED_IPS:
+                self._forget_idle_ips(now)
+            bucket = self._by_ip[ip] = TokenBucket(self._rate_per_ip,
+                            max(1.0, self._rate_per_ip * BURST_SECONDS), now)
+        bucket.take(now)
+        self.admitted += 1
+        return True
+
+    def _forget_idle_ips(self, now):
+        """
+        This forgets the IPs whose buckets have refilled (a new bucket would
+        be just the same).  Spending global tokens to get tracked, there are
+        never many more than rate * BURST_SECONDS that haven't.
+        """
+        self._by_ip = dict((ip, bucket) for ip, bucket in self._by_ip.iteritems()
+                           if bucket.refill(now) < bucket.burst)
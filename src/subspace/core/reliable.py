@@ -0,0 +1,332 @@
+"""
+This keeps the reliable packet windows for one end of a core connection.
+
+core.server.CoreConnection and core.client.Client each keep
+    * a ReliableIn, the received Reliables waiting to be processed in order,
+    * a ReliableOut, the sent Reliables waiting to be acknowledged (and the
+      ones waiting for room in its congestion window), and
+    * an RTTEstimator, which says how long to wait before resending them.
+Every operation on them is O(1) (or O(log n) for the resend heap) rather than
+a sort or a scan of the whole list:
+
+>>> window = ReliableIn()
+>>> window.add(packet.Reliable(seq=1)), window.add(packet.Reliable(seq=0))
+(True, True)
+>>> [p.seq for p in window.deliverable()]
+[0, 1]
+
+Run this module to benchmark them against the old lists.
+"""
+from subspace.core import packet
+from heapq import heappush, heappop, heapify
+from collections import deque
+
+RELIABLE_WINDOW = 1024 # received Reliables held at most (beyond are dropped)
+INITIAL_RTO = 1.0 # seconds to wait for an ACK before any RTT is measured
+MIN_RTO = 0.1 # the least seconds to wait for an ACK, however quick the RTT
+MAX_RTO = 10.0 # the most seconds to wait for an ACK, even after backing off
+INITIAL_WINDOW = 8 # Reliables in flight at first (see ReliableOut)
+MIN_WINDOW = 2 # the fewest Reliables in flight, however lossy
+MAX_WINDOW = 256 # the most Reliables in flight (well within RELIABLE_WINDOW)
+
+class ReliableIn(object):
+    """
+    This holds received Reliables, indexed by seq, until the ones before them
+    have arrived.  It holds at most window of them: any Reliable further
+    ahead than that is refused (and, unacknowledged, it will be resent).
+    """
+    __slots__ = ("next_seq", "_pending", "_window") # (one per connection)
+
+    def __init__(self, window=RELIABLE_WINDOW):
+        self.next_seq = 0 # the seq to be processed next
+        self._pending = {} # {seq:Reliable} received, but not yet processed
+        self._window = window
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, p):
+        """
+        This holds the received Reliable p, it returns False if p was refused
+        for being too far ahead.  (p.seq must be >= next_seq.)
+        """
+        if p.seq >= self.next_seq + self._window:
+            return False
+        self._pending[p.seq] = p
+        return True
+
+    def deliverable(self):
+        """ This yields (and forgets) the held Reliables that are next. """
+        while self.next_seq in self._pending:
+            p = self._pending.pop(self.next_seq)
+            self.next_seq += 1
+            yield p
+
+class ReliableOut(object):
+    """
+    This holds sent Reliables, indexed by seq, until they are acknowledged.
+
+    An ACK acknowledges every seq up to and including its own, so ack() just
+    walks up from the lowest unacknowledged seq.  Resend deadlines are kept
+    in a heap of (due, seq), so expired() only looks at the ones that are due.
+    A Reliable's heap entry goes stale when it is acknowledged or resent; the
+    stale entries are skipped, and the heap is rebuilt if they pile up.
+
+    At most window Reliables are in flight (sent but unacknowledged).  Any
+    more wait, unsent and without a seq, in the backlog until ACKs make room
+    (see released).  The window is AIMD congestion control, as TCP Reno's:
+    it grows by 1 per ACK up to ssthresh (slow start) and by 1 per window of
+    ACKs after that, and each loss (a Reliable expiring unacknowledged) halves
+    it, at most once per window.  A loss also resends at most a window.
+    """
+    __slots__ = ("next_seq", "_low_seq", "_packets", "_resends", "_backlog",
+                 "window", "ssthresh", "_recovery_seq", "backlogged",
+                 "losses", "resends")
+
+    def __init__(self):
+        self.next_seq = 0 # the seq for the next Reliable sent
+        self._low_seq = 0 # the lowest seq that might be unacknowledged
+        self._packets = {} # {seq:Reliable} sent, but not yet acknowledged
+        self._resends = [] # a heap of (due, seq)
+        self._backlog = None # tails waiting for room, a deque once needed
+        self.window = float(INITIAL_WINDOW)
+        self.ssthresh = float(MAX_WINDOW)
+        self._recovery_seq = 0 # losses below this seq were already counted
+        # these are just for inspecting how the window is working
+        self.backlogged = 0 # Reliables that had to wait in the backlog
+        self.losses = 0 # times the window was halved
+        self.resends = 0 # Reliables resent
+
+    def __len__(self):
+        return len(self._packets)
+
+    def __str__(self):
+        return "ReliableOut(%s)" % ', '.join(["%s=%s" % item
+                                              for item in self.stats()])
+
+    def stats(self):
+        """ This returns a list of (name, value) tuples about the window. """
+        return [("window", int(self.window)), ("ssthresh", int(self.ssthresh)),
+                ("in_flight", len(self._packets)),
+                ("backlog", len(self._backlog or ())),
+                ("backlogged", self.backlogged), ("losses", self.losses),
+                ("resends", self.resends)]
+
+    def add(self, tail, now, timeout):
+        """
+        This returns a new Reliable wrapping tail, sent at now and to be
+        resent timeout seconds later.  If the window is full, tail goes into
+        the backlog instead, and this returns None.
+        """
+        if self._backlog or len(self._packets) >= int(self.window):
+            if self._backlog is None:
+                self._backlog = deque()
+            self._backlog.append(tail)
+            self.backlogged += 1
+            return None
+        return self._launch(tail, now, timeout)
+
+    def room(self):
+        """ This returns how many more Reliables could be sent right now. """
+        if self._backlog:
+            return 0
+        return max(0, int(self.window) - len(self._packets))
+
+    def released(self, now, timeout):
+        """
+        This returns the new Reliables for backlogged tails that now fit in
+        the window.  They are sent at now, as with add.
+        """
+        released = []
+        while self._backlog and len(self._packets) < int(self.window):
+            released.append(self._launch(self._backlog.popleft(), now,
+                                         timeout))
+        return released
+
+    def _launch(self, tail, now, timeout):
+        """ This puts a new Reliable wrapping tail in flight. """
+        p = packet.Reliable(seq=self.next_seq)
+        p.tail = tail
+        p._sent_time = now
+        p._resends = 0
+        self.next_seq += 1
+        self._packets[p.seq] = p
+        self._schedule(p, now + timeout)
+        return p
+
+    def ack(self, seq):
+        """ This forgets every Reliable up to seq, returning them. """
+        acked = []
+        while self._low_seq <= seq and self._low_seq < self.next_seq:
+            p = self._packets.pop(self._low_seq, None)
+            if p is not None:
+                acked.append(p)
+            self._low_seq += 1
+        for p in acked:
+            if self.window < self.ssthresh:
+                self.window += 1
+            else:
+                self.window += 1 / self.window
+        self.window = min(self.window, MAX_WINDOW)
+        if len(self._resends) > 2 * len(self._packets) + 64:
+            self._resends = [(p._due, p.seq) for p in self._packets.values()]
+            heapify(self._resends)
+        return acked
+
+    def expired(self, now):
+        """
+        This returns the unacknowledged Reliables due by now, at most a
+        window of them (the rest stay due).  They stay held, the caller
+        resends them and then tells resent().
+        """
+        due_packets = []
+        while self._resends and self._resends[0][0] <= now and \
+                len(due_packets) < max(1, int(self.window)):
+            due, seq = heappop(self._resends)
+            p = self._packets.get(seq)
+            if p is not None and p._due == due:
+                due_packets.append(p)
+        if due_packets and max(p.seq for p in due_packets) >= \
+                                                    self._recovery_seq:
+            # a new loss, newer Reliables may still be lost to the same one
+            self.ssthresh = max(MIN_WINDOW, self.window / 2)
+            self.window = self.ssthresh
+            self._recovery_seq = self.next_seq
+            self.losses += 1
+        return due_packets
+
+    def next_due(self):
+        """
+        This returns when the earliest unacknowledged Reliable is due (or
+        None if there are none), dropping any stale heap entries on the way.
+        """
+        while self._resends:
+            due, seq = self._resends[0]
+            p = self._packets.get(seq)
+            if p is not None and p._due == due:
+                return due
+            heappop(self._resends)
+        return None
+
+    def resent(self, p, now, timeout):
+        """ This notes that p was resent at now, due again after timeout. """
+        p._resends += 1
+        self.resends += 1
+        self._schedule(p, now + timeout)
+
+    def _schedule(self, p, due):
+        """ This sets (or resets) when the Reliable p is next due. """
+        p._due = due
+        heappush(self._resends, (due, p.seq))
+
+class RTTEstimator(object):
+    """
+    This estimates a connection's round trip time, and from it the time to
+    wait for an ACK before resending (the RTO), as TCP does (RFC 6298):
+        srtt   -- the smoothed RTT, in seconds
+        rttvar -- the smoothed mean deviation of the RTT, in seconds
+        rto    -- srtt + 4 * rttvar, kept between MIN_RTO and MAX_RTO
+    Samples come from ACKs of Reliables that were sent only once (Karn's
+    rule, a resent one's ACK could be for either send) and from Sync and
+    SyncResponse pairs.  Each resend of a Reliable doubles its own wait.
+    """
+    __slots__ = ("srtt", "rttvar", "rto", "samples")
+
+    def __init__(self):
+        self.srtt = None # (until the first sample)
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.samples = 0
+
+    def __str__(self):
+        if self.srtt is None:
+            return "RTT(unmeasured, rto=%.3f)" % self.rto
+        return "RTT(srtt=%.3f, rttvar=%.3f, rto=%.3f, samples=%d)" % \
+                (self.srtt, self.rttvar, self.rto, self.samples)
+
+    def sample(self, rtt):
+        """ This updates the estimates with a measured rtt (in seconds). """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+        self.samples += 1
+
+    def timeout(self, resends=0):
+        """ This is how long to wait for an ACK after the resends'th resend. """
+        return min(MAX_RTO, self.rto * 2 ** resends)
+
+def benchmark(count=1000, rounds=20):
+    """
+    This compares these windows against the old sorted lists, with count
+    Reliables in flight, each arriving in a random order.  Sending is timed
+    from adding the count Reliables until all are acknowledged (with a resend
+    check after each ACK), for ACKs in order and in a random order.  The old
+    ACK loop removed from the list while iterating over it, skipping entries,
+    so here it iterates over a copy (as it meant to).
+    """
+    from random import shuffle
+    from time import time
+    received = [packet.Reliable(seq=seq) for seq in range(count)]
+    acks = {"in order" : range(count), "shuffled" : range(count)}
+    timings = {}
+    for n in range(rounds):
+        shuffle(received)
+        shuffle(acks["shuffled"])
+        # receiving, the old way: append, sort, pop(0)
+        t = time()
+        reliable_in, in_seq = [], 0
+        for p in received:
+            reliable_in.append(p)
+            reliable_in.sort(key=lambda x: x.seq)
+            while len(reliable_in) > 0 and reliable_in[0].seq == in_seq:
+                reliable_in.pop(0)
+                in_seq += 1
+        timings["in, list"] = timings.get("in, list", 0) + time() - t
+        # receiving, with ReliableIn
+        t = time()
+        window = ReliableIn()
+        for p in received:
+            window.add(p)
+            for p in window.deliverable():
+                pass
+        timings["in, ReliableIn"] = \
+                        timings.get("in, ReliableIn", 0) + time() - t
+        for order, ack_seqs in acks.iteritems():
+            # sending and acknowledging, the old way
+            t = time()
+            reliable_out = []
+            for seq in range(count):
+                p = packet.Reliable(seq=seq)
+                p.tail = ''
+                p._sent_time = time()
+                reliable_out.append(p)
+            for seq in ack_seqs:
+                for out_p in reliable_out[:]:
+                    if out_p.seq <= seq:
+                        reliable_out.remove(out_p)
+                for p in reliable_out:
+                    if time() - p._sent_time > 5.0:
+                        pass
+            name = "out (acks %s), list" % order
+            timings[name] = timings.get(name, 0) + time() - t
+            # sending and acknowledging, with ReliableOut
+            t = time()
+            window = ReliableOut()
+            window.window = count # all of them in flight
+            for seq in range(count):
+                window.add('', time(), 5.0)
+            for seq in ack_seqs:
+                window.ack(seq)
+                window.expired(time())
+            name = "out (acks %s), ReliableOut" % order
+            timings[name] = timings.get(name, 0) + time() - t
+    for name in sorted(timings):
+        print "%34s: %7.2f us per reliable" % (name,
+                            timings[name] * 1e6 / (rounds * count))
+
+if __name__ == '__main__':
+    benchmark()
@@ -16,44 +16,216 @@ Connect and ConnectResponse.  For a server, it can be initialized immediately
 after it is .accept()ed.
 """
 from subspace.core import packet
-from subspace.core.encryption import VIE
+from subspace.core.reliable import ReliableIn, ReliableOut, RTTEstimator
+from subspace.core.encryption import VIE, key_tables, encrypt_many
+from subspace.core.mmsg import datagram_io
+from subspace.core.timer import TimerWheel, timers
+from subspace.core.clock import ClockSync, tick_diff
+from subspace.core.ingress import FairQueue, INGRESS_CAP, DROP_NEWEST
+from subspace.core.ratelimit import ConnectAdmission, TokenBucket, CONNECT_RATE
+from subspace.core.ratelimit import CONNECT_RATE_PER_IP
+from subspace.core.chunk import ChunkBuffer, MAX_CHUNKED_SIZE
+from subspace.core.chunk import StreamSender, StreamReceiver, ChunkCache
 from subspace.util import now
 from socket import socket,timeout,AF_INET,SOCK_DGRAM,SOL_SOCKET,SO_REUSEADDR
-from select import select
+from socket import SO_RCVBUF
+from socket import error as socket_error
+from select import select, error as select_error
+try:
+    from select import epoll, EPOLLIN, EPOLLOUT
+except ImportError:
+    epoll = None # not on Linux, so the reactor uses select instead
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = 15 # python 2 doesn't name it, this is Linux's value
+from errno import EINTR
 from threading import Thread, RLock, Event
-from Queue import Queue, Empty, Full
+from collections import deque
 from time import time, sleep
 from logging import warn, info, debug
 
 MAX_PACKET_SIZE = 512 # we grab up to this many bytes from the socket at a time
+RECV_BUFFER = 1024 * 1024 # bytes of kernel buffer for datagrams not yet read
 CHUNK_SIZE = 480 # this is the size of the chunks to send when chunking
-QUEUE_SIZE_IN = 500 # the number of incoming packets to queue before dropping 
-QUEUE_SIZE_OUT = 500 # same, but for outgoing packets
+QUEUE_SIZE_OUT = 500 # the outgoing packets a lane queues before dropping
+MAX_STREAMS = 4 # transfers a connection may have queued (see send_stream)
 SYNC_PERIOD = 5.0 # seconds between Sync's (see _sync)
-RELIABLE_TIMEOUT_RESEND = 5.0 # seconds between reliable resends
+REACTOR_MAX_DRAIN = 256 # datagrams read per reactor pass before flushing
+ACK_DELAY = 0.02 # seconds a ReliableACK may wait for company (see _queue_ack)
+UDP_IP_HEADER_SIZE = 28 # what each datagram saved by clustering saves
+IDLE_TIMEOUT = 30.0 # seconds of silence before a connection is evicted
+MAX_CONNECTIONS = 1024 # the most connections the server holds at once
+SEND_RATE = 0 # bytes/s of unreliable packets per connection (0 is unlimited)
+SHAPING_BURST = 0.2 # seconds' worth of send_rate a connection may send at once
+MIN_SEND_RATE = 2000 # bytes/s adaptive shaping never cuts a connection below
+SHAPING_MIN_SAMPLE = 20 # datagrams sent between Syncs to judge the loss by
+SHAPING_LOSS_HIGH = 0.05 # loss above which adaptive shaping cuts the rate
+SHAPING_LOSS_LOW = 0.01 # loss below which adaptive shaping raises the rate
 
 class Server:
-    """ This is a server using the subspace core protocol. """
+    """
+    This is a server using the subspace core protocol.
+
+    It runs in one of two modes.  By default it spawns two threads: one sends
+    from the outgoing queues and one receives from the socket, while timers
+    (e.g. resends of unacknowledged reliables) fire on the shared core.timer
+    service.  With reactor=True a single thread does all of that from one
+    loop (see _reactor_loop) waiting on epoll (or select where there is no
+    epoll), with its own TimerWheel.  Either way, the API (recv, send,
+    send_to_many, send_chunked, send_stream) is the same and is threadsafe.
+
+    With batched_io=True, the socket is read and written with recvmmsg and
+    sendmmsg where the platform has them (see core.mmsg), in either mode.
+    With reuse_port=True, the socket is bound with SO_REUSEPORT so that
+    several processes can share the address (see core.shard).  The socket's
+    kernel receive buffer is set to recv_buffer bytes (the OS caps it, e.g.
+    at net.core.rmem_max on Linux), the usual default (~200K) holds only a
+    few hundred datagrams, which a burst overflows whenever the receiving
+    thread is descheduled.  None leaves the OS default.
+
+    Outgoing packets are queued unencrypted, in each connection's outbox (a
+    deque).  A connection joins the server's ready set when its outbox (or
+    its held ACKs) goes from empty to not, and flushing only visits the
+    connections in the ready set, so it costs nothing for idle clients.
+    When a connection's outbox is flushed, its small packets are packed
+    together into Cluster packets (see _cluster) and then every flushed
+    datagram, for every connection, is encrypted in one pass.  cluster_delay
+    is the longest (in seconds) that a queued packet waits for others to
+    join it.  By default it doesn't wait, so only packets queued since the
+    last flush are clustered.  ReliableACKs are held for up to ack_delay
+    seconds so they go out together, and with any other packets sent in the
+    meantime (see CoreConnection._queue_ack).
+
+    A connection that the server hasn't heard from for idle_timeout seconds
+    is evicted (halfway there, it is sent a Sync as a keepalive, see
+    CoreConnection._check_idle).  At most max_connections are held, a new
+    address beyond that is refused.  Evictions reach recv() as a None, like
+    any core disconnect.
+
+    A datagram from an unknown address only gets a CoreConnection if it is a
+    Connect within the rate of new connections: connect_rate per second in
+    all and connect_rate_per_ip per second from one IP (see
+    ratelimit.ConnectAdmission, whose counters are in .admission).  A
+    connection whose Chunks add up to more than max_chunked_size bytes is
+    evicted too (see core.chunk), as is one streaming more than that.
+    The raw Chunks of packets sent with send_chunked(..., cache=True) are
+    kept in .chunk_cache (a chunk.ChunkCache), so a packet sent chunked to
+    many clients is only packed and split once.  Such a packet mustn't be
+    changed afterwards, forget_chunked lets go of it (e.g. once replaced by a
+    new one).
 
-    def __init__(self, address):
+    With send_rate set, each connection is shaped to send_rate bytes per
+    second by a token bucket (see CoreConnection._take_outgoing).  Only the
+    events and latest lanes wait for tokens.  The control lane (core packets
+    and reliables) always goes out, and what it uses is spent from the same
+    bucket.  With adaptive_send_rate, each connection's rate follows the loss
+    its client reports in Syncs, between MIN_SEND_RATE and send_rate (see
+    CoreConnection._adapt_send_rate).
+
+    Received packets wait for recv() in .ingress, an ingress.FairQueue that
+    holds up to ingress_cap packets per connection and takes from each
+    connection in turn.  Receiving never blocks on it, a connection with
+    ingress_cap packets waiting has its packets dropped instead, by
+    ingress_drop (see core.ingress), and counted in its dropped_in.
+    """
+
+    def __init__(self, address, reactor=False, batched_io=False,
+                 reuse_port=False, recv_buffer=RECV_BUFFER,
+                 cluster_delay=0.0, ack_delay=ACK_DELAY,
+                 idle_timeout=IDLE_TIMEOUT, max_connections=MAX_CONNECTIONS,
+                 connect_rate=CONNECT_RATE,
+                 connect_rate_per_ip=CONNECT_RATE_PER_IP,
+                 send_rate=SEND_RATE, adaptive_send_rate=False,
+                 max_chunked_size=MAX_CHUNKED_SIZE, ingress_cap=INGRESS_CAP,
+                 ingress_drop=DROP_NEWEST):
         self._connections = {} # all active {client_address:CoreConnection}
         self._connections_lock = RLock() # so rel thread can grab it to resend
         self._server_socket = socket(AF_INET,SOCK_DGRAM)
         self._server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        if reuse_port:
+            self._server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        if recv_buffer is not None:
+            self._server_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, recv_buffer)
         self._server_socket.bind(address)
         self._server_socket.setblocking(False)
-        self._in = Queue(QUEUE_SIZE_IN) # contains tuples of incoming (address, packet)
+        self._io = datagram_io(self._server_socket, batched_io)
+        self._blocked = [] # (data, address)'s the socket wouldn't yet take
+        self._output_event = Event() # set when a connection becomes ready
+        self._init_clustering(cluster_delay, ack_delay)
+        self._init_connection_limits(idle_timeout, max_connections,
+                                     connect_rate, connect_rate_per_ip,
+                                     max_chunked_size)
+        self._init_shaping(send_rate, adaptive_send_rate)
+        self._init_ingress(ingress_cap, ingress_drop)
         self.address = self._server_socket.getsockname()
-        self._threads = {
-            "send" : Thread(target=self._sending_loop,name="Server:Core:send"),
-            "recv" : Thread(target=self._receiving_loop,name="Server:Core:recv"),
-            "rel"  : Thread(target=self._reliable_resend_loop,name="Server:Core:rel")
-            }
+        self._reactor = reactor
+        if reactor:
+            # other threads poke the reactor awake through this socket when
+            # they queue outgoing packets (see _output_ready)
+            self._wake_socket = socket(AF_INET,SOCK_DGRAM)
+            self._wake_socket.bind(("127.0.0.1",0))
+            self._wake_socket.setblocking(False)
+            self._wake_pending = False
+            self._timers = TimerWheel() # see _call_later
+            self._threads = {
+                "reactor" : Thread(target=self._reactor_loop,
+                                   name="Server:Core:reactor"),
+                }
+        else:
+            self._timers = timers # the shared timer service
+            self._threads = {
+                "send" : Thread(target=self._sending_loop,name="Server:Core:send"),
+                "recv" : Thread(target=self._receiving_loop,name="Server:Core:recv"),
+                }
         self._shutting_down = Event() # this is set to tell the threads to end
+        key_tables.start() # so Connects find server keys with tables built
         info("starting core server %s" % self)
         for thread_name,thread in self._threads.iteritems():
             thread.start()
     
+    def _init_clustering(self, cluster_delay, ack_delay):
+        """ This sets up the outgoing clustering state (and its counters). """
+        self._cluster_delay = cluster_delay
+        self._ack_delay = ack_delay
+        self._next_flush = None # when the earliest waiting packet is due
+        self._ready = deque() # connections with something to send
+        # these are just for inspecting how well clustering is working
+        self.clustered_packets = 0 # packets sent inside Clusters
+        self.datagrams_saved = 0 # datagrams not sent thanks to Clusters
+        self.bytes_saved = 0 # header bytes saved, less the Cluster overhead
+        self.coalesced_packets = 0 # stale packets replaced by a newer one
+
+    def _init_connection_limits(self, idle_timeout, max_connections,
+                                connect_rate, connect_rate_per_ip,
+                                max_chunked_size=MAX_CHUNKED_SIZE):
+        """
+        This sets up the idle eviction, connection cap, admission of new
+        connections, chunk limit and chunk cache (and their counters).
+        """
+        self._idle_timeout = idle_timeout
+        self._max_connections = max_connections
+        self._max_chunked_size = max_chunked_size
+        self.chunk_cache = ChunkCache(CHUNK_SIZE) # see send_chunked
+        self.admission = ConnectAdmission(connect_rate, connect_rate_per_ip)
+        # these are just for inspecting the connection table
+        self.keepalives_sent = 0 # Syncs sent to connections going idle
+        self.evicted_idle = 0 # connections evicted for idle_timeout
+        self.refused_full = 0 # Connects from new addresses with no room
+        self.evicted_chunks = 0 # connections evicted for max_chunked_size
+
+    def _init_shaping(self, send_rate, adaptive_send_rate):
+        """ This sets up the per connection send_rate (and its counters). """
+        self._send_rate = send_rate
+        self._adaptive_send_rate = adaptive_send_rate
+        # these are just for inspecting how shaping is working
+        self.shaped_flushes = 0 # flushes that left packets for the bucket
+        self.send_rate_cuts = 0 # times adaptive shaping cut a rate
+
+    def _init_ingress(self, ingress_cap, ingress_drop):
+        """ This sets up the received packets' per connection queues. """
+        self.ingress = FairQueue(ingress_cap, ingress_drop) # (it counts)
+
     def __str__(self):
         return "Core:Server(%s:%d)" % self.address
 
@@ -67,30 +239,108 @@ class Server:
     def send_to_many(self, addresses, packet, reliable = False):
         """ 
         This permits more efficient sending of the same packet to many 
-        addresses.
+        addresses.  The packet is packed once (and, like all sends, it is
+        encrypted for every recipient together when flushed).
         """
         packet.raw(final_form = True)
-        for address in addresses:
-            self.send(address, packet, reliable)
+        for conn in map(self._connections.get, addresses):
+            if conn is not None:
+                conn._queue_outgoing(packet,
+                                     conn._outgoing_raw(packet, reliable))
         packet.has_final = False
             
-    def send_chunked(self, address, packet):
+    def rtt(self, address):
+        """
+        This returns the RTTEstimator for the client at address (or None if
+        it isn't connected), see reliable.RTTEstimator for its estimates.
+        """
+        conn = self._connections.get(address)
+        return conn.rtt if conn is not None else None
+
+    def clock(self, address):
+        """
+        This returns the ClockSync for the client at address (or None if it
+        isn't connected), to translate between its clock and ours (see
+        core.clock).
+        """
+        conn = self._connections.get(address)
+        return conn.clock if conn is not None else None
+
+    def dropped_in(self, address):
+        """
+        This returns how many packets from the client at address were dropped
+        for having ingress_cap waiting already (or None if not connected).
+        """
+        conn = self._connections.get(address)
+        return conn.dropped_in if conn is not None else None
+
+    def send_rate(self, address):
+        """
+        This returns the bytes/s the client at address is shaped to (or None
+        if it isn't connected or isn't shaped), see adaptive_send_rate.
+        """
+        conn = self._connections.get(address)
+        if conn is None or conn._shaper is None:
+            return None
+        return conn._shaper.rate
+
+    def reliable_stats(self, address):
+        """
+        This returns a list of (name, value) tuples about the reliable window
+        of the client at address (or None if it isn't connected), see
+        reliable.ReliableOut.stats.
+        """
+        conn = self._connections.get(address)
+        if conn is None:
+            return None
+        with conn._reliable_out_lock:
+            return conn._reliable_out.stats()
+
+    def send_chunked(self, address, packet, cache=False):
+        """
+        This sends a large packet to the client at address in reliable chunks
+        (see CoreConnection.send_chunked), returning False if not connected.
+        """
         if address in self._connections:
-            self._connections[address].send_chunked(packet)
+            self._connections[address].send_chunked(packet, cache)
             return True
         else:
             return False
 
+    def forget_chunked(self, packet):
+        """
+        This drops the packet's raw Chunks from the chunk_cache, e.g. when an
+        arena reloads the settings it had been sending with send_chunked.
+        """
+        self.chunk_cache.discard(packet)
+
+    def send_stream(self, address, packet, progress=None):
+        """
+        This streams a large packet (e.g. a map file) to the client at address
+        (see CoreConnection.send_stream).  It returns the chunk.StreamOut, to
+        follow (or cancel_stream) the transfer, or None if not connected (or
+        if the client already has MAX_STREAMS transfers queued).
+        """
+        conn = self._connections.get(address)
+        return conn.send_stream(packet, progress) if conn is not None else None
+
+    def cancel_stream(self, address, transfer=None):
+        """ This cancels the transfer (or every one) to the client. """
+        conn = self._connections.get(address)
+        if conn is not None:
+            conn.cancel_stream(transfer)
+
     def recv(self, timeout=None):
         """ 
         This blocks until it returns the next (address, packet) tuple.
         
         If no timeout is specified, it blocks until it gets a packet.
         But if timeout is not None, then this blocks for at most timeout 
-        seconds, when it will throw the threading.Empty exception.
-        If the connection is disconnected, it returns None instead of a tuple.
+        seconds, when it will throw the Queue.Empty exception.
+        If the connection is disconnected, packet is None.  Connections take
+        turns, see ingress.FairQueue.
         """
-        return self._in.get(True, timeout)
+        return self.ingress.get(timeout)
 
     def disconnect(self, address, notify=True):
         """
@@ -104,7 +354,7 @@ class Server:
                 if notify:
                     self.send(address, packet.Disconnect()) # let them know
                     self.send(address, packet.Disconnect()) # let them know
-                del self._connections[address]
+                self._connections.pop(address)._stop_timers()
         
     def shutdown(self):
         """ 
@@ -118,33 +368,28 @@ class Server:
             conns = self._connections.keys()[:]
             for address in conns:
                 self.disconnect(address, notify = True)
+        self._output_ready() # the reactor (if any) must notice the shutdown
         for thread_name,thread in self._threads.iteritems():
             thread.join(3.0) # give it 3s to join
 
     def _sending_loop(self):
-        """ This grabs from the outgoing queues and sends them. """
-        while True:                 
-            with self._connections_lock:
-                conn_pairs = self._connections.items()[:]
-            sent_any = False
-            for address, conn in conn_pairs:
-                try:
-                    p = conn._out.get(False)
-                except Empty:
-                    continue
-                try:
-                    self._server_socket.sendto(p._encrypted, address)
-                    sent_any = True
-                except timeout:
-                    warn("socket send failure")
-                conn._out.task_done()
-            if self._shutting_down.is_set():
-                if sent_any: 
-                    info("continuing send loop despite shutdown to flush out")
-                else:
+        """
+        This flushes the ready connections' outboxes.  It sleeps until a
+        connection becomes ready (see _output_ready), or until the next one
+        waiting for company is due, or (if the socket was full) for 1ms.
+        """
+        while True:
+            shutting_down = self._shutting_down.is_set()
+            self._output_event.clear()
+            if self._flush_outgoing():
+                if shutting_down:
                     return # we only exit when we are done sending
+                wait = 1.0
+                if self._next_flush is not None:
+                    wait = max(0.0, self._next_flush - time())
             else:
-                sleep(0.001)
+                wait = 0.001
+            self._output_event.wait(wait)
 
     def _receiving_loop(self):
         """ This polls the server socket for incoming packets. """
@@ -152,36 +397,273 @@ class Server:
             rs,_,__ = select([self._server_socket],[],[],1.0)
             if len(rs) == 0:
                 continue
+            for raw_packet, client_address in self._io.recv_many():
+                self._handle_datagram(raw_packet, client_address)
+
+    def _handle_datagram(self, raw_packet, client_address):
+        """ This passes a received datagram to its CoreConnection. """
+        # we only lock the connections dictionary when we add a new one.
+        # fetching from the dict, unlike adding, is atomic and threadsafe
+        if client_address not in self._connections:
+            if not self.admission.admit(client_address, raw_packet):
+                return
+            with self._connections_lock:
+                if len(self._connections) >= self._max_connections:
+                    self.refused_full += 1
+                    return
+                conn = self._connections[client_address] = \
+                                        CoreConnection(client_address,self)
+        else:
+            conn = self._connections[client_address]
+        try:
+            conn.receive_incoming_packet(raw_packet)
+        except Exception as err:
+            warn("error receiving incoming packet %s" % 
+                    ' '.join([x.encode("hex") for x in raw_packet]))
+            warn("%s" % err)
+
+    def _evict(self, conn):
+        """
+        This drops the connection, telling the client (in case it's still
+        there).  If it had connected, recv()'ers get a None for it just as if
+        it had sent a Disconnect.
+        """
+        with self._connections_lock:
+            if self._connections.get(conn.address) is not conn:
+                return # it's already gone
+            self.disconnect(conn.address, notify = conn._enc is not None)
+        info("evicted %s:%d" % conn.address)
+        if conn._enc is not None:
+            self._deliver(conn.address, None)
+
+    def _deliver(self, address, packet_data):
+        """
+        CoreConnections call this with each non-core packet they receive (or
+        with None when they are disconnected) to queue it for recv().  It
+        never blocks, it returns False if a packet was dropped instead.
+        """
+        return self.ingress.put(address, packet_data)
+
+    def _mark_ready(self, conn):
+        """
+        CoreConnections call this when their outbox (or held ACKs) goes from
+        empty to not.  It adds conn to the ready set for the next flush.
+        """
+        self._ready.append(conn)
+        self._output_ready()
+
+    def _output_ready(self):
+        """
+        This wakes whatever flushes the outboxes.  In reactor mode it wakes
+        the reactor (at most one wake datagram is in flight), otherwise the
+        sending thread.
+        """
+        if not self._reactor:
+            self._output_event.set()
+        elif not self._wake_pending:
+            self._wake_pending = True
             try:
-                raw_packet, client_address = \
-                            self._server_socket.recvfrom(MAX_PACKET_SIZE)
-            except timeout:
+                self._wake_socket.sendto('\x00', 
+                                         self._wake_socket.getsockname())
+            except socket_error:
+                pass # a wake is already waiting to be read
+
+    def _call_later(self, delay, fn, *args):
+        """
+        This has fn(*args) invoked after delay seconds, by the reactor or (in
+        the threaded mode) by the shared timer service.  It returns the timer,
+        which can be cancel()'ed.
+        """
+        return self._timers.schedule(delay, fn, *args)
+
+    def _reactor_loop(self):
+        """
+        This is the only thread in reactor mode.  Each pass, it waits (in
+        epoll, or select) on the server socket and on the wake socket until
+        the next timer is due.  Then it 
+            1. drains the datagrams waiting on the server socket,
+            2. fires any timers that are due (see core.timer), and
+            3. flushes the outgoing queues, as far as the socket will take.
+        While it is busy with 1 and 2, _wake_pending stays set, so packets it
+        sends itself (e.g. ACKs) don't bother waking it.
+        """
+        poller = _Poller()
+        server_fd = self._server_socket.fileno()
+        wake_fd = self._wake_socket.fileno()
+        poller.watch(server_fd)
+        poller.watch(wake_fd)
+        while True:
+            due = [self._timers.next_deadline()]
+            if due[0] is None:
+                due = []
+            if self._next_flush is not None:
+                due.append(self._next_flush)
+            wait = max(0.0, min(due) - time()) if due else None
+            ready = poller.poll(wait)
+            self._wake_pending = True
+            if wake_fd in ready:
+                self._drain_wakes()
+            if server_fd in ready:
+                self._drain_datagrams()
+            self._timers.advance()
+            self._wake_pending = False
+            blocked = not self._flush_outgoing()
+            poller.watch(server_fd, writable = blocked)
+            if self._shutting_down.is_set() and not blocked:
+                return # we only exit when we are done sending
+
+    def _drain_wakes(self):
+        """ This reads (and discards) every wake datagram. """
+        while True:
+            try:
+                self._wake_socket.recv(MAX_PACKET_SIZE)
+            except socket_error:
+                return
+
+    def _drain_datagrams(self):
+        """ This reads datagrams until the socket has no more waiting. """
+        drained = 0
+        while drained < REACTOR_MAX_DRAIN:
+            datagrams = self._io.recv_many()
+            for raw_packet, client_address in datagrams:
+                self._handle_datagram(raw_packet, client_address)
+            if not datagrams:
+                return
+            drained += len(datagrams)
+
+    def _flush_outgoing(self):
+        """
+        This sends everything due from every connection, in batches (see
+        core.mmsg).  It returns False if the socket stopped taking data, the
+        rest then waits in _blocked until the socket is writable again.
+        """
+        datagrams = self._blocked
+        datagrams.extend(self._collect_outgoing(
+                                force = self._shutting_down.is_set()))
+        if not datagrams:
+            return True
+        sent = self._io.send_many(datagrams)
+        self._blocked = datagrams[sent:]
+        return not self._blocked
+
+    def _collect_outgoing(self, force=False):
+        """
+        This takes the queued packets (and ACKs) of every ready connection
+        that is due, clusters them and returns the encrypted datagrams as
+        (data, address) tuples.  A connection is due as its _flush_due says,
+        or if force is set (which also ignores shaping).  Those not yet due,
+        and those whose shaping held packets back, stay in the ready set, and
+        this sets _next_flush to when the first of them will be due.  (A
+        connection that was disconnected since it became ready is still
+        flushed, so its Disconnect goes out.)
+        """
+        flush_time = time()
+        self._next_flush = None
+        conns, raws, datagrams = [], [], []
+        waiting = [] # ready connections that aren't due yet
+        for n in xrange(len(self._ready)):
+            conn = self._ready.popleft()
+            # (cleared first: anything queued from here on, either we take
+            # it below or it marks conn ready again, see _make_ready)
+            conn._ready = False
+            due = conn._flush_due(self._cluster_delay, self._ack_delay)
+            if due is None:
+                continue # (it was in the ready set twice)
+            if not force and flush_time < due:
+                if self._next_flush is None or due < self._next_flush:
+                    self._next_flush = due
+                conn._ready = True
+                waiting.append(conn)
                 continue
-            # we only lock the connections dictionary when we add a new one.
-            # fetching from the dict, unlike adding, is atomic and threadsafe
-            if client_address not in self._connections:
-                with self._connections_lock:
-                    conn = self._connections[client_address] = \
-                                            CoreConnection(client_address,self)
+            address = conn.address
+            queued = conn._take_acks() + \
+                        conn._take_outgoing(flush_time, shaped = not force)
+            # the ConnectResponse must go out alone and unencrypted
+            connect_responses = [raw for raw in queued
+                        if raw[:2] == '\x00' + packet.ConnectResponse._id]
+            if connect_responses:
+                datagrams.extend((raw, address) for raw in connect_responses)
+                queued = [raw for raw in queued if raw not in connect_responses]
+            clustered = self._cluster(queued)
+            conn._sent_packet_count += len(connect_responses) + len(clustered)
+            for raw in clustered:
+                if conn._enc is None:
+                    datagrams.append((raw, address))
+                else:
+                    conns.append(conn)
+                    raws.append(raw)
+            if conn._out_since is not None and not conn._ready:
+                # shaping held some back (or more was queued meanwhile)
+                self.shaped_flushes += 1
+                due = conn._flush_due(self._cluster_delay, self._ack_delay)
+                if self._next_flush is None or due < self._next_flush:
+                    self._next_flush = due
+                conn._ready = True
+                waiting.append(conn)
+        self._ready.extend(waiting)
+        datagrams.extend(zip(_encrypt_for_many(conns, raws),
+                             [conn.address for conn in conns]))
+        return datagrams
+
+    def _cluster(self, raws):
+        """
+        This packs a connection's queued packets (in order) into as few
+        datagrams as it can (see packet.cluster_groups), and counts how much
+        that saved.
+        """
+        datagrams = []
+        for group in packet.cluster_groups(raws, MAX_PACKET_SIZE):
+            datagrams.append(packet.cluster_raw(group))
+            if len(group) > 1:
+                self.clustered_packets += len(group)
+                self.datagrams_saved += len(group) - 1
+                self.bytes_saved += UDP_IP_HEADER_SIZE * (len(group) - 1) \
+                                        - 2 - len(group)
+        return datagrams
+
+class _Poller:
+    """
+    This is the little bit of a selector that the reactor needs (python 2 has
+    no selectors module).  It uses epoll where there is one (Linux) and falls
+    back to select everywhere else.  Every watched fd is watched for reading,
+    and optionally for writing too.
+    """
+
+    def __init__(self):
+        self._epoll = epoll() if epoll is not None else None
+        self._readers = set()
+        self._writers = set()
+
+    def watch(self, fd, writable=False):
+        """ This (re)registers fd, it only touches epoll if things change. """
+        if fd in self._readers and writable == (fd in self._writers):
+            return
+        if self._epoll is not None:
+            events = EPOLLIN | (EPOLLOUT if writable else 0)
+            if fd in self._readers:
+                self._epoll.modify(fd, events)
             else:
-                conn = self._connections[client_address]
-            try:
-                conn.receive_incoming_packet(raw_packet)
-            except Exception as err:
-                warn("error receiving incoming packet %s" % 
-                        ' '.join([x.encode("hex") for x in raw_packet]))
-                warn("%s" % err)
-
-    def _reliable_resend_loop(self):
-        """ This checks each connection for reliable packets to resend. """ 
-        while not self._shutting_down.is_set():
-            with self._connections_lock:
-                conns = self._connections.values()
-            for conn in conns:
-                conn.check_reliable_resend()
-            sleep(1.0)
+                self._epoll.register(fd, events)
+        self._readers.add(fd)
+        if writable:
+            self._writers.add(fd)
+        else:
+            self._writers.discard(fd)
 
-class CoreConnection:
+    def poll(self, timeout=None):
+        """ This returns the set of ready fds, waiting at most timeout. """
+        try:
+            if self._epoll is not None:
+                return set(fd for fd, events in 
+                        self._epoll.poll(-1 if timeout is None else timeout))
+            rs, ws, _ = select(self._readers, self._writers, [], timeout)
+            return set(rs) | set(ws)
+        except (IOError, select_error) as err:
+            if err.args[0] == EINTR:
+                return set()
+            raise
+
+class CoreConnection(object):
     """
     This is a single client connected to the server.  It is made unique by the
     client_address tuple (ip, port).  It provides the methods for interacting
@@ -192,60 +674,98 @@ class CoreConnection:
         2. receive_incoming_packet -- which accepts and processes a packet, and
         3. check_reliable_resend -- which resends any unacknowledged reliables
         
-    When a packet is sent (.send()) it is encrypted and added to the
-    server's outgoing queue.  If it is a reliable send, then it is wrapped as
-    such before encryption.
+    When a packet is sent (.send()) it is added to one of three lanes of
+    this connection's outbox, to be encrypted when the server flushes it.  If
+    it is a reliable send, then it is wrapped as such first.  The lanes are
+    flushed in order:
+        1. control -- core packets, including every reliable (e.g. chat),
+        2. latest -- unreliable packets of which only the latest matters,
+           e.g. positions.  An unsent one is replaced by a newer one with
+           the same key (see packet.Packet.latest_key), so a slow client
+           gets the newest state rather than a stale backlog, and
+        3. events -- other unreliable packets (e.g. weapons).
+    The latest lane goes before the events, which may have been queued
+    after it, so that a player's position never arrives after a newer event
+    of theirs.
     
     When a packet is received (.receive_incoming_packet()) it is decrypted and
     then processed.  If it is a core packet, it is handled internally.  If it
     is a game packet, then it is added to the server's incoming queue and
     tagged as coming from this client's address.
     
-    When .check_reliable_resend() is invoked, it cycles through the list of
-    reliable packets previously sent and checks whether they have timed out 
-    (i.e. if the client has not acknowledged receipt).  Any that have so 
-    expired are resent.  NOTE: .check_reliable_resend() is threadsafe 
+    When .check_reliable_resend() is invoked, it resends the reliable packets
+    previously sent that have timed out (i.e. if the client has not
+    acknowledged receipt).  A server timer invokes it when the earliest one
+    is due (see _arm_resend).  NOTE: .check_reliable_resend() is threadsafe
     vis-a-vis .send().  
+
+    A server may hold many thousands of these (e.g. under a ping flood), so
+    they're kept small: slots instead of a __dict__, one dispatch table for
+    every connection (_handlers), and the chunk and stream buffers are only
+    made for the connections that use them.
     """
+    __slots__ = ("address", "server", "_out", "_events", "_latest",
+                 "_out_since", "_ready", "_acks", "_acks_since",
+                 "_reliable_in", "_reliable_out", "_reliable_out_lock",
+                 "_resend_timer", "_resend_due", "rtt", "clock", "_chunks",
+                 "_streams_out", "_stream_in", "_sent_packet_count",
+                 "_received_packet_count", "dropped_in", "_last_received",
+                 "_idle_timer", "_enc", "_client_key", "_server_key",
+                 "_shaper", "_sync_counts")
     
     def __init__(self, client_address, server):
         self.address = client_address
         self.server = server
-        self._out = Queue(QUEUE_SIZE_OUT)
+        # the outbox, raw (unencrypted) outgoing data in 3 lanes
+        self._out = deque() # the control lane, core packets and reliables
+        self._events = deque() # the events lane, other unreliable packets
+        self._latest = {} # the latest lane, {latest_key:raw}
+        self._out_since = None # when the oldest data in _out was queued
+        self._ready = False # whether this is in the server's ready set
+        self._acks = [] # seqs of received reliables still to acknowledge
+        self._acks_since = None # when the oldest of those was received
         # added to by _handle_reliable, removed from by _process_any_reliable
-        self._reliable_in = [] 
-        self._reliable_in_seq = 0
+        self._reliable_in = ReliableIn()
         # for outgoing reliable packets, reliable_out is locked by 3 methods: 
         # 1:send (if reliable)   -- to add unacknowledged reliable packets
         # 2:_handle_reliable_ack -- to remove now-acknowledged reliable packets
-        # 3:_reliable_loop       -- to resend unacknowledged rel packets
-        self._reliable_out = []
+        # 3:check_reliable_resend -- to resend unacknowledged rel packets
+        # (it also guards _acks, which the receiving thread adds to and the
+        # sending thread empties, see _queue_ack and _take_acks)
+        self._reliable_out = ReliableOut()
         self._reliable_out_lock = RLock()
-        self._reliable_out_seq = 0
-        # payload accumulates in _handle_chunk and _handle_chunk_tail
-        self._chunks = [] 
+        self._resend_timer = None # invokes check_reliable_resend when due
+        self._resend_due = None # when _resend_timer is set to fire
+        # the measured round trip time sets how long we wait to resend
+        self.rtt = RTTEstimator()
+        # the Syncs and SyncResponses relate the client's clock to ours
+        self.clock = ClockSync()
+        # payload accumulates in _handle_chunk and _handle_chunk_tail, in a
+        # ChunkBuffer made by the first Chunk
+        self._chunks = None
+        # streams go out (and come in) with these, see core.chunk, they're
+        # made by the first send_stream (and StreamRequest)
+        self._streams_out = None
+        self._stream_in = None
         self._sent_packet_count = 0
         self._received_packet_count = 0
-        self._socket = None
-        # this is properly initialized during self._connect (after we receive
-        # the server's encryption key).
+        self.dropped_in = 0 # packets dropped with ingress_cap waiting
+        self._last_received = time() # (so idle since then, see _check_idle)
+        self._idle_timer = None
+        if server._idle_timeout:
+            self._idle_timer = server._call_later(server._idle_timeout / 2,
+                                                  self._check_idle)
+        # these are properly initialized during self._handle_connect (after we
+        # receive the client's encryption key).
         self._enc = None
-        # core packets begin with 0x00. the next byte, packet[1], is the key 
-        # into this dispatch table.  see _process_core_packet
-        self._handlers = {
-            # Connect & ConnectResponse are already handled
-            packet.Connect._id             : self._handle_connect,
-            packet.Reliable._id            : self._handle_reliable,
-            packet.ReliableACK._id         : self._handle_reliable_ack,
-            packet.Sync._id                : self._handle_sync,
-            packet.SyncResponse._id        : self._handle_sync_response,
-            packet.Disconnect._id          : self._handle_disconnect,
-            packet.Chunk._id               : self._handle_chunk,
-            packet.ChunkTail._id           : self._handle_chunk_tail,
-            packet.StreamRequest._id       : self._handle_stream_request,
-            packet.StreamCancelRequest._id : self._handle_stream_cancel_request,
-            packet.Cluster._id             : self._handle_cluster,
-            }
+        self._client_key = None
+        self._server_key = None
+        # with the server's send_rate, this shapes the events and latest lanes
+        self._shaper = None
+        if server._send_rate:
+            self._shaper = TokenBucket(server._send_rate,
+                                       server._send_rate * SHAPING_BURST)
+        self._sync_counts = None # (sent, client's received) at its last Sync
 
     def send(self, outgoing_packet, reliable=False):
         """ 
@@ -253,88 +773,292 @@ class CoreConnection:
         It adds the packet to the outgoing queue and immediately returns.
         NOTE: packet is not raw data, it is a packet class having member .raw()
         """
+        self._queue_outgoing(outgoing_packet,
+                             self._outgoing_raw(outgoing_packet, reliable))
+
+    def _outgoing_raw(self, outgoing_packet, reliable):
+        """
+        This returns the raw data to send for the packet.  If it is a reliable
+        send, then it is wrapped as such (and tracked for resending) first.
+        This returns None for a reliable that must wait in the backlog for
+        room in the window, it is sent when ACKs release it.
+        """
         if reliable:
-            p = packet.Reliable(seq=self._reliable_out_seq)
-            p.tail = outgoing_packet.raw()
-            self._reliable_out_seq += 1
-            p._last_send_time = time()
             with self._reliable_out_lock:
-                self._reliable_out.append(p)
-            outgoing_packet = p
-        outgoing_packet._encrypted = \
-                            self._encrypt_packet(outgoing_packet.raw())
-        try:
-            self._out.put(outgoing_packet,False)
-        except Full:
-            warn("outgoing queue full, discarding packet:\n %s"\
-                                     % outgoing_packet)
+                outgoing_packet = self._reliable_out.add(outgoing_packet.raw(),
+                                        time(), self.rtt.timeout())
+                self._arm_resend()
+            if outgoing_packet is None:
+                return None
+        return outgoing_packet.raw()
+
+    def _queue_outgoing(self, outgoing_packet, raw):
+        """
+        This adds the raw data to its lane of the outbox (see the class doc).
+        It is clustered and encrypted when the server flushes the outbox (see
+        Server._collect_outgoing).  A raw of None (a backlogged reliable) is
+        skipped.
+        """
+        if raw is None:
+            return
+        if raw[0] == '\x00':
+            lane = self._out
+        else:
+            lane = self._events
+            key = outgoing_packet.latest_key()
+            if key is not None:
+                if key in self._latest:
+                    self.server.coalesced_packets += 1
+                self._latest[key] = raw
+                lane = None
+        if lane is not None:
+            if len(lane) >= QUEUE_SIZE_OUT:
+                warn("outgoing queue full, discarding packet:\n %s"\
+                                         % outgoing_packet)
+                return
+            lane.append(raw)
+        sooner = self._out_since is None
+        if sooner:
+            self._out_since = time()
+        self._make_ready(sooner)
+
+    def _make_ready(self, sooner=False):
+        """
+        This puts this connection in the server's ready set (once).  If it is
+        already there, waiting to fall due, and sooner is set (something new
+        started waiting) the server is woken anyway, since this connection
+        may now be due before the flush it was waiting for.
+        """
+        if not self._ready:
+            self._ready = True
+            self.server._mark_ready(self)
+        elif sooner:
+            self.server._output_ready()
 
-    def send_chunked(self, outgoing_packet):
+    def _queue_ack(self, seq):
+        """
+        This holds the ReliableACK for seq until the server next flushes this
+        connection, so that ACKs for a burst of reliables (and any reply to
+        them) share one datagram.  It waits at most the server's ack_delay.
+        """
+        with self._reliable_out_lock: # (the sending thread takes them)
+            if seq not in self._acks:
+                self._acks.append(seq)
+            first = self._acks_since is None
+            if first:
+                self._acks_since = time()
+        if first:
+            self._make_ready(sooner=True)
+
+    def _take_acks(self):
+        """ This empties the held ACKs, returning their raw ReliableACKs. """
+        with self._reliable_out_lock:
+            self._acks_since = None
+            acks, self._acks = self._acks, []
+        return [packet.ReliableACK(seq=seq).raw() for seq in acks]
+
+    def _take_outgoing(self, now, shaped=True):
+        """
+        This empties the outbox, returning its raw data, lane by lane.  If
+        this connection is shaped (and shaped is set), the latest and events
+        lanes are only taken while the bucket has tokens at now.  The control
+        lane is always taken whole, but it spends tokens too (never leaving
+        more than a burst of debt), so it delays the other lanes instead of
+        the other way around.  Whatever is left keeps its _out_since.
+        """
+        since, self._out_since = self._out_since, None
+        out, events, latest = self._out, self._events, self._latest
+        raws = [out.popleft() for n in xrange(len(out))]
+        shaper = self._shaper if shaped else None
+        if shaper is None:
+            # (popitem, so that a newer one set meanwhile is kept for next time)
+            raws.extend([latest.popitem()[1] for n in xrange(len(latest))])
+            raws.extend([events.popleft() for n in xrange(len(events))])
+            return raws
+        shaper.refill(now)
+        shaper.spend(sum(len(raw) for raw in raws))
+        shaper.tokens = max(shaper.tokens, -shaper.burst)
+        while latest and shaper.tokens > 0:
+            raws.append(latest.popitem()[1])
+            shaper.spend(len(raws[-1]))
+        while events and shaper.tokens > 0:
+            raws.append(events.popleft())
+            shaper.spend(len(raws[-1]))
+        if (latest or events) and self._out_since is None:
+            self._out_since = since
+        return raws
+
+    def _flush_due(self, cluster_delay, ack_delay):
+        """
+        This returns when the server should next flush this connection (or
+        None if there is nothing to send): once its oldest queued packet has
+        waited cluster_delay or its oldest ACK has waited ack_delay.  While
+        only the shaped lanes have packets, they also wait for tokens.
+        """
+        due = None
+        if self._out_since is not None:
+            due = self._out_since + cluster_delay
+            if self._shaper is not None and not self._out:
+                due = max(due, self._shaper.ready_at())
+        if self._acks_since is not None:
+            ack_due = self._acks_since + ack_delay
+            if due is None or ack_due < due:
+                due = ack_due
+        return due
+
+    def send_chunked(self, outgoing_packet, cache=False):
         """
         This sends a large packet to the client in reliable chunks.  It is 
-        used, for example, to send ArenaSettings.
+        used, for example, to send ArenaSettings.  With cache set, the raw
+        Chunks come from the server's chunk_cache, so only the Reliables are
+        new (for a packet sent to many clients, and never changed after).
         """
-        data = outgoing_packet.raw()
-        data_length = len(data)
-        if data_length < CHUNK_SIZE: # don't chunk it if we don't have to
+        if cache:
+            raws = self.server.chunk_cache.raws(outgoing_packet)
+        else:
+            data = outgoing_packet.raw()
+            raws = None
+            if len(data) >= CHUNK_SIZE:
+                raws = packet.chunk_raws(data, CHUNK_SIZE)
+        if raws is None: # don't chunk it if we don't have to
             self.send(outgoing_packet, reliable=True)
-        else: 
-            index = 0 # use index to avoid too many copies of the data
-            while data_length - index > CHUNK_SIZE:
-                p = packet.Chunk()
-                p.tail = data[index:index+CHUNK_SIZE]
-                index += CHUNK_SIZE
-                self.send(p, reliable=True)
-            p = packet.ChunkTail()
-            p.tail = data[index:]
-            self.send(p, reliable=True)  
+            return
+        # the raw chunks go straight into the window (see chunk.ChunkCache)
+        send_time = time()
+        with self._reliable_out_lock:
+            reliables = [self._reliable_out.add(raw, send_time,
+                                                self.rtt.timeout())
+                         for raw in raws]
+            self._arm_resend()
+        for p in reliables:
+            if p is not None: # (backlogged, an ACK will release it)
+                self._queue_outgoing(p, p.raw())
     
+    def send_stream(self, outgoing_packet, progress=None):
+        """
+        This streams a large packet (e.g. a map file) to the client, as
+        StreamRequest pieces that keep to a share of the reliable window (see
+        core.chunk).  It returns the chunk.StreamOut for the transfer, or None
+        if MAX_STREAMS transfers to the client are already queued.
+        """
+        with self._reliable_out_lock:
+            if self._streams_out is None:
+                self._streams_out = StreamSender(CHUNK_SIZE, MAX_STREAMS)
+            transfer = self._streams_out.add(outgoing_packet.raw(), progress)
+            if transfer is None:
+                warn("%s:%d has too many streams queued, refusing another" %
+                     self.address)
+                return None
+            reliables = self._streams_out.pump(self._reliable_out, time(),
+                                               self.rtt.timeout())
+            self._arm_resend()
+        for p in reliables:
+            self._queue_outgoing(p, p.raw())
+        return transfer
+
+    def cancel_stream(self, transfer=None):
+        """
+        This cancels the transfer (or every one) to the client.  If it had
+        begun, the client is told to discard it with a StreamCancelRequest.
+        """
+        with self._reliable_out_lock:
+            begun = self._streams_out is not None and \
+                        self._streams_out.cancel(transfer)
+        if begun:
+            self.send(packet.StreamCancelRequest(), reliable = True)
+
     def receive_incoming_packet(self, packet_data):
         """ 
         This should be called when we recv incoming packets.  It processes the
         packet which, in turn, passes it off to the appropriate handlers.  None
         of the processing or handling functions should block for long. 
         """
+        self._last_received = time()
         decrypted_data = self._decrypt_packet(packet_data)
         self._received_packet_count += 1
         self._process_packet(decrypted_data)
 
+    def _check_idle(self):
+        """
+        This is the idle timer.  Halfway to the server's idle_timeout without
+        hearing from the client, it sends a Sync as a keepalive (any reply,
+        e.g. the SyncResponse, resets the idle time).  At idle_timeout, the
+        server evicts the connection.
+        """
+        if self._idle_timer is False:
+            return # stopped
+        idle_timeout = self.server._idle_timeout
+        idle = time() - self._last_received
+        if idle >= idle_timeout:
+            self.server.evicted_idle += 1
+            self.server._evict(self)
+            return
+        if idle >= idle_timeout / 2:
+            if self._enc is not None:
+                self.send(packet.Sync(sender_time=now(),
+                                packets_sent=self._sent_packet_count,
+                                packets_received=self._received_packet_count))
+                self.server.keepalives_sent += 1
+            wait = idle_timeout - idle
+        else:
+            wait = idle_timeout / 2 - idle
+        self._idle_timer = self.server._call_later(wait, self._check_idle)
+
     def check_reliable_resend(self):
         """ 
         This should be called periodically to resend unacknowledged reliables.
         It is threadsafe vis-a-vis calls to receive_incoming_packet.
         """
+        resend_time = time()
         with self._reliable_out_lock:
-            for p in self._reliable_out:
-                if now() - p._last_send_time > RELIABLE_TIMEOUT_RESEND:
-                    # NOTE: resend must not be reliable else this will deadlock
-                    self.send(p,reliable=False)
-                    p._last_send_time = now()
+            self._resend_due = None # (the timer that called this is done)
+            for p in self._reliable_out.expired(resend_time):
+                # NOTE: resend must not be reliable else this will deadlock
+                self.send(p,reliable=False)
+                self._reliable_out.resent(p, resend_time,
+                                self.rtt.timeout(p._resends + 1))
+            self._arm_resend()
 
-    def _encrypt_packet(self, packet_data):
+    def _arm_resend(self):
         """
-        This doesn't encrypt the first byte of any packet.  And for core 
-        packets, it doesn't encrypt the first 2 bytes.
+        This makes sure that a timer will invoke check_reliable_resend when
+        the earliest unacknowledged reliable is due.  There is at most one
+        such timer per connection, it's only replaced by an earlier one.  (The
+        caller must hold _reliable_out_lock.)
         """
-        unencrypted_prefix_size = 1
-        if packet_data[0] == '\x00': # core packets have an extra byte prefix
-            unencrypted_prefix_size += 1
-        if self._enc is None: # before encryption is setup, don't
-            return packet_data
-        else:
-            encrypted_data = self._enc.encrypt(\
-                                    packet_data[unencrypted_prefix_size:])
-            if encrypted_data is None:
-                return None
-            else:
-                return packet_data[:unencrypted_prefix_size] + encrypted_data
+        due = self._reliable_out.next_due()
+        if due is None or self._resend_timer is False or \
+                (self._resend_due is not None and self._resend_due <= due):
+            return
+        if self._resend_due is not None:
+            self._resend_timer.cancel()
+        self._resend_due = due
+        self._resend_timer = self.server._call_later(max(0.0, due - time()),
+                                                     self.check_reliable_resend)
+
+    def _stop_timers(self):
+        """ This cancels this connection's timers, for good. """
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        self._idle_timer = False # (so _check_idle won't set another)
+        with self._reliable_out_lock:
+            if self._resend_due is not None:
+                self._resend_timer.cancel()
+            self._resend_due = None
+            self._resend_timer = False # (so _arm_resend won't set another)
 
     def _decrypt_packet(self, packet_data):
-        """ This doesn't decrypt certain leading bytes, as in _encrypt. """
+        """
+        This doesn't decrypt the first byte of any packet.  And for core
+        packets, it doesn't decrypt the first 2 bytes.  (Encryption is the
+        same, see _encrypt_for_many.)
+        """
         unencrypted_prefix_size = 1
         if packet_data[0] == '\x00': # core packets have an extra byte prefix
             unencrypted_prefix_size += 1
-        if self._enc is None:
+        # a (repeated) Connect is never encrypted, see _handle_connect
+        if self._enc is None or \
+                packet_data[:2] == '\x00' + packet.Connect._id:
             return packet_data
         else:
             decrypted_data = self._enc.decrypt(\
@@ -348,49 +1072,44 @@ class CoreConnection:
         """ This processes any core \x00 packets, and queues all others. """
         if packet_data[0] == '\x00':
             self._process_core_packet(packet_data)
-        else:
-            self.server._in.put((self.address,packet_data))
+        elif not self.server._deliver(self.address, packet_data):
+            self.dropped_in += 1
 
     def _process_core_packet(self, packet_data):
         """ This dispatches the core packet to the appropriate handler. """
-        core_id = packet_data[1]
-        if core_id in self._handlers:
-            self._handlers[core_id](packet_data)
+        handler = self._handlers[ord(packet_data[1])]
+        if handler is not None:
+            handler(self, packet_data)
         else:
-            warn("unhandled core packet id=%s" % core_id.encode("hex"))
+            warn("unhandled core packet id=%s" % packet_data[1].encode("hex"))
 
     def _process_any_reliables(self):
         """ 
-        This goes through the list of received reliable packets and processes
-        any that are now ready to be processed.  
-        
-        self._reliable_in is the list, it contains packet.Reliable items.
-        self._reliable_in_seq is the next id to be processed.
-        It is incremented as the packets are processed.
-        
-        The actual contents of each reliable packet is retrieved by calling the
-        instance member .tail() on the packet.
-
+        This processes, in order, the received reliable packets that are now
+        ready to be processed (see reliable.ReliableIn), acknowledging each.
         If nothing is ready for processing, this function does nothing.
-        Also, we might squeeze some performance with bisect instead of sort
         """
-        self._reliable_in.sort(key=lambda x: x.seq)
-        while len(self._reliable_in) > 0 and \
-                self._reliable_in[0].seq == self._reliable_in_seq:
-            p = self._reliable_in.pop(0)
+        for p in self._reliable_in.deliverable():
             self._process_packet(p.tail)
-            self.send(packet.ReliableACK(seq=self._reliable_in_seq))
-            self._reliable_in_seq += 1
+            self._queue_ack(p.seq)
 
     def _handle_connect(self, raw_data):
         """
         This receives the incoming Connect packet.  It responds with the
         ConnectReponse.
+
+        The server key (and its prebuilt table) comes from the shared
+        key_tables pool, so this is only a queue fetch and a dict store.  If
+        the client repeats its Connect (e.g. our response was lost), it gets
+        the same server key again so both ends keep using the same table.
         """
         p = packet.Connect(raw_data)
-        server_key = p.key # this, in essence, disables encryption
-        self.send(packet.ConnectResponse(server_key=server_key))
-        self._enc = VIE(p.key,server_key)
+        if self._enc is None or p.key != self._client_key:
+            self._client_key = p.key
+            self._server_key, table = key_tables.fresh(exclude=p.key)
+            self._enc = VIE(p.key, self._server_key, table)
+        # (the server knows to send the ConnectResponse unencrypted)
+        self.send(packet.ConnectResponse(server_key=self._server_key))
  
 #    for clients (the only ones who will ever receive this packet) the socket
 #    has already undergone the connect/response exchange.  so we don't need to
@@ -406,40 +1125,100 @@ class CoreConnection:
         packets that are newly ripe for processing.
         """
         p = packet.Reliable(raw_data)
-        if p.seq < self._reliable_in_seq: # we already got this, re-ACK
-            self.send(packet.ReliableACK(seq=self._reliable_in_seq))
-        else:
-            self._reliable_in.append(p)
+        if p.seq < self._reliable_in.next_seq: # we already got this, re-ACK
+            self._queue_ack(p.seq)
+        elif self._reliable_in.add(p):
             self._process_any_reliables()
+        else:
+            warn("incoming reliable too far ahead, dropping seq=%d (next=%d)" %
+                    (p.seq, self._reliable_in.next_seq))
         if len(self._reliable_in) > 30:
-            warn("outgoing reliable queue getting large seq=%d,size=%d" % \
-                  (self._reliable_in_seq,len(self._reliable_in)))
+            warn("incoming reliable queue getting large seq=%d,size=%d" % \
+                  (self._reliable_in.next_seq,len(self._reliable_in)))
 
     def _handle_reliable_ack(self, raw_data):
         """
         This Handles incoming ACKs for reliable packets we earlier sent. This
         ensures we stop waiting for acknowledgements about packets that we now
         know have been received.  An ACK operates to acknowledge every seq <= 
-        that seq.
+        that seq.  The ACK's own Reliable, if it was sent just once, gives an
+        RTT sample.  The room it makes in the window releases any backlogged
+        reliables.
         """
         p = packet.ReliableACK(raw_data)
+        ack_time = time()
         with self._reliable_out_lock:
-            if p.seq < self._reliable_out_seq:
-                for out_p in self._reliable_out:
-                    if out_p.seq <= p.seq:
-                        self._reliable_out.remove(out_p)
+            acked = self._reliable_out.ack(p.seq)
+            if acked and acked[-1].seq == p.seq and acked[-1]._resends == 0:
+                self.rtt.sample(ack_time - acked[-1]._sent_time)
+            released = self._reliable_out.released(ack_time, self.rtt.timeout())
+            progressed = []
+            if self._streams_out:
+                progressed = self._streams_out.acked(p.seq)
+                released.extend(self._streams_out.pump(self._reliable_out,
+                                            ack_time, self.rtt.timeout()))
+            self._arm_resend()
+        for released_p in released:
+            self._queue_outgoing(released_p, released_p.raw())
+        for transfer in progressed:
+            transfer.report()
                                            
     def _handle_sync(self, raw_packet):
         """ This receives the Sync packet and responds with a SyncResponse. """
         p = packet.Sync(raw_packet)
+        received = now()
         sync_resp = packet.SyncResponse(remote_time=p.sender_time,
-                                        sender_time=now())
+                                        sender_time=received)
         self.send(sync_resp)
+        # it was sent about half an RTT ago (50 ticks per second of RTT)
+        delay = self.rtt.srtt * 50 if self.rtt.srtt is not None else 0
+        self.clock.sample(received, p.sender_time, delay)
+        if self._shaper is not None and self.server._adaptive_send_rate:
+            self._adapt_send_rate(p.packets_received)
+
+    def _adapt_send_rate(self, packets_received):
+        """
+        This adjusts the shaped rate by the loss the client's Sync reports,
+        i.e. the share of the datagrams sent since its last Sync that it
+        didn't receive.  Like the reliable window, it is AIMD: loss above
+        SHAPING_LOSS_HIGH cuts the rate by a quarter (to no less than
+        MIN_SEND_RATE), and loss below SHAPING_LOSS_LOW raises it by a tenth
+        of the server's send_rate (to no more than that).
+        """
+        last = self._sync_counts
+        if last is None:
+            self._sync_counts = (self._sent_packet_count, packets_received)
+            return
+        sent = self._sent_packet_count - last[0]
+        if sent < SHAPING_MIN_SAMPLE:
+            return # (it's judged at a later Sync, with more)
+        self._sync_counts = (self._sent_packet_count, packets_received)
+        received = (packets_received - last[1]) % 0x100000000
+        loss = 1.0 - float(received) / sent
+        shaper, send_rate = self._shaper, self.server._send_rate
+        if loss > SHAPING_LOSS_HIGH:
+            rate = max(min(MIN_SEND_RATE, send_rate), shaper.rate * 0.75)
+            if rate < shaper.rate:
+                self.server.send_rate_cuts += 1
+        elif loss < SHAPING_LOSS_LOW:
+            rate = min(send_rate, shaper.rate + send_rate * 0.1)
+        else:
+            return
+        shaper.rate, shaper.burst = rate, rate * SHAPING_BURST
 
     def _handle_sync_response(self, raw_packet):
-        """ This receives SyncResponses to our earlier Sync requests. """
+        """
+        This receives SyncResponses to our earlier Sync requests.  The time
+        since the Sync that it repeats back is an RTT sample (if it isn't
+        from an old Sync), and a sample of the client's clock.
+        """
         p = packet.SyncResponse(raw_packet)
-        # TODO: store or do something to synchronize
+        received = now()
+        rtt = tick_diff(received, p.remote_time) / 100.0 # centiseconds
+        if 0 <= rtt < SYNC_PERIOD:
+            self.rtt.sample(rtt)
+            self.clock.sample_round_trip(p.remote_time, p.sender_time,
+                                         received)
 
     def _handle_disconnect(self, raw_packet):
         """ 
@@ -450,46 +1229,105 @@ class CoreConnection:
         p = packet.Disconnect(raw_packet)
         # this tosses a "None" to anything recv'ing to let them know that we
         # were disconnected in the core.
-        self.server._in.put((self.address,None))
+        self.server._deliver(self.address, None)
         self.server.disconnect(self.address,
                     notify=False) # they sent Disconnect, so no need to notify
 
     def _handle_chunk(self, raw_packet):
-        """ This handles accumulating chunks. """
-        p = packet.Chunk(raw_packet)
-        # TODO: should probably do some checks to avoid an unending chunk
-        self._chunks.append(p.tail)
+        """
+        This handles accumulating chunks.  A client whose chunks overflow the
+        server's max_chunked_size is evicted.
+        """
+        if self._chunks is None:
+            self._chunks = ChunkBuffer(self.server._max_chunked_size)
+        if not self._chunks.add(raw_packet, 2): # (past \x00\x08)
+            warn("chunks from %s:%d overflowed, evicting" % self.address)
+            self.server.evicted_chunks += 1
+            self.server._evict(self)
 
     def _handle_chunk_tail(self, raw_packet):
         """ 
         This takes the accumulated chunks, adds this last one, and processes
         the content as a single packet.
         """ 
-        p = packet.ChunkTail(raw_packet)
-        self._chunks.append(p.tail)
-        all_chunks = ''.join(self._chunks)
-        self._process_packet(all_chunks)
-        self._chunks = []
+        self._handle_chunk(raw_packet) # (\x00\x09 is as long as \x00\x08)
+        if len(self._chunks):
+            self._process_packet(self._chunks.take())
     
     def _handle_stream_request(self, raw_packet):
-        p = packet.StreamRequest(raw_packet)
-        # TODO: handle stream requests (must investigate first)
-        debug("got stream request: %s" % p)
+        """
+        This adds a piece of the client's stream, and processes the whole
+        once it's in.  A client streaming more than the server's
+        max_chunked_size is evicted.
+        """
+        if self._stream_in is None:
+            self._stream_in = StreamReceiver(self.server._max_chunked_size)
+        whole = self._stream_in.add(raw_packet)
+        if whole is False:
+            warn("stream from %s:%d overflowed, evicting" % self.address)
+            self.server.evicted_chunks += 1
+            self.server._evict(self)
+        elif whole:
+            self._process_packet(whole)
     
     def _handle_stream_cancel_request(self, raw_packet):
-        p = packet.StreamCancelRequest(raw_packet)
+        """
+        This cancels the streams either way (there are no stream ids), and
+        acknowledges it.  Pieces of ours already in flight still arrive, but
+        before our ACK, so the client knows to drop them.
+        """
         debug("got stream cancel request, acknowledging")
+        with self._reliable_out_lock:
+            if self._streams_out is not None:
+                self._streams_out.cancel()
+        if self._stream_in is not None:
+            self._stream_in.clear()
         self.send(packet.StreamCancelRequestACK(), reliable = True)
+
+    def _handle_stream_cancel_request_ack(self, raw_packet):
+        """ This ends the dropping of stale pieces after a cancel. """
+        if self._stream_in is not None:
+            self._stream_in.cancelling = False
     
     def _handle_cluster(self, raw_packet):
         """ This takes a cluster and processes the packets inside. """
-        p = packet.Cluster(raw_packet)
-        d = p.tail
-        while len(d) > 0:
-            size = ord(d[0])
-            if len(d) > size:
-                self._process_packet(d[1:size+1]) 
-            d = d[size+1:]
+        for raw in packet.cluster_parts(raw_packet, 2): # (past \x00\x0E)
+            self._process_packet(raw)
+
+    # core packets begin with 0x00, the next byte (packet[1]) indexes this
+    # dispatch table of unbound handlers, see _process_core_packet
+    _handlers = [None] * 256
+    for core_id, handler in [
+            # Connect & ConnectResponse are already handled
+            (packet.Connect._id,               _handle_connect),
+            (packet.Reliable._id,              _handle_reliable),
+            (packet.ReliableACK._id,           _handle_reliable_ack),
+            (packet.Sync._id,                  _handle_sync),
+            (packet.SyncResponse._id,          _handle_sync_response),
+            (packet.Disconnect._id,            _handle_disconnect),
+            (packet.Chunk._id,                 _handle_chunk),
+            (packet.ChunkTail._id,             _handle_chunk_tail),
+            (packet.StreamRequest._id,         _handle_stream_request),
+            (packet.StreamCancelRequest._id,   _handle_stream_cancel_request),
+            (packet.StreamCancelRequestACK._id,
+                                        _handle_stream_cancel_request_ack),
+            (packet.Cluster._id,               _handle_cluster),
+            ]:
+        _handlers[ord(core_id)] = handler
+    _handlers = tuple(_handlers)
+    del core_id, handler
+
+def _encrypt_for_many(conns, raws):
+    """
+    This encrypts raw data for many connections at once.  raws[i] is the raw
+    data for conns[i].  The unencrypted prefix of each (the first byte, or
+    first 2 bytes for core packets) is split off, and all the rest is
+    encrypted in one encrypt_many pass.
+    """
+    prefix_sizes = [2 if raw[0] == '\x00' else 1 for raw in raws]
+    encrypted = encrypt_many([conn._enc for conn in conns],
+                             [raw[n:] for raw, n in zip(raws, prefix_sizes)])
+    return [raw[:n] + e for raw, n, e in zip(raws, prefix_sizes, encrypted)]
 
 def main():
     import logging
@@ -0,0 +1,340 @@
+"""
+This spreads one core server address over several worker processes.
+
+One python process (with its one GIL) caps how many packets a core server can
+decrypt, acknowledge and reassemble.  A ShardedServer instead starts N worker
+processes which each bind the same address with SO_REUSEPORT (Linux 3.9+).
+The kernel hashes each client's (ip, port) 4-tuple to one of those sockets,
+so a client always lands on the same worker.  Each worker runs an ordinary
+core.server.Server and so owns its clients' CoreConnections: encryption,
+reliables, chunks, clusters and syncs never leave the worker.
+
+Only decoded (non-core) packets cross processes.  Workers forward them, in
+batches, to the process that created the ShardedServer; for a Zone, that is
+the process that owns the arenas.  With each batch go the clock estimates
+(see core.clock) that changed since the last, for clock().  Packets sent
+from there are routed back to whichever worker owns the recipient's
+connection.  So a ShardedServer offers the same API as a Server:
+
+    s = ShardedServer(("", 5000), workers=4)
+    address, raw_packet = s.recv()
+    s.send(address, some_packet, reliable=True)
+
+Run this module to measure packets per second as the worker count grows.
+"""
+from subspace.core import packet
+from subspace.core.server import Server
+from subspace.core.ingress import FairQueue, INGRESS_CAP, DROP_NEWEST
+from subspace.core.clock import ClockSync
+from multiprocessing import Process, Queue as ProcessQueue
+from threading import Thread, Event
+from Queue import Empty
+from logging import warn, info, debug
+
+FORWARD_BATCH = 64 # the most packets a worker forwards in one message
+READY_TIMEOUT = 5.0 # seconds to wait for the workers to bind
+
+class ShardedServer:
+    """
+    This is core.server.Server spread over worker processes.
+
+    The workers are started (and have bound the address) by the time this
+    returns.  Options other than workers are passed through to each worker's
+    Server, e.g. reactor or batched_io.  The address must have a fixed port.
+    The forwarded packets wait for recv() in a FairQueue of this process's
+    own (with the same ingress_cap and ingress_drop as the workers').  Of
+    Server's API, it offers what the game server uses: send, send_to_many,
+    send_chunked, forget_chunked, send_stream, clock, recv, disconnect and
+    shutdown.  The per connection stats (rtt, dropped_in, send_rate,
+    reliable_stats) and cancel_stream stay in the workers.
+    """
+
+    def __init__(self, address, workers=2, **options):
+        self.address = address
+        self.ingress = FairQueue(options.get("ingress_cap", INGRESS_CAP),
+                                 options.get("ingress_drop", DROP_NEWEST))
+        self._owners = {} # {client_address:index of the worker that owns it}
+        self._clocks = {} # {client_address:ClockSync, as forwarded}
+        # (index, [(address, packet), ...], [(address, clock estimate), ...])
+        self._results = ProcessQueue()
+        self._commands = [ProcessQueue() for n in range(workers)]
+        self._workers = [Process(target=_worker_main,
+                                 name="Server:Core:worker%d" % n,
+                                 args=(n, address, options,
+                                       self._commands[n], self._results))
+                         for n in range(workers)]
+        # this is just for seeing how evenly the kernel spreads clients
+        self.packet_counts = [0] * workers # packets forwarded by each worker
+        self._shutting_down = Event() # this is set to tell the threads to end
+        self._threads = {
+            "collect" : Thread(target=self._collecting_loop,
+                               name="Server:Core:collect"),
+            }
+        info("starting core server %s" % self)
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        for n in range(workers):
+            index, ready, clocks = self._results.get(True, READY_TIMEOUT)
+        for thread_name,thread in self._threads.iteritems():
+            thread.start()
+
+    def __str__(self):
+        return "Core:ShardedServer(%s:%d, workers=%d)" % \
+                (self.address + (len(self._workers),))
+
+    def send(self, address, packet, reliable = False):
+        index = self._owners.get(address)
+        if index is None:
+            return False
+        self._commands[index].put(("send", address, packet.raw(), reliable,
+                                   packet.latest_key()))
+        return True
+
+    def send_to_many(self, addresses, packet, reliable = False):
+        """
+        This packs the packet once and sends each worker one command with the
+        addresses it owns, so each worker still encrypts in one pass.
+        """
+        raw_packet = packet.raw()
+        by_worker = {}
+        for address in addresses:
+            index = self._owners.get(address)
+            if index is not None:
+                by_worker.setdefault(index, []).append(address)
+        for index, owned in by_worker.iteritems():
+            self._commands[index].put(("many", owned, raw_packet, reliable,
+                                       packet.latest_key()))
+
+    def send_chunked(self, address, packet, cache=False):
+        index = self._owners.get(address)
+        if index is None:
+            return False
+        self._commands[index].put(("chunked", address, packet.raw(), cache))
+        return True
+
+    def forget_chunked(self, packet):
+        """ This is Server.forget_chunked, done by every worker. """
+        for commands in self._commands:
+            commands.put(("forget", packet.raw()))
+
+    def send_stream(self, address, packet, progress=None):
+        """
+        This is Server.send_stream, done by the owning worker.  The transfer
+        stays in that process, so this returns True (or False if address
+        isn't connected) rather than a StreamOut, and progress isn't called.
+        """
+        index = self._owners.get(address)
+        if index is None:
+            return False
+        self._commands[index].put(("stream", address, packet.raw()))
+        return True
+
+    def clock(self, address):
+        """
+        This is Server.clock, from the estimates the workers forward.  It is
+        a copy, as of the owning worker's latest batch.
+        """
+        return self._clocks.get(address)
+
+    def recv(self, timeout=None):
+        """ This is Server.recv, for packets from every worker. """
+        return self.ingress.get(timeout)
+
+    def disconnect(self, address, notify=True):
+        """ This is Server.disconnect, done by the owning worker. """
+        index = self._owners.pop(address, None)
+        if index is not None:
+            self._commands[index].put(("disconnect", address, notify))
+
+    def shutdown(self):
+        """ This shuts down every worker and waits for them to exit. """
+        debug("shutting down core server")
+        self._shutting_down.set()
+        for commands in self._commands:
+            commands.put(("shutdown",))
+        for worker in self._workers:
+            worker.join(5.0) # give it 5s, it has its own Server to shut down
+        for thread_name,thread in self._threads.iteritems():
+            thread.join(3.0) # give it 3s to join
+
+    def _collecting_loop(self):
+        """ This queues the packets forwarded by the workers for recv(). """
+        while not self._shutting_down.is_set():
+            try:
+                index, forwarded, clocks = self._results.get(True, 1.0)
+            except Empty:
+                continue
+            self.packet_counts[index] += len(forwarded)
+            for address, estimate in clocks:
+                clock = self._clocks.get(address)
+                if clock is None:
+                    clock = self._clocks[address] = ClockSync()
+                clock.set_estimate(estimate)
+            for address, packet_data in forwarded:
+                # the core spits out None to signal disconnect
+                if packet_data is None:
+                    self._owners.pop(address, None)
+                    self._clocks.pop(address, None)
+                else:
+                    self._owners[address] = index
+                self.ingress.put(address, packet_data)
+
+class _Forwarded(packet.Packet):
+    """ This is a packet sent from the ShardedServer, already packed. """
+    _id = ''
+    _latest_key = None # the original packet's latest_key()
+
+    def latest_key(self):
+        return self._latest_key
+
+    # they are equal by their data, so a packet sent chunked again (as a new
+    # _Forwarded) finds its chunks in the worker's chunk_cache
+    def __eq__(self, other):
+        return isinstance(other, _Forwarded) and self.tail == other.tail
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.tail)
+
+def _worker_main(index, address, options, commands, results):
+    """ This runs a worker: one Server, forwarding and taking commands. """
+    server = Server(address, reuse_port=True, **options)
+    results.put((index, [], [])) # we're bound and ready
+    stopping = Event()
+    forwarder = Thread(target=_forwarding_loop,
+                       args=(index, server, results, stopping),
+                       name="Server:Core:forward")
+    forwarder.start()
+    while True:
+        command = commands.get()
+        if command[0] == "send":
+            address, raw_packet, reliable, latest_key = command[1:]
+            server.send(address, _Forwarded(tail=raw_packet,
+                                            _latest_key=latest_key), reliable)
+        elif command[0] == "many":
+            addresses, raw_packet, reliable, latest_key = command[1:]
+            server.send_to_many(addresses, _Forwarded(tail=raw_packet,
+                                                _latest_key=latest_key),
+                                reliable)
+        elif command[0] == "chunked":
+            address, raw_packet, cache = command[1:]
+            server.send_chunked(address, _Forwarded(tail=raw_packet), cache)
+        elif command[0] == "forget":
+            server.forget_chunked(_Forwarded(tail=command[1]))
+        elif command[0] == "stream":
+            address, raw_packet = command[1:]
+            server.send_stream(address, _Forwarded(tail=raw_packet))
+        elif command[0] == "disconnect":
+            address, notify = command[1:]
+            server.disconnect(address, notify)
+        elif command[0] == "shutdown":
+            break
+    stopping.set()
+    forwarder.join(3.0)
+    server.shutdown()
+
+def _forwarding_loop(index, server, results, stopping):
+    """
+    This forwards the worker's received packets, in batches, with the clock
+    estimates of their senders that have taken samples since the last.
+    """
+    samples = {} # {address:ClockSync.samples as last forwarded}
+    while not stopping.is_set():
+        try:
+            forwarded = [server.recv(timeout=1.0)]
+        except Empty:
+            continue
+        try:
+            while len(forwarded) < FORWARD_BATCH:
+                forwarded.append(server.recv(timeout=0))
+        except Empty:
+            pass
+        clocks = []
+        for address in set(address for address, packet_data in forwarded):
+            clock = server.clock(address)
+            if clock is None: # (disconnected)
+                samples.pop(address, None)
+            elif clock.samples != samples.get(address):
+                samples[address] = clock.samples
+                clocks.append((address, clock.estimate()))
+        results.put((index, forwarded, clocks))
+
+def _client_main(address, count, size):
+    """ This is one benchmark client process: count packets, then leave. """
+    from subspace.core.client import Client
+    from time import sleep
+    c = Client(address)
+    p = _Forwarded(tail="\x42" + "x" * (size - 1))
+    for n in xrange(count):
+        c.send(p)
+        if n % 50 == 49:
+            sleep(0.005) # don't just overflow the client's outgoing queue
+    sleep(0.5)
+    c.close()
+
+def _receive_buffer_errors():
+    """
+    This returns how many datagrams the kernel has dropped, all told, for
+    lack of room in a socket's receive buffer (or None where that isn't
+    known, it is read from Linux's /proc/net/snmp).
+    """
+    try:
+        with open("/proc/net/snmp") as f:
+            udp = [line.split() for line in f if line.startswith("Udp:")]
+        return int(udp[1][udp[0].index("RcvbufErrors")])
+    except (IOError, IndexError, ValueError):
+        return None
+
+def main(port=5099, clients=8, count=2000, size=32, worker_counts=(1,2,4)):
+    """
+    This measures how many packets per second reach recv() (i.e. are
+    decrypted, processed and forwarded) as the number of workers grows.
+    Each of clients processes sends count unreliable packets of size bytes,
+    as fast as it can, so once that is more than the workers can read (e.g.
+    with fewer cpus than workers and clients) the rest are lost.  So it also
+    reports where they were lost: the kernel's socket buffers overflowing,
+    or this process's ingress (see Server).
+    """
+    from multiprocessing import cpu_count
+    from time import time
+    address = ("127.0.0.1", port)
+    print "%d cpus, %d clients sending %d packets each" % (cpu_count(),
+                                                           clients, count)
+    for workers in worker_counts:
+        buffer_errors = _receive_buffer_errors()
+        s = ShardedServer(address, workers)
+        senders = [Process(target=_client_main, args=(address, count, size))
+                   for n in range(clients)]
+        for sender in senders:
+            sender.start()
+        received = left = 0
+        start = None
+        while left < clients:
+            try:
+                client_address, raw_packet = s.recv(timeout=5.0)
+            except Empty:
+                break # some Disconnects went missing
+            if raw_packet is None:
+                left += 1
+                continue
+            if start is None:
+                start = time()
+            received += 1
+            end = time()
+        for sender in senders:
+            sender.join()
+        s.shutdown()
+        if buffer_errors is not None:
+            buffer_errors = _receive_buffer_errors() - buffer_errors
+        print "%d workers: received %d/%d packets at %d/s (by worker: %s)" % \
+                (workers, received, clients * count,
+                 received / max(end - start, 1e-6), s.packet_counts)
+        print "    lost %s in socket buffers, %d in ingress" % \
+                (buffer_errors if buffer_errors is not None else "?",
+                 s.ingress.dropped)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+This schedules callbacks on a hierarchical timing wheel.
+
+Anything that must happen at some time (a reliable resend, a Sync, an idle
+timeout, a game timer) is scheduled here instead of being found by a loop
+that wakes periodically to scan every connection.  The wheel is 4 levels of
+slots.  Level 0 has a slot per TICK (256 of them, 2.56s) and each higher
+level's slot spans a whole turn of the level below.  Scheduling drops the
+timer into one slot, and each tick only touches the timers in that tick's
+slot (and, once per turn, cascades the next slot of the level above down).
+So each timer costs O(1) to schedule, cancel and fire, however many there
+are, and a connection with nothing due costs nothing at all.
+
+The shared timers instance fires its timers on one daemon thread:
+
+>>> resends = []
+>>> timer = timers.schedule(0.25, resends.append, "conn")
+>>> timer.cancel() # (if it is no longer needed)
+
+Timers fire at most a TICK late (and never early).  Callbacks run on the
+timer thread, so they shouldn't block for long.  Run this module to compare
+it against a loop that checks every connection.
+"""
+from threading import Thread, Lock, Event
+from time import time
+import atexit
+from math import floor, ceil
+from logging import warn, info, debug
+
+TICK = 0.01 # seconds per slot of the innermost level (a timer's precision)
+LEVEL_BITS = (8, 6, 6, 6) # log2 of the slots per level (256 ticks, ... 7.8d)
+MAX_IDLE_WAIT = 60.0 # seconds the thread sleeps when nothing is scheduled
+
+class Timer:
+    """ This is a scheduled callback, as returned by TimerWheel.schedule. """
+
+    def __init__(self, deadline, fn, args):
+        self.deadline = deadline
+        self.tick = int(ceil(deadline / TICK)) # the first tick >= deadline
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def __str__(self):
+        return "Timer(%.3f, %s)" % (self.deadline, self.fn.__name__)
+
+    def cancel(self):
+        """ This stops the timer from firing (it's dropped when it's due). """
+        self.cancelled = True
+
+class TimerWheel:
+    """
+    This holds timers in the slots of a hierarchical timing wheel (see the
+    module doc).  advance() fires the timers that are due.  It is threadsafe:
+    any thread may schedule or cancel, but only one should advance it.
+    """
+
+    def __init__(self, start=None):
+        self._tick = int(floor((time() if start is None else start) / TICK))
+        self._levels = [[[] for n in range(1 << bits)] for bits in LEVEL_BITS]
+        self._shifts = [sum(LEVEL_BITS[:n]) for n in range(len(LEVEL_BITS))]
+        self._due = [] # timers scheduled for a tick already past
+        self._lock = Lock()
+        self.pending = 0 # timers held (including cancelled, until dropped)
+        # these are just for inspecting how the wheel is working
+        self.fired = 0 # timers fired
+        self.cascaded = 0 # timers moved down a level
+
+    def __len__(self):
+        return self.pending
+
+    def __str__(self):
+        return "TimerWheel(pending=%d, fired=%d, cascaded=%d)" % \
+                (self.pending, self.fired, self.cascaded)
+
+    def schedule(self, delay, fn, *args):
+        """ This has fn(*args) called after delay seconds, see Timer. """
+        return self.schedule_at(time() + delay, fn, *args)
+
+    def schedule_at(self, deadline, fn, *args):
+        """ This has fn(*args) called at (or just after) deadline. """
+        timer = Timer(deadline, fn, args)
+        with self._lock:
+            self._insert(timer)
+            self.pending += 1
+        return timer
+
+    def _insert(self, timer):
+        """ This puts timer into the slot for its tick. """
+        delta = timer.tick - self._tick
+        if delta <= 0:
+            self._due.append(timer)
+            return
+        for level, bits in enumerate(LEVEL_BITS):
+            shift = self._shifts[level]
+            if delta < 1 << (shift + bits) or level == len(LEVEL_BITS) - 1:
+                # (the last level holds anything further, it re-cascades)
+                slots = self._levels[level]
+                slots[(timer.tick >> shift) & (len(slots) - 1)].append(timer)
+                return
+
+    def advance(self, now=None):
+        """ This fires every timer due by now, it returns how many fired. """
+        now = time() if now is None else now
+        with self._lock:
+            target = int(floor(now / TICK))
+            if self.pending == len(self._due) and target > self._tick:
+                self._tick = target # nothing else is held, skip the walk
+            while self._tick < target:
+                self._tick += 1
+                self._cascade() # (this may add to _due)
+                slot = self._levels[0][self._tick & ((1 << LEVEL_BITS[0]) - 1)]
+                if slot:
+                    self._due.extend(slot)
+                    del slot[:]
+            due, self._due = self._due, []
+            self.pending -= len(due)
+        fired = 0
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                timer.fn(*timer.args)
+            except Exception as err:
+                warn("error firing %s: %s" % (timer, err))
+            fired += 1
+        self.fired += fired
+        return fired
+
+    def _cascade(self):
+        """
+        This moves the timers of the next slot of each higher level down,
+        whenever the level below it has just come round to its first slot.
+        """
+        for level in range(1, len(LEVEL_BITS)):
+            shift = self._shifts[level]
+            if self._tick & ((1 << shift) - 1):
+                return # the level below hasn't wrapped
+            slots = self._levels[level]
+            slot = slots[(self._tick >> shift) & (len(slots) - 1)]
+            timers = slot[:]
+            del slot[:]
+            for timer in timers:
+                if not timer.cancelled:
+                    self._insert(timer)
+                    self.cascaded += 1
+                else:
+                    self.pending -= 1
+
+    def next_deadline(self):
+        """
+        This returns when advance() next has something to do (or None if
+        nothing is scheduled).  It may be a cascade rather than a timer.
+        """
+        with self._lock:
+            if not self.pending:
+                return None
+            if self._due:
+                return self._tick * TICK
+            slots = self._levels[0]
+            mask = len(slots) - 1
+            for tick in xrange(self._tick + 1,
+                               ((self._tick >> LEVEL_BITS[0]) + 1) <<
+                                                        LEVEL_BITS[0]):
+                if slots[tick & mask]:
+                    return tick * TICK
+            # nothing more this turn, so wake to cascade the next
+            return (((self._tick >> LEVEL_BITS[0]) + 1) << LEVEL_BITS[0]) \
+                        * TICK
+
+class TimerService(TimerWheel):
+    """
+    This is a TimerWheel with a (daemon) thread to advance it.  The thread
+    sleeps until the next deadline, an earlier timer scheduled meanwhile
+    wakes it.  stop() ends the thread, the shared timers are stopped at exit
+    (a daemon thread still running while the interpreter tears down its
+    modules dies with a traceback).
+    """
+
+    def __init__(self):
+        TimerWheel.__init__(self)
+        self._thread = None
+        self._wake = Event()
+        self._stopping = Event() # this is set to tell the thread to end
+        self._sleeping_until = None # the deadline the thread is waiting on
+
+    def start(self):
+        """ This starts the thread (if it isn't already running). """
+        with self._lock:
+            if self._thread is None:
+                self._stopping.clear()
+                self._thread = Thread(target=self._ticking_loop,
+                                      name="Core:timers")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """
+        This ends the thread (timers still pending don't fire, unless a later
+        schedule starts it again) and waits up to timeout seconds for it.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            thread.join(timeout)
+
+    def schedule_at(self, deadline, fn, *args):
+        self.start()
+        timer = TimerWheel.schedule_at(self, deadline, fn, *args)
+        sleeping_until = self._sleeping_until
+        if sleeping_until is None or deadline < sleeping_until:
+            self._wake.set()
+        return timer
+
+    def _ticking_loop(self):
+        """ This advances the wheel whenever something is due. """
+        while not self._stopping.is_set():
+            deadline = self.next_deadline()
+            if deadline is None:
+                deadline = time() + MAX_IDLE_WAIT
+            self._sleeping_until = deadline
+            wait = deadline - time()
+            if wait > 0:
+                self._wake.wait(wait)
+            self._sleeping_until = None
+            self._wake.clear()
+            if not self._stopping.is_set():
+                self.advance()
+
+timers = TimerService()
+atexit.register(timers.stop)
+
+def benchmark(connection_counts=(100, 1000, 10000), seconds=1.0):
+    """
+    This compares the wheel against loops that check every connection, as
+    the core used to, for connections that each have one resend due every
+    RTO (0.5s).  Each check (and each resend) takes the connection's lock,
+    as check_reliable_resend does.  Polling every 0.1s is the old precision,
+    polling every TICK is the wheel's.
+    """
+    from random import random
+    rto = 0.5
+    for count in connection_counts:
+        locks = [Lock() for n in xrange(count)]
+        timings = []
+        for period in (0.1, TICK):
+            dues = [random() * rto for n in xrange(count)]
+            def check(n, clock):
+                with locks[n]:
+                    if dues[n] <= clock:
+                        dues[n] = clock + rto
+            t = time()
+            for step in xrange(int(seconds / period)):
+                for n in xrange(count):
+                    check(n, step * period)
+            timings.append(time() - t)
+        wheel = TimerWheel(start=0.0)
+        def resend(n):
+            with locks[n]:
+                wheel.schedule_at(wheel._tick * TICK + rto, resend, n)
+        for n in xrange(count):
+            wheel.schedule_at(random() * rto, resend, n)
+        t = time()
+        for step in xrange(int(seconds / TICK)):
+            wheel.advance(step * TICK)
+        timings.append(time() - t)
+        print "%6d connections, ms per second: polling %8.2f (%.1fs apart)," \
+              " %8.2f (%.2fs apart), wheel %7.2f" % \
+              (count, timings[0] * 1e3, 0.1, timings[1] * 1e3, TICK,
+               timings[2] * 1e3)
+
+if __name__ == '__main__':
+    benchmark()
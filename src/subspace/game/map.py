@@ -68,10 +68,10 @@ class LVL:
                 if e_magic[::-1] == 'elvl': # there is elvl data
                     p += elvlh.size
                     e_size -= elvlh.size # we already got the elvlh off of the e
-                    self._process_elvl(d[p:p + e_size])
+                    self._process_elvl(buffer(d, p, e_size))
                     p += e_size # tiles start after elvl chunks
             # done with any bmp or elvl, d[p:] is tile data
-            self._process_tile_list(d[p:])
+            self._process_tile_list(buffer(d, p))
 
     def checksum(self, key=0x46692017):
         """ I'm uncertain when the tile-wise checksum is ever used. """
@@ -99,36 +99,44 @@ class LVL:
         return self._compressed
 
     def _process_elvl(self, data):
-        """ Reads raw_elvl_chunks as a list of packed elvl chunks """
+        """
+        Reads raw_elvl_chunks as a list of packed elvl chunks.  It walks an
+        offset through data, and each chunk is handed on as a buffer of it,
+        so nothing is copied (but the unhandled chunks we keep).
+        """
         elvl_chunk_header = Struct("<4sL") # chunk header (type, size)
-        while len(data) >= elvl_chunk_header.size:
+        offset = 0
+        while len(data) - offset >= elvl_chunk_header.size:
             # read chunk header
-            (chunk_type, chunk_size) = elvl_chunk_header.unpack_from(data)
+            (chunk_type, chunk_size) = \
+                            elvl_chunk_header.unpack_from(data, offset)
             chunk_total_size = chunk_size + elvl_chunk_header.size
-            if chunk_total_size > len(data):
+            if chunk_total_size > len(data) - offset:
                 warn("invalid elvl specifier (requested=%d > actual=%d)" % \
-                            (chunk_total_size, len(data)))
+                            (chunk_total_size, len(data) - offset))
                 break
             else:
-                chunk_data = data[elvl_chunk_header.size:chunk_total_size]
-                id = type[::-1] # fix the endian
+                chunk_data = buffer(data, offset + elvl_chunk_header.size,
+                                    chunk_size)
+                id = chunk_type[::-1] # fix the endian
                 if id in self.elvl_handlers:
                     self.elvl_handlers[id](chunk_data)
                 else:
-                    self.elvl_unhandled.setdefault(id,[]).append(chunk_data)
-                data = data[chunk_total_size:]
+                    self.elvl_unhandled.setdefault(id,[]).append(
+                                                            str(chunk_data))
+                offset += chunk_total_size
 
     def _process_tile_list(self, raw_tile_list):
-        """ Takes raw_tile_data as packed list of tiles on the LVL """
-        tile = raw_tile_list
-        while len(tile) >= 4:
-            self._process_single_tile(tile[:4])
-            tile = tile[4:]
-
-    def _process_single_tile(self, tile_data):
-        """ Takes tile_data as single packed tile on the LVL """
-        tile_structure = Struct("<L")
-        t = tile_structure.unpack_from(tile_data)[0] # unpack u32
+        """
+        Takes raw_tile_data as packed list of tiles on the LVL.  They are
+        unpacked all at once, rather than sliced off 4 bytes at a time.
+        """
+        count = len(raw_tile_list) // 4
+        for t in Struct("<%dL" % count).unpack_from(raw_tile_list):
+            self._process_single_tile(t)
+
+    def _process_single_tile(self, t):
+        """ Takes t as a single tile on the LVL (an unpacked u32) """
         x = t & 0x03FF
         y = (t >> 12) & 0x03FF
         tile = t >> 24
@@ -142,22 +150,24 @@ class LVL:
     def _process_elvl_REGN(self, data):
         """ Handles an elvl REGN chunk """
         regn_chunk_header = Struct("<4sL") # chunk header (type, size)
-        while len(data) >= regn_chunk_header.size:
-            (chunk_type, chunk_size) = \
-                regn_chunk_header.unpack_from(data) # u32,u32 (type, size)
+        offset = 0 # (walked through data, as in _process_elvl)
+        while len(data) - offset >= regn_chunk_header.size:
+            (chunk_type, chunk_size) = regn_chunk_header.unpack_from(data,
+                                        offset) # u32,u32 (type, size)
             total_chunk_size = chunk_size + regn_chunk_header.size
-            if total_chunk_size > len(data):
+            if total_chunk_size > len(data) - offset:
                 warn("invalid regn specifier (requested=%d actual=%d)" % \
-                            (total_chunk_size,len(data)))
+                            (total_chunk_size,len(data) - offset))
                 break
             else:
-                chunk_data = data[regn_chunk_header.size:total_chunk_size]
+                chunk_data = buffer(data, offset + regn_chunk_header.size,
+                                    chunk_size)
                 chunk_id = chunk_type[::-1]
                 if chunk_id in self.regn_handlers:
                     self.regn_handlers[chunk_id](chunk_data)
-                    data = data[regn_chunk_header.size:]
                 else:
                     debug("unhandled regn=%s" % chunk_id)
+                offset += total_chunk_size
 
     def _process_regn_rNAM(self,rnam_data):
         """ Handles rNAM -- a name for the region """
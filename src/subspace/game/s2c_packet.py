@@ -254,6 +254,10 @@ class PlayerPosition(S2CPacket):
     # timer = 0
     # item_info = 0
 
+    def latest_key(self):
+        """ A player's newer position makes any unsent one stale. """
+        return (self._id, self.player_id)
+
 class PlayerPositionWeapon(S2CPacket):
     _id = '\x05'
     _format = "bHhhHhBBBhHH" # + "HHHI"  # may not exist (ExtraPosData)
@@ -18,8 +18,8 @@ from subspace.game.map import LVL
 from subspace.game.ship import Ship
 from subspace.game import c2s_packet, s2c_packet
 from subspace.game.server import message
+from subspace.core.chunk import StreamOut
 from subspace.game.weapon import WeaponInfo, WeaponTypes, has_weapon
-from subspace.util import now
 from logging import debug, info, warn
 from threading import RLock
 
@@ -34,11 +34,19 @@ class Arena(set):
             self.map.load()
         else:
             self.map = None
+        self._compressed_map = None # compressed once, see _map_file_data
+        self._map_transfers = {} # {player:StreamOut} of map downloads
+        # the ArenaSettings sent to entering players (None sends the defaults)
+        self._settings = None
         # this will contain all registered player packet handlers
         self._player_packet_handlers = {}
         # the lock protects this from adds/gets during process_player_packet 
         self._player_packet_handlers_lock = RLock()
         self.zone = zone
+        # players download the map (see _send_map_info) by requesting it
+        self.add_player_packet_handler(**{
+            c2s_packet.FileRequestMap._id : self._handle_file_request_map,
+            })
         self.games = [DefaultGame(self)]#self.load_games(self.cfg["games"])
 
     def __str__(self):
@@ -63,6 +71,23 @@ class Arena(set):
         set.remove(self, player)
         self.do_arena_leave(player)
 
+    @property
+    def settings(self):
+        """ The ArenaSettings sent to entering players (None for defaults). """
+        return self._settings
+
+    @settings.setter
+    def settings(self, settings):
+        """
+        This replaces the ArenaSettings sent to entering players.  The core
+        keeps the chunks of the old ones (they were sent chunked to everyone
+        entering), so it is told to forget them.  So the settings must be
+        replaced (never changed in place) for the change to be sent.
+        """
+        old_settings, self._settings = self._settings, settings
+        if old_settings is not None and old_settings is not settings:
+            self.zone.core.forget_chunked(old_settings)
+
     def process_message(self, player, type, msg, target_player = None):
         if type is message.Type.Public:
             p = s2c_packet.PlayerChatMessage(
@@ -94,7 +119,7 @@ class Arena(set):
         player.ship = Ship.SPECTATOR
         player.freq = 8025 # TODO: self.cfg["SpectatorFreq"]
         # send them the ship settings
-        player.send_ship_settings(None)
+        player.send_ship_settings(self.settings)
         # tell them their own player ID
         player.send_session_id()
         # tell them about every other player in the arena
@@ -116,6 +141,7 @@ class Arena(set):
         """
         for other_player in self: # let the entire arena know that they left
             self.notify_of_leaving_player(other_player, player)
+        self._map_transfers.pop(player, None)
 
     def process_player_packet(self, player, raw_packet):
         packet_id = raw_packet[0]
@@ -169,13 +195,44 @@ class Arena(set):
                             leaving_player_id = leaving_player.id)
         recipient.send(p, reliable = True)
 
+    def _map_file_data(self):
+        """
+        This returns the map compressed, as it is sent.  It is compressed
+        only once, then kept for every player that needs it.
+        """
+        if self._compressed_map is None:
+            self._compressed_map = self.map.compress_from_file()
+        return self._compressed_map
+
     def _send_map_info(self, player):
-        # TODO: make this perform full map check / transfer, as needed
         p = s2c_packet.ArenaMapFilesCont()
-        p.add_file(self.map.filename, self.map.checksum(0), 0x8c9b)
-        # TODO: fix map "size" (it need to use compressed filesize + 17)
+        # the size is of the FileTransfer that _handle_file_request_map sends
+        p.add_file(self.map.filename, self.map.checksum(0),
+                   len(self._map_file_data()) + 17)
         player.send(p, reliable = True)
 
+    def _handle_file_request_map(self, player, raw_packet):
+        """
+        This sends the map (compressed) to a player that doesn't have it.  It
+        is streamed (see core.chunk), so it doesn't hold up their other
+        reliables.  A request while the player is still downloading it is
+        ignored.  (When the core is sharded, the transfer isn't ours to
+        follow, but the core still caps the streams a player may queue.)
+        """
+        if self.map is None:
+            warn("%s requested a map, but %s has none" % (player, self.name))
+            return
+        transfer = self._map_transfers.get(player)
+        if transfer is not None and not (transfer.done() or
+                                         transfer.cancelled):
+            debug("%s requested the map again, still sending it" % player)
+            return
+        p = s2c_packet.FileTransfer(file_name = self.map.filename,
+                                    tail = self._map_file_data())
+        transfer = player.send_stream(p)
+        if isinstance(transfer, StreamOut):
+            self._map_transfers[player] = transfer
+
 class Game(object):
     
     def __init__(self, arena, desired_event_types):
@@ -308,7 +365,8 @@ class DefaultGame(Game):
         p = s2c_packet.PlayerPositionWeapon(
                 player_id = player.id, weapon_info = weapon_info.raw(),
                 x = x, y = y, rotation = rotation, dx = dx, dy = dy,
-                time = now() & 0xffff, bounty = bounty, energy = energy, 
+                time = player.server_time(time) & 0xffff,
+                bounty = bounty, energy = energy,
                 status = status)
         p.calculate_checksum() # this sets p.checksum properly
         player.position = p
@@ -323,7 +381,8 @@ class DefaultGame(Game):
         p = s2c_packet.PlayerPosition(
                 player_id = player.id,
                 x = x, y = y, rotation = rotation, dx = dx, dy = dy,
-                time = now() & 0xffff, bounty = bounty, energy = energy,
+                time = player.server_time(time) & 0xffff,
+                bounty = bounty, energy = energy,
                 status = status)
         player.position = p
         if player.ship is Ship.SPECTATOR:
@@ -1,5 +1,6 @@
 
 from subspace.game import c2s_packet, s2c_packet
+from subspace.util import now
 from logging import debug, warn
 from threading import RLock
 from struct import unpack_from
@@ -165,12 +166,48 @@ class Player:
         send to this player's address
         """
         self._zone.core.send_chunked(self.address, packet, **args)
+
+    def send_stream(self, packet, **args):
+        """
+        This convenience function reaches into the zone to tell the core to
+        stream a large packet (e.g. a map file) to this player's address
+        """
+        return self._zone.core.send_stream(self.address, packet, **args)
     
+    def server_time(self, client_time):
+        """
+        This translates client_time (e.g. a position's) from this player's
+        clock to the server's, as the core has measured it from their Syncs.
+        Until it has (or if it can't), it's taken to be now.
+        """
+        clock = self._zone.core.clock(self.address)
+        if clock is None or clock.offset is None:
+            return now()
+        return clock.to_local(client_time)
+
     def send_session_id(self):
         login_pid = s2c_packet.SessionPlayerID(player_id = self.id)
         self.send(login_pid, reliable = True)
 
     def send_ship_settings(self, settings):
+        """
+        This sends the ArenaSettings (or, if settings is None, the defaults).
+        They are sent chunked, and the core keeps the chunks for whoever is
+        sent the same ArenaSettings next (see core.chunk.ChunkCache).
+        """
+        if settings is None:
+            settings = default_ship_settings()
+        self.send_chunked(settings, cache=True)
+
+_default_ship_settings = None # the one ArenaSettings default_ship_settings makes
+
+def default_ship_settings():
+    """
+    This returns the ArenaSettings sent by default.  It's the same packet
+    every time, so it's only packed and chunked once.
+    """
+    global _default_ship_settings
+    if _default_ship_settings is None:
         # until we load ship settings from file, here is a block of them
         raw_settings = ''.join(chr(x) for x in [
             0x0f, 0x01, 0x00, 0x00, 0xa0, 0x0f, 0x00, 0x00,#chunk 1 
@@ -352,7 +389,8 @@ class Player:
             0x06, 0x84, 0x06, 0x06, 0x06, 0x00, 0x68, 0xe0, 
             0x00, 0x00, 0x2c, 0xb4, 0xf0, 0xf0, 0x68, 0x00, 
             0x3c, 0x00, 0x68, 0x68])
-        self.send_chunked(s2c_packet.ArenaSettings(raw_settings))
+        _default_ship_settings = s2c_packet.ArenaSettings(raw_settings)
+    return _default_ship_settings
 
 class ContinuumChecksums():
     
@@ -21,7 +21,7 @@ All other c2s_packets from a Player are handled by the Player's Arena via
 Arena.process_player_packet.  Before handing the packets off to the Arena, the
 Zone looks up the Player, so the Arena receives the Player and the raw_packet.
 """
-from subspace.core import server
+from subspace.core import server, shard
 from subspace.game.server import ping, session, arena, message
 from subspace.game import c2s_packet, s2c_packet
 from time import sleep
@@ -51,7 +51,16 @@ class Zone:
             self.DISCONNECT_PACKET_ID : self._handle_disconnect,
         }
         self.add_packet_handlers(**self._local_packet_handlers)
-        self.core = server.Server(self._address)
+        # the optional "core" section holds keyword options for core.Server,
+        # except workers: with more than 1, core.shard spreads the core over
+        # that many processes and this process gets their decoded packets
+        core_options = dict(self.cfg.get("core") or {})
+        workers = core_options.pop("workers", 1)
+        if workers > 1:
+            self.core = shard.ShardedServer(self._address, workers,
+                                            **core_options)
+        else:
+            self.core = server.Server(self._address, **core_options)
         self.shutting_down = Event()
         self._threads = {
             "recv"  : Thread(target=self._receiving_loop,name="Zone:recv")
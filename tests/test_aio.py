@@ -0,0 +1,76 @@
+import unittest
+import trollius as asyncio
+from trollius import From
+from subspace.core.aio import AsyncServer, AsyncClient
+from subspace.game.s2c_packet import PlayerChatMessage
+
+def chat(message):
+    return PlayerChatMessage(type=2, tail=message + "\x00")
+
+class AsyncTest(unittest.TestCase):
+    """ This runs a server and clients on one event loop (and no threads). """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_coroutine(self, coroutine):
+        self.loop.run_until_complete(
+                    asyncio.wait_for(coroutine, 10.0, loop=self.loop))
+
+    def test_round_trip(self):
+        @asyncio.coroutine
+        def run():
+            server = yield From(AsyncServer.listen(("127.0.0.1", 0),
+                                                   loop=self.loop))
+            client = yield From(AsyncClient.connect(server.address,
+                                                    loop=self.loop))
+            client.send(chat("hello"), reliable=True)
+            address, raw_packet = yield From(server.recv())
+            self.assertEqual(raw_packet, chat("hello").raw())
+            server.send(address, chat("hi"), reliable=True)
+            self.assertEqual((yield From(client.recv())), chat("hi").raw())
+            client.close()
+            self.assertEqual((yield From(server.recv())), (address, None))
+            server.shutdown()
+        self.run_coroutine(run())
+
+    def test_shutdown_disconnects_clients(self):
+        @asyncio.coroutine
+        def run():
+            server = yield From(AsyncServer.listen(("127.0.0.1", 0),
+                                                   loop=self.loop))
+            client = yield From(AsyncClient.connect(server.address,
+                                                    loop=self.loop))
+            server.shutdown()
+            self.assertEqual((yield From(client.recv())), None)
+        self.run_coroutine(run())
+
+    def test_new_output_doesnt_wait_for_a_delayed_flush(self):
+        @asyncio.coroutine
+        def run():
+            server = yield From(AsyncServer.listen(("127.0.0.1", 0),
+                                                   loop=self.loop,
+                                                   ack_delay=10.0))
+            slow = yield From(AsyncClient.connect(server.address,
+                                                  loop=self.loop))
+            client = yield From(AsyncClient.connect(server.address,
+                                                    loop=self.loop))
+            slow.send(chat("hello"), reliable=True)
+            yield From(server.recv())
+            yield From(asyncio.sleep(0.05, loop=self.loop))
+            self.assertNotEqual(server._flush_timer, None) # (for slow's ACK)
+            address = client._transport.get_extra_info("sockname")
+            server.send(address, chat("hi"))
+            raw_packet = yield From(asyncio.wait_for(client.recv(), 2.0,
+                                                     loop=self.loop))
+            self.assertEqual(raw_packet, chat("hi").raw())
+            slow.close()
+            client.close()
+            server.shutdown()
+        self.run_coroutine(run())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+from subspace.core.chunk import StreamOut
+from subspace.core.server import Server
+from subspace.game.s2c_packet import ArenaSettings
+from subspace.game.server.arena import Arena
+
+class Zone:
+    """ This is as much of a zone as an Arena's settings need. """
+
+    def __init__(self, core):
+        self.core = core
+
+class Map:
+    """ This is a map that counts how often it's compressed. """
+    filename = "test.lvl"
+
+    def __init__(self):
+        self.compressions = 0
+
+    def checksum(self, key):
+        return 0
+
+    def compress_from_file(self):
+        self.compressions += 1
+        return "compressed"
+
+class Player:
+    """ This keeps what an Arena sends it, its streams go nowhere. """
+
+    def __init__(self):
+        self.sent = []
+        self.streams = []
+
+    def send(self, packet, reliable=False):
+        self.sent.append(packet)
+
+    def send_stream(self, packet):
+        self.streams.append(StreamOut(packet.raw(), 480))
+        return self.streams[-1]
+
+class ArenaSettingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.core = Server(("127.0.0.1", 0))
+        self.core.shutdown()
+        self.arena = Arena(Zone(self.core), "test", None)
+
+    def tearDown(self):
+        self.core._server_socket.close()
+
+    def test_replacing_settings_forgets_their_chunks(self):
+        old_settings = self.arena.settings = ArenaSettings()
+        self.core.chunk_cache.raws(old_settings) # (as cached sends do)
+        self.arena.settings = old_settings # (the same, so they're kept)
+        self.assertEqual(len(self.core.chunk_cache), 1)
+        self.arena.settings = ArenaSettings()
+        self.assertEqual(len(self.core.chunk_cache), 0)
+
+class ArenaMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.arena = Arena(Zone(None), "test", None)
+        self.arena.map = Map()
+        self.player = Player()
+
+    def test_compresses_the_map_once(self):
+        self.arena._send_map_info(self.player)
+        self.arena._send_map_info(Player())
+        self.arena._handle_file_request_map(self.player, None)
+        self.assertEqual(self.arena.map.compressions, 1)
+        self.assertEqual(len(self.player.streams), 1)
+
+    def test_ignores_requests_while_downloading(self):
+        self.arena._handle_file_request_map(self.player, None)
+        self.arena._handle_file_request_map(self.player, None)
+        self.assertEqual(len(self.player.streams), 1)
+        transfer = self.player.streams[0]
+        transfer.acked = transfer.total # (done)
+        self.arena._handle_file_request_map(self.player, None)
+        self.assertEqual(len(self.player.streams), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import doctest
+from struct import pack
+from subspace.core import chunk
+from subspace.core.chunk import ChunkBuffer, StreamReceiver, INITIAL_SIZE
+from subspace.core.chunk import ChunkCache, StreamSender, STREAM_RESERVE_SIZE
+from subspace.game.s2c_packet import ArenaSettings, PlayerChatMessage
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(chunk))
+    return tests
+
+def stream_piece(total, data):
+    """ This returns a raw StreamRequest carrying data of a total length. """
+    return '\x00\x0A' + pack("<I", total) + data
+
+class ChunkBufferTest(unittest.TestCase):
+
+    def test_reassembles(self):
+        chunks = ChunkBuffer(max_size=4096)
+        self.assertTrue(chunks.add('\x00\x08abc', 2))
+        self.assertTrue(chunks.add('\x00\x09def', 2))
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual(chunks.take(), 'abcdef')
+        self.assertEqual(len(chunks), 0)
+        self.assertEqual(chunks.take(), '')
+
+    def test_refuses_past_max_size(self):
+        chunks = ChunkBuffer(max_size=10)
+        self.assertTrue(chunks.add('\x00\x08' + 'x' * 8, 2))
+        self.assertFalse(chunks.add('\x00\x08' + 'x' * 3, 2))
+        self.assertEqual(len(chunks), 0) # (emptied)
+        self.assertTrue(chunks.add('\x00\x08' + 'y' * 10, 2))
+        self.assertEqual(chunks.take(), 'y' * 10)
+
+    def test_grows_past_the_initial_size(self):
+        chunks = ChunkBuffer(max_size=4 * INITIAL_SIZE)
+        piece = 'z' * (INITIAL_SIZE - 1)
+        for n in range(3):
+            self.assertTrue(chunks.add(piece))
+        self.assertEqual(chunks.take(), piece * 3)
+        self.assertEqual(chunks._data, None) # (let go of, once grown)
+
+    def test_allocates_nothing_until_the_first_chunk(self):
+        self.assertEqual(ChunkBuffer()._data, None)
+
+class StreamReceiverTest(unittest.TestCase):
+
+    def test_reassembles(self):
+        stream = StreamReceiver(max_size=100)
+        self.assertEqual(stream.add(stream_piece(6, 'abc')), None)
+        self.assertEqual(stream.received(), 3)
+        self.assertEqual(stream.add(stream_piece(6, 'def')), 'abcdef')
+        self.assertEqual(stream.total, None)
+
+    def test_refuses_a_total_past_max_size(self):
+        stream = StreamReceiver(max_size=100)
+        self.assertFalse(stream.add(stream_piece(101, 'abc')))
+        self.assertEqual(stream.received(), 0)
+
+    def test_refuses_pieces_that_dont_add_up(self):
+        stream = StreamReceiver(max_size=100)
+        stream.add(stream_piece(6, 'abcd'))
+        self.assertFalse(stream.add(stream_piece(6, 'efg'))) # 7 > 6
+        self.assertEqual(stream.received(), 0)
+        stream.add(stream_piece(6, 'abc'))
+        self.assertFalse(stream.add(stream_piece(7, 'def'))) # a new total
+        self.assertEqual(stream.received(), 0)
+
+    def test_reserves_only_so_much_for_a_claimed_total(self):
+        stream = StreamReceiver(max_size=4 * STREAM_RESERVE_SIZE)
+        stream.add(stream_piece(4 * STREAM_RESERVE_SIZE, ''))
+        self.assertEqual(len(stream._buffer._data), STREAM_RESERVE_SIZE)
+
+    def test_drops_pieces_while_cancelling(self):
+        stream = StreamReceiver(max_size=100)
+        stream.cancelling = True
+        self.assertEqual(stream.add(stream_piece(3, 'abc')), None)
+        self.assertEqual(stream.received(), 0)
+
+class StreamSenderTest(unittest.TestCase):
+
+    def test_refuses_past_max_transfers(self):
+        streams = StreamSender(480, max_transfers=2)
+        self.assertNotEqual(streams.add("a"), None)
+        cancelled = streams.add("b")
+        self.assertEqual(streams.add("c"), None)
+        streams.cancel(cancelled)
+        self.assertNotEqual(streams.add("c"), None)
+        self.assertEqual(len(streams), 2)
+
+class ChunkCacheTest(unittest.TestCase):
+
+    def test_splits_each_packet_once(self):
+        cache = ChunkCache(480)
+        settings = ArenaSettings()
+        raws = cache.raws(settings)
+        self.assertEqual(len(raws), 3) # (1428 bytes)
+        self.assertTrue(cache.raws(settings) is raws)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_doesnt_keep_small_packets(self):
+        cache = ChunkCache(480)
+        self.assertEqual(cache.raws(PlayerChatMessage(tail="hi\x00")), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_forgets(self):
+        cache = ChunkCache(480, max_entries=2)
+        first, second, third = [ArenaSettings() for n in range(3)]
+        for settings in (first, second, third):
+            cache.raws(settings)
+        self.assertEqual(len(cache), 2) # (the oldest was dropped)
+        cache.discard(second)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from Queue import Queue
+from threading import Thread
+from time import time
+from subspace.core import packet
+from subspace.core.client import Client
+import subspace.core.client as client_module
+
+def stopped_client(queue_size):
+    """
+    This returns a Client with no threads, socket or timers, so nothing ever
+    drains its outgoing queue (of queue_size).
+    """
+    client = Client.__new__(Client)
+    client._init_protocol_state()
+    client._stop_timers()
+    client._out = Queue(queue_size)
+    return client
+
+class TimerSendTest(unittest.TestCase):
+    """ The timers share one thread, so what they send must never block. """
+
+    def call(self, fn):
+        """ This calls fn on another thread, failing if it blocks. """
+        thread = Thread(target=fn)
+        thread.daemon = True
+        thread.start()
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive(), "%s blocked" % fn.__name__)
+
+    def test_resends_wait_when_the_queue_is_full(self):
+        client = stopped_client(2)
+        for n in range(3):
+            client._reliable_out.add("x%d" % n, time() - 10.0, 1.0)
+        self.call(client._check_reliable_resend)
+        self.assertEqual([client._out.get().seq for n in range(2)], [0, 1])
+        self.assertEqual(len(client._reliable_out), 3) # (still unacked)
+        self.assertTrue(client._reliable_out.next_due() > time())
+
+    def test_sync_is_skipped_when_the_queue_is_full(self):
+        client = stopped_client(1)
+        client._out.put(None)
+        self.call(client._sync_timer)
+        self.assertEqual(client._out.get(), None)
+        self.assertTrue(client._out.empty())
+        self.assertTrue(client._send_sync())
+        self.assertEqual(client._out.get()._id, packet.Sync._id)
+
+class SyncResponseTest(unittest.TestCase):
+
+    def test_rtt_across_the_wrap(self):
+        stopped = stopped_client(1)
+        now, client_module.now = client_module.now, lambda: 5
+        try:
+            stopped._handle_sync_response(packet.SyncResponse(
+                        remote_time=0xFFFFFFFB, sender_time=0).raw())
+        finally:
+            client_module.now = now
+        self.assertEqual(stopped.rtt.srtt, 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import doctest
+from subspace.core import clock
+from subspace.core.clock import ClockSync, tick_diff, CLOCK_WINDOW
+from subspace.core.clock import DRIFT_HISTORY
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(clock))
+    return tests
+
+def remote(local_time, offset=50000, drift=1e-4):
+    """ This returns a remote clock (drifting from ours) at local_time. """
+    return int(round(local_time + offset + drift * local_time)) % 0x100000000
+
+class TickDiffTest(unittest.TestCase):
+
+    def test_wraps(self):
+        self.assertEqual(tick_diff(5, 0xFFFFFFFB), 10)
+        self.assertEqual(tick_diff(0xFFFFFFFB, 5), -10)
+        self.assertEqual(tick_diff(1000, 400), 600)
+
+class ClockSyncTest(unittest.TestCase):
+
+    def test_translates_nothing_until_sampled(self):
+        clock = ClockSync()
+        self.assertEqual(clock.to_local(1000), None)
+        self.assertEqual(clock.to_remote(1000), None)
+
+    def test_ignores_a_delayed_sample(self):
+        clock = ClockSync()
+        for t in range(1000, 2000, 100):
+            clock.sample(t, t + 500)
+        clock.sample(2000, 2000 + 500 - 300) # (held up 300 ticks)
+        self.assertEqual(clock.offset, 500)
+
+    def test_round_trips_take_half_the_rtt(self):
+        clock = ClockSync()
+        clock.sample_round_trip(1000, 1520, 1040)
+        self.assertEqual(clock.offset, 500)
+        clock.sample_round_trip(1050, 9999, 1000) # (an impossible RTT)
+        self.assertEqual(clock.samples, 1)
+
+    def test_estimates_drift(self):
+        clock = ClockSync()
+        samples = CLOCK_WINDOW * DRIFT_HISTORY
+        for n in range(samples): # (a Sync every 10s)
+            clock.sample(n * 1000, remote(n * 1000))
+        self.assertAlmostEqual(clock.drift, 1e-4, delta=2e-5) # (to a tick)
+        later = samples * 1000 + 60000 # (10 minutes on)
+        self.assertTrue(abs(clock.to_remote(later) - remote(later)) <= 1)
+        self.assertTrue(abs(clock.to_local(remote(later)) - later) <= 1)
+
+    def test_estimates_across_the_wrap(self):
+        clock = ClockSync()
+        start = 0x100000000 - 100 * CLOCK_WINDOW / 2
+        for n in range(CLOCK_WINDOW):
+            local_time = (start + n * 100) % 0x100000000
+            clock.sample(local_time, (local_time + 500) % 0x100000000)
+        self.assertEqual(clock.offset, 500)
+        self.assertEqual(clock.to_remote(0xFFFFFFFF), 499)
+        self.assertEqual(clock.to_local(499), 0xFFFFFFFF)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from random import Random
+from subspace.core import encryption
+from subspace.core.encryption import VIE, encrypt_many, NUMPY_MIN_WORDS
+from subspace.core.encryption import _reference_encrypt, _reference_decrypt
+
+SIZES = range(0, 521) # (VIE tables cover 520 bytes)
+
+def random_data(rng, size):
+    return ''.join(chr(rng.randrange(256)) for n in xrange(size))
+
+class VIETest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = Random(1234)
+        self.vie = VIE(1234, -98765)
+
+    def check_against_reference(self):
+        for size in SIZES:
+            data = random_data(self.rng, size)
+            encrypted = self.vie.encrypt(data)
+            self.assertEqual(encrypted, _reference_encrypt(self.vie, data),
+                             "encrypt differs at %d bytes" % size)
+            self.assertEqual(self.vie.decrypt(encrypted),
+                             _reference_decrypt(self.vie, encrypted),
+                             "decrypt differs at %d bytes" % size)
+            self.assertEqual(self.vie.decrypt(encrypted), data)
+
+    def test_matches_the_reference(self):
+        self.check_against_reference()
+
+    def test_matches_the_reference_without_numpy(self):
+        numpy, encryption.numpy = encryption.numpy, None
+        try:
+            self.check_against_reference()
+        finally:
+            encryption.numpy = numpy
+
+    def test_encrypts(self):
+        data = 'x' * (NUMPY_MIN_WORDS * 4)
+        self.assertNotEqual(self.vie.encrypt(data), data)
+
+    def test_equal_keys_dont_encrypt(self):
+        vie = VIE(1234, 1234)
+        self.assertEqual(vie.encrypt('abcdef'), 'abcdef')
+        self.assertEqual(vie.decrypt('abcdef'), 'abcdef')
+
+class EncryptManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = Random(5678)
+        self.ciphers = [VIE(n, 1000 + n) for n in range(1, 9)]
+
+    def test_matches_each_cipher(self):
+        sizes = [0, 3, 20, 95, 96, 250, 496, 520]
+        datas = [random_data(self.rng, size) for size in sizes]
+        encrypted = encrypt_many(self.ciphers, datas)
+        for cipher, data, e in zip(self.ciphers, datas, encrypted):
+            self.assertEqual(e, _reference_encrypt(cipher, data))
+            self.assertEqual(cipher.decrypt(e), data)
+
+    def test_matches_each_cipher_for_the_same_data(self):
+        data = random_data(self.rng, 300)
+        encrypted = encrypt_many(self.ciphers, [data] * len(self.ciphers))
+        for cipher, e in zip(self.ciphers, encrypted):
+            self.assertEqual(e, _reference_encrypt(cipher, data))
+
+    def test_passes_identity_ciphers_through(self):
+        ciphers = self.ciphers[:4] + [VIE(7, 7)]
+        datas = [random_data(self.rng, 200) for cipher in ciphers]
+        encrypted = encrypt_many(ciphers, datas)
+        self.assertEqual(encrypted[-1], datas[-1])
+        self.assertEqual(encrypted[0], _reference_encrypt(ciphers[0], datas[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import doctest
+from Queue import Empty
+from threading import Timer
+from subspace.core import ingress
+from subspace.core.ingress import FairQueue, DROP_NEWEST, DROP_OLDEST
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ingress))
+    return tests
+
+A = ("10.0.0.1", 1)
+B = ("10.0.0.2", 1)
+
+class FairQueueTest(unittest.TestCase):
+
+    def test_takes_turns_between_addresses(self):
+        ingress = FairQueue()
+        for n in range(3):
+            ingress.put(A, "a%d" % n)
+        ingress.put(B, "b0")
+        self.assertEqual([ingress.pop()[1] for n in range(4)],
+                         ["a0", "b0", "a1", "a2"])
+        self.assertEqual(len(ingress), 0)
+        self.assertRaises(IndexError, ingress.pop)
+
+    def test_drops_newest(self):
+        ingress = FairQueue(cap=2, drop=DROP_NEWEST)
+        self.assertEqual([ingress.put(A, n) for n in range(3)],
+                         [True, True, False])
+        self.assertTrue(ingress.put(B, "b"))
+        self.assertEqual([ingress.pop() for n in range(3)],
+                         [(A, 0), (B, "b"), (A, 1)])
+        self.assertEqual(ingress.dropped, 1)
+
+    def test_drops_oldest(self):
+        ingress = FairQueue(cap=2, drop=DROP_OLDEST)
+        self.assertEqual([ingress.put(A, n) for n in range(3)],
+                         [True, True, False])
+        self.assertEqual([ingress.pop()[1] for n in range(2)], [1, 2])
+        self.assertEqual(len(ingress), 0)
+
+    def test_never_drops_a_disconnect(self):
+        ingress = FairQueue(cap=1, drop=DROP_OLDEST)
+        ingress.put(A, "a")
+        self.assertTrue(ingress.put(A, None)) # (past cap)
+        self.assertEqual([ingress.pop()[1] for n in range(2)], ["a", None])
+        ingress.put(B, None)
+        self.assertFalse(ingress.put(B, "late")) # (not the oldest, None)
+        self.assertEqual(ingress.pop(), (B, None))
+
+    def test_get_waits_for_a_packet(self):
+        ingress = FairQueue()
+        Timer(0.05, ingress.put, (A, "a")).start()
+        self.assertEqual(ingress.get(timeout=5.0), (A, "a"))
+
+    def test_get_times_out(self):
+        self.assertRaises(Empty, FairQueue().get, 0.01)
+
+    def test_refuses_an_unknown_drop_policy(self):
+        self.assertRaises(ValueError, FairQueue, drop="random")
+
+    def test_stats(self):
+        ingress = FairQueue(cap=1)
+        ingress.put(A, "a")
+        ingress.put(A, "b")
+        self.assertEqual(dict(ingress.stats()),
+                         {"queued": 1, "dropped": 1, "peak": 1,
+                          "waiting": 1, "addresses": 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import doctest
+from socket import socket, AF_INET, SOCK_DGRAM
+from subspace.core import mmsg
+from subspace.core.mmsg import datagram_io, mmsg_available, PlainIO, MMsgIO
+from subspace.core.mmsg import BATCH_SIZE
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(mmsg))
+    return tests
+
+class PlainIOTest(unittest.TestCase):
+    io_class = PlainIO
+
+    def setUp(self):
+        if self.io_class is MMsgIO and not mmsg_available():
+            self.skipTest("recvmmsg/sendmmsg aren't available")
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.io = self.io_class(self.sock)
+
+    def tearDown(self):
+        self.sock.close()
+
+    def test_round_trip(self):
+        datagrams = [("x" * n, self.address) for n in (1, 100, 512)]
+        self.assertEqual(self.io.send_many(datagrams), 3)
+        self.assertEqual(self.io.recv_many(), datagrams)
+        self.assertEqual(self.io.recv_many(), [])
+
+    def test_moves_a_batch_at_a_time(self):
+        datagrams = [(str(n), self.address) for n in range(BATCH_SIZE + 6)]
+        self.assertEqual(self.io.send_many(datagrams), len(datagrams))
+        self.assertEqual(self.io.recv_many(), datagrams[:BATCH_SIZE])
+        self.assertEqual(self.io.recv_many(), datagrams[BATCH_SIZE:])
+
+class MMsgIOTest(PlainIOTest):
+    io_class = MMsgIO
+
+    def test_is_chosen_when_batched(self):
+        self.assertTrue(isinstance(datagram_io(self.sock), MMsgIO))
+        self.assertTrue(isinstance(datagram_io(self.sock, batched=False),
+                                   PlainIO))
+
+if __name__ == '__main__':
+    unittest.main()
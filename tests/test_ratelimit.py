@@ -0,0 +1,66 @@
+import unittest
+import doctest
+from time import time
+from subspace.core import ratelimit
+from subspace.core import packet
+from subspace.core.ratelimit import TokenBucket, ConnectAdmission
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ratelimit))
+    return tests
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_starts_full_and_empties(self):
+        bucket = TokenBucket(rate=1.0, burst=3, now=0.0)
+        self.assertEqual([bucket.take(0.0) for n in range(4)],
+                         [True, True, True, False])
+
+    def test_refills_at_rate(self):
+        bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+        bucket.take(0.0, 3)
+        self.assertFalse(bucket.take(0.25))
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+
+    def test_never_holds_more_than_burst(self):
+        bucket = TokenBucket(rate=100.0, burst=3, now=0.0)
+        self.assertEqual(bucket.refill(1000.0), 3)
+
+    def test_spend_may_go_into_debt(self):
+        bucket = TokenBucket(rate=10.0, burst=5, now=0.0)
+        bucket.spend(15)
+        self.assertEqual(bucket.tokens, -10)
+        self.assertEqual(bucket.ready_at(), 1.1)
+        self.assertFalse(bucket.take(1.0))
+        self.assertTrue(bucket.take(1.1))
+
+class ConnectAdmissionTest(unittest.TestCase):
+
+    connect = packet.Connect(key=1234).raw()
+
+    def test_only_admits_connects(self):
+        admission = ConnectAdmission()
+        self.assertFalse(admission.admit(("10.0.0.1", 1), '\x00\x05abcdef'))
+        self.assertFalse(admission.admit(("10.0.0.1", 1), '\x01\x01abcdef'))
+        self.assertEqual(admission.not_connect, 2)
+
+    def test_limits_each_ip(self):
+        admission = ConnectAdmission(rate=100.0, rate_per_ip=0.2)
+        now = time()
+        self.assertTrue(admission.admit(("10.0.0.1", 1), self.connect, now))
+        self.assertFalse(admission.admit(("10.0.0.1", 2), self.connect, now))
+        self.assertTrue(admission.admit(("10.0.0.2", 1), self.connect, now))
+        self.assertTrue(admission.admit(("10.0.0.1", 3), self.connect,
+                                        now + 5.0))
+        self.assertEqual(admission.ip_rate, 1)
+
+    def test_limits_everyone(self):
+        admission = ConnectAdmission(rate=0.2, rate_per_ip=100.0)
+        now = time()
+        self.assertTrue(admission.admit(("10.0.0.1", 1), self.connect, now))
+        self.assertFalse(admission.admit(("10.0.0.2", 1), self.connect, now))
+        self.assertEqual(admission.global_rate, 1)
+
+if __name__ == '__main__':
+    unittest.main()
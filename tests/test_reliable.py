@@ -0,0 +1,158 @@
+import unittest
+import doctest
+from subspace.core import packet, reliable
+from subspace.core.reliable import ReliableIn, ReliableOut, RTTEstimator
+from subspace.core.reliable import INITIAL_WINDOW, MIN_WINDOW, MAX_WINDOW
+from subspace.core.reliable import MIN_RTO, MAX_RTO
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(reliable))
+    return tests
+
+class ReliableInTest(unittest.TestCase):
+
+    def test_delivers_in_order(self):
+        window = ReliableIn()
+        for seq in (2, 0, 3):
+            self.assertTrue(window.add(packet.Reliable(seq=seq)))
+        self.assertEqual([p.seq for p in window.deliverable()], [0])
+        self.assertEqual(len(window), 2) # 2 and 3 wait for 1
+        window.add(packet.Reliable(seq=1))
+        self.assertEqual([p.seq for p in window.deliverable()], [1, 2, 3])
+        self.assertEqual(window.next_seq, 4)
+        self.assertEqual(len(window), 0)
+
+    def test_duplicates_are_delivered_once(self):
+        window = ReliableIn()
+        window.add(packet.Reliable(seq=1))
+        window.add(packet.Reliable(seq=1))
+        window.add(packet.Reliable(seq=0))
+        self.assertEqual([p.seq for p in window.deliverable()], [0, 1])
+
+    def test_refuses_beyond_the_window(self):
+        window = ReliableIn(window=4)
+        self.assertTrue(window.add(packet.Reliable(seq=3)))
+        self.assertFalse(window.add(packet.Reliable(seq=4)))
+        self.assertEqual(len(window), 1)
+
+class ReliableOutTest(unittest.TestCase):
+
+    def fill(self, window, count, now=0.0, timeout=1.0):
+        return [window.add("x%d" % n, now, timeout) for n in range(count)]
+
+    def test_seqs_and_tails(self):
+        window = ReliableOut()
+        sent = self.fill(window, 3)
+        self.assertEqual([p.seq for p in sent], [0, 1, 2])
+        self.assertEqual([p.tail for p in sent], ["x0", "x1", "x2"])
+        self.assertEqual(len(window), 3)
+
+    def test_ack_walks_up_to_its_seq(self):
+        window = ReliableOut()
+        self.fill(window, 5)
+        self.assertEqual([p.seq for p in window.ack(2)], [0, 1, 2])
+        self.assertEqual(window.ack(1), []) # (already acknowledged)
+        self.assertEqual(len(window), 2)
+        self.assertEqual([p.seq for p in window.ack(10)], [3, 4])
+        self.assertEqual(len(window), 0)
+
+    def test_acknowledged_reliables_dont_expire(self):
+        window = ReliableOut()
+        self.fill(window, 3, now=0.0, timeout=1.0)
+        window.ack(1)
+        self.assertEqual([p.seq for p in window.expired(2.0)], [2])
+        self.assertEqual(window.expired(2.0), []) # (until resent())
+
+    def test_next_due_follows_resends(self):
+        window = ReliableOut()
+        p, = self.fill(window, 1, now=0.0, timeout=1.0)
+        self.assertEqual(window.next_due(), 1.0)
+        window.expired(1.0)
+        window.resent(p, 1.0, 2.0)
+        self.assertEqual(window.next_due(), 3.0)
+        window.ack(0)
+        self.assertEqual(window.next_due(), None)
+
+    def test_slow_start_grows_by_one_per_ack(self):
+        window = ReliableOut()
+        self.fill(window, INITIAL_WINDOW)
+        window.ack(INITIAL_WINDOW - 1)
+        self.assertEqual(window.window, 2 * INITIAL_WINDOW)
+
+    def test_congestion_avoidance_grows_by_one_per_window(self):
+        window = ReliableOut()
+        window.window = window.ssthresh = 10.0
+        self.fill(window, 10)
+        window.ack(9)
+        self.assertAlmostEqual(window.window, 11.0, delta=0.1)
+
+    def test_window_is_capped(self):
+        window = ReliableOut()
+        window.window = float(MAX_WINDOW)
+        self.fill(window, 10)
+        window.ack(9)
+        self.assertEqual(window.window, MAX_WINDOW)
+
+    def test_loss_halves_the_window_once_per_window(self):
+        window = ReliableOut()
+        window.window = 16.0
+        sent = self.fill(window, 16, now=0.0, timeout=1.0)
+        self.assertEqual(len(window.expired(1.0)), 16)
+        self.assertEqual(window.window, 8.0)
+        self.assertEqual(window.losses, 1)
+        for p in sent:
+            window.resent(p, 1.0, 1.0)
+        due = window.expired(2.0) # (the same loss, so no halving again)
+        self.assertEqual(len(due), 8) # (at most a window resent)
+        self.assertEqual(window.window, 8.0)
+        self.assertEqual(window.losses, 1)
+
+    def test_window_never_falls_below_the_minimum(self):
+        window = ReliableOut()
+        for n in range(10):
+            window.add("x", float(n), 0.5)
+            window.expired(n + 1.0)
+        self.assertEqual(window.window, MIN_WINDOW)
+
+    def test_backlog_is_released_as_acks_make_room(self):
+        window = ReliableOut()
+        sent = self.fill(window, INITIAL_WINDOW + 3)
+        self.assertEqual(sent[INITIAL_WINDOW:], [None] * 3)
+        self.assertEqual(window.backlogged, 3)
+        window.ack(0)
+        released = window.released(1.0, 1.0)
+        self.assertEqual(len(released), 2) # (9 - 7 in flight)
+        window.ack(2)
+        released += window.released(1.0, 1.0)
+        self.assertEqual([p.seq for p in released],
+                         range(INITIAL_WINDOW, INITIAL_WINDOW + 3))
+        self.assertEqual([p.tail for p in released],
+                         ["x%d" % n for n in range(INITIAL_WINDOW,
+                                                   INITIAL_WINDOW + 3)])
+        self.assertEqual(window.stats()[3], ("backlog", 0))
+
+    def test_new_reliables_queue_behind_the_backlog(self):
+        window = ReliableOut()
+        self.fill(window, INITIAL_WINDOW + 1)
+        window.ack(0) # (room for one, but the backlog goes first)
+        self.assertEqual(window.add("late", 0.0, 1.0), None)
+        released = window.released(1.0, 1.0)
+        self.assertEqual(released[0].tail, "x%d" % INITIAL_WINDOW)
+
+class RTTEstimatorTest(unittest.TestCase):
+
+    def test_first_sample(self):
+        rtt = RTTEstimator()
+        rtt.sample(0.2)
+        self.assertEqual(rtt.srtt, 0.2)
+        self.assertEqual(rtt.rttvar, 0.1)
+        self.assertAlmostEqual(rtt.rto, 0.6)
+
+    def test_rto_is_bounded(self):
+        rtt = RTTEstimator()
+        rtt.sample(0.0)
+        self.assertEqual(rtt.rto, MIN_RTO)
+        self.assertEqual(rtt.timeout(resends=20), MAX_RTO)
+
+if __name__ == '__main__':
+    unittest.main()
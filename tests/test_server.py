@@ -0,0 +1,297 @@
+import unittest
+from Queue import Queue
+from socket import socket, AF_INET, SOCK_DGRAM
+from threading import Thread, current_thread
+from time import time
+from subspace.core import packet
+from subspace.core.client import Client
+from subspace.core.server import Server, CoreConnection, _Poller
+import subspace.core.server as server_module
+from subspace.game.s2c_packet import ArenaSettings, PlayerChatMessage
+from subspace.game.s2c_packet import PlayerPosition
+
+def chat(message):
+    """ This returns a public chat packet, '\\x07\\x02...' on the wire. """
+    return PlayerChatMessage(type=2, tail=message + "\x00")
+
+def quiet_server(**options):
+    """
+    This returns a Server whose threads are already stopped, so only the
+    test flushes its connections (see Server._collect_outgoing).
+    """
+    server = Server(("127.0.0.1", 0), **options)
+    server.shutdown()
+    return server
+
+def connect(server, address=("127.0.0.1", 1)):
+    """ This has a client at address Connect, returning its connection. """
+    server._handle_datagram(packet.Connect(key=1234).raw(), address)
+    return server._connections.get(address)
+
+def parts(conn, data):
+    """ This decrypts a flushed datagram, returning the packets inside. """
+    prefix_size = 2 if data[0] == '\x00' else 1
+    raw = data[:prefix_size] + conn._enc.decrypt(data[prefix_size:])
+    if raw[:2] != '\x00' + packet.Cluster._id:
+        return [raw]
+    raws, offset = [], 2
+    while offset < len(raw): # (each is its length byte, then itself)
+        size = ord(raw[offset])
+        raws.append(raw[offset + 1:offset + 1 + size])
+        offset += 1 + size
+    return raws
+
+class ServerTestCase(unittest.TestCase):
+    """ This has a quiet server, with one connection (its Connect flushed). """
+    options = {}
+
+    def setUp(self):
+        self.server = quiet_server(**self.options)
+        self.conn = connect(self.server)
+        self.server._collect_outgoing(force=True) # (the ConnectResponse)
+
+    def tearDown(self):
+        for conn in self.server._connections.values():
+            conn._stop_timers()
+        self.server._server_socket.close()
+
+    def flush(self, force=True):
+        """ This returns the packets flushed to self.conn (decrypted). """
+        return [raw for data, address in self.server._collect_outgoing(force)
+                    for raw in parts(self.conn, data)]
+
+class CorePrefixTest(ServerTestCase):
+    """
+    Only a Connect (in) and ConnectResponse (out) go unencrypted, every other
+    packet (core or not, whatever its second byte) must still be encrypted.
+    """
+
+    def test_decrypts_core_packets(self):
+        self.assertEqual(self.conn._decrypt_packet('\x00\x05' + 'abcdefgh'),
+                         '\x00\x05' + self.conn._enc.decrypt('abcdefgh'))
+        self.assertEqual(self.conn._decrypt_packet('\x42\x01abcdefg'),
+                         '\x42' + self.conn._enc.decrypt('\x01abcdefg'))
+
+    def test_doesnt_decrypt_a_connect(self):
+        connect = packet.Connect(key=1234).raw()
+        self.assertEqual(self.conn._decrypt_packet(connect), connect)
+
+    def test_sends_only_the_connect_response_unencrypted(self):
+        self.conn._handle_connect(packet.Connect(key=1234).raw()) # (again)
+        self.conn.send(chat("hi")) # '\x07\x02...'
+        datagrams = self.server._collect_outgoing(force=True)
+        response = packet.ConnectResponse(
+                            server_key=self.conn._server_key).raw()
+        self.assertEqual(datagrams[0], (response, self.conn.address))
+        self.assertEqual(len(datagrams), 2)
+        self.assertEqual(datagrams[1], ('\x07' + self.conn._enc.encrypt(
+                            chat("hi").raw()[1:]), self.conn.address))
+
+class PollerTest(unittest.TestCase):
+
+    def test_polls_for_readable_sockets(self):
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        poller = _Poller()
+        poller.watch(sock.fileno())
+        self.assertEqual(poller.poll(0), set())
+        sock.sendto("x", sock.getsockname())
+        self.assertEqual(poller.poll(5.0), set([sock.fileno()]))
+        sock.close()
+
+class ReactorTest(unittest.TestCase):
+    """ In reactor mode, one thread does all that the threaded mode does. """
+
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), reactor=True)
+        self.client = Client(self.server.address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+
+    def test_round_trip(self):
+        self.assertEqual(self.server._threads.keys(), ["reactor"])
+        self.client.send(chat("hello"), reliable=True)
+        address, raw_packet = self.server.recv(timeout=5.0)
+        self.assertEqual(raw_packet, chat("hello").raw())
+        self.server.send(address, chat("hi"), reliable=True)
+        self.assertEqual(self.client.recv(timeout=5.0), chat("hi").raw())
+
+    def test_timers_fire_on_the_reactor(self):
+        fired = Queue()
+        self.server._call_later(0.01, lambda: fired.put(current_thread().name))
+        self.assertEqual(fired.get(timeout=5.0), "Server:Core:reactor")
+
+class DelayedAckTest(ServerTestCase):
+    options = {"ack_delay" : 10.0}
+
+    def receive_reliable(self, seq):
+        self.conn._handle_reliable(packet.Reliable(seq=seq,
+                                                   tail=chat("x").raw()).raw())
+
+    def test_acks_wait_for_ack_delay(self):
+        self.receive_reliable(0)
+        self.assertEqual(self.flush(force=False), [])
+        self.assertEqual(self.server._next_flush,
+                         self.conn._acks_since + 10.0)
+
+    def test_acks_go_out_together(self):
+        for seq in (0, 1, 2):
+            self.receive_reliable(seq)
+        self.receive_reliable(1) # (a repeat is re-ACKed, but only once)
+        self.assertEqual(self.flush(),
+                         [packet.ReliableACK(seq=seq).raw() for seq in (0,1,2)])
+
+    def test_acks_join_other_packets(self):
+        self.receive_reliable(0)
+        self.conn.send(chat("reply"), reliable=True)
+        ack, reply = self.flush()
+        self.assertEqual(ack, packet.ReliableACK(seq=0).raw())
+        self.assertEqual(packet.Reliable(reply).tail, chat("reply").raw())
+
+    def test_acks_arent_lost_between_threads(self):
+        seqs = range(5000)
+        receiving = Thread(target=lambda: [self.conn._queue_ack(seq)
+                                           for seq in seqs])
+        receiving.start()
+        taken = []
+        while receiving.is_alive():
+            taken.extend(self.conn._take_acks())
+        receiving.join()
+        taken.extend(self.conn._take_acks())
+        self.assertEqual(taken, [packet.ReliableACK(seq=seq).raw()
+                                 for seq in seqs])
+        self.assertEqual(self.conn._acks_since, None)
+
+    def test_a_reply_doesnt_wait_for_ack_delay(self):
+        self.receive_reliable(0)
+        self.assertEqual(self.flush(force=False), []) # (the ACK waits)
+        woken = []
+        self.server._output_ready = lambda: woken.append(True)
+        self.conn.send(chat("reply"), reliable=True)
+        self.assertEqual(woken, [True])
+        self.assertEqual(len(self.flush(force=False)), 2)
+
+class IdleEvictionTest(ServerTestCase):
+    options = {"idle_timeout" : 30.0, "max_connections" : 2}
+
+    def test_sends_a_keepalive_halfway(self):
+        self.conn._last_received = time() - 16.0
+        self.conn._check_idle()
+        self.assertEqual(self.server.keepalives_sent, 1)
+        self.assertEqual([raw[:2] for raw in self.flush()],
+                         ['\x00' + packet.Sync._id])
+        self.assertTrue(self.conn.address in self.server._connections)
+
+    def test_evicts_when_idle(self):
+        self.conn._last_received = time() - 31.0
+        self.conn._check_idle()
+        self.assertEqual(self.server.evicted_idle, 1)
+        self.assertFalse(self.conn.address in self.server._connections)
+        self.assertEqual(self.server.recv(timeout=0), (self.conn.address, None))
+        self.assertEqual([raw[:2] for raw in self.flush()],
+                         ['\x00' + packet.Disconnect._id] * 2)
+
+    def test_refuses_connections_past_the_cap(self):
+        self.assertNotEqual(connect(self.server, ("127.0.0.1", 2)), None)
+        self.assertEqual(connect(self.server, ("127.0.0.1", 3)), None)
+        self.assertEqual(self.server.refused_full, 1)
+
+class ReadySetTest(ServerTestCase):
+
+    def test_only_ready_connections_are_flushed(self):
+        other = connect(self.server, ("127.0.0.1", 2))
+        self.server._collect_outgoing(force=True)
+        self.conn.send(chat("a"), reliable=True)
+        self.conn.send(chat("b"), reliable=True)
+        self.assertEqual(list(self.server._ready), [self.conn]) # (just once)
+        datagrams = self.server._collect_outgoing(force=True)
+        self.assertEqual([address for data, address in datagrams],
+                         [self.conn.address])
+        self.assertEqual(len(self.server._ready), 0)
+        self.assertEqual(self.server._collect_outgoing(force=True), [])
+
+class ClusterDelayTest(ServerTestCase):
+    options = {"cluster_delay" : 10.0}
+
+    def test_connections_wait_for_company(self):
+        self.conn.send(chat("a"), reliable=True)
+        self.assertEqual(self.flush(force=False), [])
+        self.assertEqual(list(self.server._ready), [self.conn])
+        self.assertEqual(self.server._next_flush, self.conn._out_since + 10.0)
+        self.conn.send(chat("b"), reliable=True)
+        self.assertEqual([packet.Reliable(raw).tail for raw in self.flush()],
+                         [chat("a").raw(), chat("b").raw()])
+
+class LaneTest(ServerTestCase):
+
+    def position(self, player_id, x):
+        return PlayerPosition(player_id=player_id, x=x)
+
+    def test_positions_are_coalesced(self):
+        self.conn.send(self.position(1, 100))
+        self.conn.send(self.position(2, 200))
+        self.conn.send(self.position(1, 101))
+        self.assertEqual(sorted(self.flush()),
+                         sorted([self.position(1, 101).raw(),
+                                 self.position(2, 200).raw()]))
+        self.assertEqual(self.server.coalesced_packets, 1)
+
+    def test_lanes_go_in_order(self):
+        self.conn.send(chat("event"))
+        self.conn.send(self.position(1, 100))
+        self.conn.send(chat("reliable"), reliable=True)
+        flushed = self.flush()
+        self.assertEqual(flushed[0][:2], '\x00' + packet.Reliable._id)
+        self.assertEqual(flushed[1:], [self.position(1, 100).raw(),
+                                       chat("event").raw()])
+
+class SyncResponseTest(ServerTestCase):
+
+    def respond(self, remote_time, received):
+        """ This has the SyncResponse to a Sync sent at remote_time come. """
+        now, server_module.now = server_module.now, lambda: received
+        try:
+            self.conn._handle_sync_response(packet.SyncResponse(
+                        remote_time=remote_time, sender_time=0).raw())
+        finally:
+            server_module.now = now
+
+    def test_rtt_across_the_wrap(self):
+        self.respond(0xFFFFFFFB, 5) # (10 ticks)
+        self.assertEqual(self.conn.rtt.srtt, 0.1)
+
+    def test_ignores_a_response_from_the_future(self):
+        self.respond(1010, 1000)
+        self.assertEqual(self.conn.rtt.srtt, None)
+
+class ChunkedTest(ServerTestCase):
+
+    def test_caches_chunks_only_when_asked(self):
+        settings, cache = ArenaSettings(), self.server.chunk_cache
+        self.server.send_chunked(self.conn.address, settings)
+        self.assertEqual(len(cache), 0)
+        for n in range(2):
+            self.server.send_chunked(self.conn.address, settings, cache=True)
+        self.assertEqual((len(cache), cache.misses, cache.hits), (1, 1, 1))
+        tails = [packet.Reliable(raw).tail for raw in self.flush()]
+        self.assertEqual(tails[:3], list(cache.raws(settings))) # (the same)
+
+class SlotsTest(ServerTestCase):
+    """ Connections (and what each one holds) have no __dict__. """
+
+    def test_connections_have_slots(self):
+        for obj in (self.conn, self.conn._reliable_in, self.conn._reliable_out,
+                    self.conn.rtt, self.conn.clock,
+                    packet.Reliable(seq=0, tail="x")):
+            self.assertFalse(hasattr(obj, "__dict__"), obj)
+        self.assertRaises(AttributeError, setattr, self.conn, "spare", 1)
+
+    def test_connections_share_one_dispatch_table(self):
+        other = connect(self.server, ("127.0.0.1", 2))
+        self.assertTrue(self.conn._handlers is other._handlers)
+        self.assertTrue(self.conn._handlers is CoreConnection._handlers)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from socket import socket, AF_INET, SOCK_DGRAM
+from subspace.core.client import Client
+from subspace.core.shard import ShardedServer
+from subspace.game.s2c_packet import PlayerChatMessage
+
+def chat(message):
+    return PlayerChatMessage(type=2, tail=message + "\x00")
+
+def free_address():
+    """ This returns an address (with a fixed port) nothing is bound to. """
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+class ShardedServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ShardedServer(free_address(), workers=2)
+        self.client = Client(self.server.address)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+
+    def test_round_trip(self):
+        self.client.send(chat("hello"), reliable=True)
+        address, raw_packet = self.server.recv(timeout=5.0)
+        self.assertEqual(raw_packet, chat("hello").raw())
+        self.assertEqual(address, self.client._socket.getsockname())
+        self.server.send(address, chat("hi"), reliable=True)
+        self.assertEqual(self.client.recv(timeout=5.0), chat("hi").raw())
+
+    def test_forwards_clocks(self):
+        self.client.send(chat("hello"), reliable=True) # (after its Sync)
+        address, raw_packet = self.server.recv(timeout=5.0)
+        clock = self.server.clock(address)
+        self.assertNotEqual(clock, None)
+        self.assertNotEqual(clock.offset, None)
+
+    def test_sends_to_unknown_addresses_fail(self):
+        self.assertFalse(self.server.send(("127.0.0.1", 1), chat("x")))
+
+if __name__ == '__main__':
+    unittest.main()
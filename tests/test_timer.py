@@ -0,0 +1,74 @@
+import unittest
+import doctest
+from threading import Event
+from subspace.core import timer
+from subspace.core.timer import TimerWheel, TimerService, TICK, LEVEL_BITS
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(timer))
+    return tests
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(start=0.0)
+        self.fired = []
+
+    def test_fires_on_time(self):
+        self.wheel.schedule_at(0.5, self.fired.append, "a")
+        self.assertEqual(self.wheel.advance(0.49), 0) # (never early)
+        self.assertEqual(self.wheel.advance(0.5 + TICK), 1) # (at most a TICK)
+        self.assertEqual(self.fired, ["a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_fires_in_deadline_order(self):
+        for deadline in (0.3, 0.1, 0.2):
+            self.wheel.schedule_at(deadline, self.fired.append, deadline)
+        for n in range(1, 40):
+            self.wheel.advance(n * TICK)
+        self.assertEqual(self.fired, [0.1, 0.2, 0.3])
+
+    def test_fires_past_deadlines_at_once(self):
+        self.wheel.advance(1.0)
+        self.wheel.schedule_at(0.5, self.fired.append, "late")
+        self.assertEqual(self.wheel.next_deadline(), 1.0)
+        self.assertEqual(self.wheel.advance(1.0), 1)
+
+    def test_cancelled_timers_dont_fire(self):
+        self.wheel.schedule_at(0.5, self.fired.append, "a").cancel()
+        self.assertEqual(self.wheel.advance(1.0), 0)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_far_timers_cascade_down(self):
+        far = (1 << LEVEL_BITS[0]) * TICK * 3.5 # (on level 1)
+        self.wheel.schedule_at(far, self.fired.append, "far")
+        self.assertEqual(self.wheel.advance(far - TICK), 0)
+        self.assertTrue(self.wheel.cascaded > 0)
+        self.assertEqual(self.wheel.advance(far + TICK), 1)
+        self.assertEqual(self.fired, ["far"])
+
+    def test_an_error_doesnt_stop_the_rest(self):
+        self.wheel.schedule_at(0.1, lambda: 1 / 0)
+        self.wheel.schedule_at(0.1, self.fired.append, "b")
+        self.assertEqual(self.wheel.advance(0.2), 2)
+        self.assertEqual(self.fired, ["b"])
+
+    def test_next_deadline(self):
+        self.assertEqual(self.wheel.next_deadline(), None)
+        self.wheel.schedule_at(0.25, self.fired.append, "a")
+        self.assertAlmostEqual(self.wheel.next_deadline(), 0.25)
+
+class TimerServiceTest(unittest.TestCase):
+
+    def test_fires_on_its_thread_until_stopped(self):
+        service = TimerService()
+        fired = Event()
+        service.schedule(0.01, fired.set)
+        self.assertTrue(fired.wait(5.0))
+        thread = service._thread
+        service.stop()
+        self.assertFalse(thread.is_alive())
+
+if __name__ == '__main__':
+    unittest.main()